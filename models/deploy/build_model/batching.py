@@ -0,0 +1,175 @@
+"""
+Dynamic request batching in front of the model.
+
+Flask handles each request on its own thread. Instead of every thread calling generate, requests
+are queued and a single scheduler thread drains the queue into batches, bounded by a token budget
+and a maximum queue delay, runs one generate per batch and scatters the outputs back.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+# Padded tokens (prompt + new tokens, times the batch size) one batch may hold
+MAX_BATCH_TOKENS = int(os.environ.get("MAX_BATCH_TOKENS", 16384))
+# How long the first request of a batch waits for others to join it
+MAX_QUEUE_DELAY_MS = float(os.environ.get("MAX_QUEUE_DELAY_MS", 10))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 16))
+
+
+@dataclass
+class GenerationRequest:
+    """One prompt waiting for its completion."""
+
+    prompt: str
+    num_prompt_tokens: int
+    max_new_tokens: int
+    # A transformers streamer fed with the tokens as they are generated, for /predict_stream
+    streamer: Any = None
+    # The document the prompt is about, its KV cache is shared between requests (see prefix_cache.py)
+    context: Optional[str] = None
+    # {"type", "count"} of a schema-constrained JSON completion (see structured.py)
+    response_format: Optional[dict] = None
+    # Sampling temperature, 0 decodes greedily
+    temperature: float = 0.0
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+def padded_tokens(requests):
+    """The tokens a batch occupies once every prompt is left-padded to the longest one."""
+    if not requests:
+        return 0
+    longest_prompt = max(request.num_prompt_tokens for request in requests)
+    longest_output = max(request.max_new_tokens for request in requests)
+    return len(requests) * (longest_prompt + longest_output)
+
+
+def end_stream(request):
+    """Unblocks the reader of a request's streamer, e.g. when generation failed half way."""
+    if request.streamer is not None:
+        request.streamer.end()
+
+
+class DynamicBatcher:
+    """
+    Collects pending requests into batches and runs them on a single scheduler thread.
+
+    Attributes:
+        generate_batch (callable): (prompts, max_new_tokens, streamer, context, response_formats,
+            temperature) -> list of (completion, generated tokens), in one generate call
+        max_batch_tokens (int): token budget of a batch, see padded_tokens
+        max_queue_delay (float): seconds the oldest request waits before its batch is run anyway
+        max_batch_size (int): most requests in one batch
+    """
+
+    def __init__(
+        self,
+        generate_batch,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        max_queue_delay_ms: float = MAX_QUEUE_DELAY_MS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+    ):
+        self.generate_batch = generate_batch
+        self.max_batch_tokens = max_batch_tokens
+        self.max_queue_delay = max_queue_delay_ms / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self._queue = queue.Queue()
+        # Requests that didn't fit in the previous batch, they open the next ones
+        self._pending = deque()
+        self._thread = threading.Thread(target=self._run, name="dynamic-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: str,
+        num_prompt_tokens: int,
+        max_new_tokens: int,
+        streamer=None,
+        context: str = None,
+        response_format: dict = None,
+        temperature: float = 0.0,
+    ) -> Future:
+        """
+        Queues one prompt. Only requests about the same context share a batch, their context is
+        prefilled once. A request with a streamer runs in a batch of its own, transformers
+        streamers only handle one sequence. Constrained and free requests share batches, the
+        constraint is applied per row. generate samples a whole batch alike, so only requests
+        with the same temperature share one.
+
+        Returns:
+            Future: resolves to (generated text, number of generated tokens)
+        """
+        request = GenerationRequest(
+            prompt, num_prompt_tokens, max_new_tokens, streamer, context, response_format, temperature
+        )
+        self._queue.put(request)
+        return request.future
+
+    def _fits(self, batch, request):
+        return (
+            request.streamer is None
+            and request.context == batch[0].context
+            and request.temperature == batch[0].temperature
+            and padded_tokens(batch + [request]) <= self.max_batch_tokens
+        )
+
+    def _next_batch(self):
+        """
+        Blocks for a first request, then adds more until the budget, size or delay is reached.
+        Requests that can't join this batch wait in _pending, in arrival order.
+        """
+        first = self._pending.popleft() if self._pending else self._queue.get()
+        batch = [first]
+        if first.streamer is not None:
+            return batch
+
+        skipped = deque()
+        while self._pending and len(batch) < self.max_batch_size:
+            request = self._pending.popleft()
+            (batch if self._fits(batch, request) else skipped).append(request)
+
+        deadline = first.enqueued_at + self.max_queue_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            (batch if self._fits(batch, request) else skipped).append(request)
+
+        skipped.extend(self._pending)
+        self._pending = skipped
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.perf_counter()
+            try:
+                outputs = self.generate_batch(
+                    [request.prompt for request in batch],
+                    [request.max_new_tokens for request in batch],
+                    batch[0].streamer,
+                    batch[0].context,
+                    [request.response_format for request in batch],
+                    batch[0].temperature,
+                )
+            except Exception as e:
+                logging.exception(f"Batch of {len(batch)} requests failed")
+                for request in batch:
+                    end_stream(request)
+                    request.future.set_exception(e)
+                continue
+
+            logging.info(
+                f"Generated a batch of {len(batch)} ({padded_tokens(batch)} padded tokens) "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+            for request, output in zip(batch, outputs):
+                request.future.set_result(output)
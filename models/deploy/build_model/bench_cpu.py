@@ -0,0 +1,100 @@
+"""
+Benchmark of the CPU backend: generated tokens per second and memory of the int8 model against fp32.
+
+Each variant is loaded in a process of its own so its resident memory isn't mixed with the
+other's. The prompts are explanation requests, the workload CPU replicas are meant for:
+
+    python3 bench_cpu.py --model-dir /tmp/hugging-face-models/llama-7b-pruned --batch-sizes 1,4 --new-tokens 64
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+VARIANTS = ("none", "int8")
+DOCUMENT = (
+    "The mitochondrion is the site of aerobic respiration in eukaryotic cells. Glycolysis happens "
+    "in the cytoplasm, the Krebs cycle in the mitochondrial matrix and oxidative phosphorylation "
+    "across the inner membrane, where ATP synthase uses the proton gradient to make ATP."
+)
+PROMPT = "Explain why the answer 'ATP synthase' to the question 'What makes ATP?' is correct, based on the text above."
+
+
+def memory_mib():
+    """Current and peak resident memory of this process, from /proc."""
+    status = {}
+    with open("/proc/self/status") as file:
+        for line in file:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                status[name] = int(value.split()[0]) / 1024
+    return status.get("VmRSS", 0.0), status.get("VmHWM", 0.0)
+
+
+def run_variant(model_dir, variant, batch_sizes, new_tokens):
+    """Loads one variant and times greedy generation of new_tokens at each batch size."""
+    import torch
+    from transformers import AutoTokenizer
+
+    from cpu_backend import load_cpu_model
+
+    started = time.perf_counter()
+    model = load_cpu_model(model_dir, variant)
+    load_seconds = time.perf_counter() - started
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    result = {"variant": variant, "load_seconds": load_seconds, "tokens_per_second": {}}
+    for batch_size in batch_sizes:
+        inputs = tokenizer([f"{DOCUMENT}\n{PROMPT}"] * batch_size, return_tensors="pt", padding=True)
+        settings = dict(do_sample=False, pad_token_id=tokenizer.pad_token_id)
+        with torch.inference_mode():
+            # The first call at a batch size pays for allocations, it isn't timed
+            model.generate(**inputs, max_new_tokens=2, **settings)
+            started = time.perf_counter()
+            model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens, **settings)
+        elapsed = time.perf_counter() - started
+        result["tokens_per_second"][str(batch_size)] = batch_size * new_tokens / elapsed
+
+    result["rss_mib"], result["peak_rss_mib"] = memory_mib()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens/s and RSS of the CPU backend, int8 against fp32.")
+    parser.add_argument("--model-dir", required=True)
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--variants", default=",".join(VARIANTS), help="CPU_QUANTIZE values to compare")
+    parser.add_argument("--only", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+
+    if args.only:
+        # Child process: one variant, its result as the last line of output
+        print(json.dumps(run_variant(args.model_dir, args.only, batch_sizes, args.new_tokens)))
+        return
+
+    results = []
+    for variant in args.variants.split(","):
+        command = [sys.executable, __file__, "--only", variant] + sys.argv[1:]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = results[0]["tokens_per_second"]
+    print(f"{'variant':>8} {'load s':>8} {'RSS MiB':>9} {'peak MiB':>9}  tokens/s by batch size")
+    for result in results:
+        speeds = ", ".join(
+            f"{size}: {speed:.1f} ({speed / baseline[size]:.2f}x)" for size, speed in result["tokens_per_second"].items()
+        )
+        print(
+            f"{result['variant']:>8} {result['load_seconds']:>8.1f} {result['rss_mib']:>9.0f} "
+            f"{result['peak_rss_mib']:>9.0f}  {speeds}"
+        )
+
+
+if __name__ == "__main__":
+    main()
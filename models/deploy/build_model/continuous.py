@@ -0,0 +1,373 @@
+"""
+Continuous (iteration-level) batching.
+
+Instead of running generate to completion for a whole batch, the engine runs one decoding step at a
+time over a fixed set of slots. After every step finished sequences leave their slot and queued
+requests are admitted into the free ones, so a short explanation never waits for a long MCQ list.
+
+All slots share one preallocated KV cache of shape [layers, slots, heads, max_seq_len, head_dim].
+Columns are decoding steps: every step writes column `t` for all slots, a sequence's prompt is
+prefilled on its own and copied right-aligned so it ends at the current column, and each slot's
+attention mask covers only its own columns. The model sees the cache through SlotCache, whose
+update writes the step's column straight into the shared tensors and hands back views of them, so
+a step allocates nothing proportional to the sequence length.
+
+Requests are decoded greedily unless they have a temperature, greedy slots give the same tokens as
+generate_batch with do_sample=False, so switching BATCHING_MODE changes the scheduling and not the
+tokens. A sampled slot draws its token the way generate does: temperature, then top-k, then top-p.
+"""
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+from transformers import DynamicCache
+
+from batching import GenerationRequest, end_stream
+from prefix_cache import PrefixCache, encode, to_cache, to_pairs
+from structured import JsonConstraint
+
+MAX_SLOTS = int(os.environ.get("CONTINUOUS_MAX_SLOTS", 8))
+# Columns of the shared KV cache, the longest prompt + completion a slot can hold
+MAX_SEQ_LEN = int(os.environ.get("CONTINUOUS_MAX_SEQ_LEN", 2048))
+
+
+def sample_token(scores: torch.Tensor, temperature: float, top_k: int = 0, top_p: float = 1.0) -> int:
+    """
+    Samples one token from a row of logits, like generate's temperature, top-k and top-p warpers.
+    Tokens masked to -inf (e.g. by a JSON constraint) are never drawn.
+    """
+    scores = scores.float() / temperature
+    if top_k and top_k < scores.numel():
+        kth = torch.topk(scores, top_k).values[-1]
+        scores = scores.masked_fill(scores < kth, float("-inf"))
+    probs = torch.softmax(scores, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, indices = probs.sort(descending=True)
+        # Keep the smallest set of tokens whose probability reaches top_p, at least the first
+        sorted_probs[(sorted_probs.cumsum(-1) - sorted_probs) > top_p] = 0
+        probs = torch.zeros_like(probs).scatter(-1, indices, sorted_probs)
+    return int(torch.multinomial(probs, 1))
+
+
+class SlotCache(DynamicCache):
+    """
+    The shared KV cache as the model's cache object, for one step. Layers start as views of the
+    first `length` columns, update writes the new columns in place after them and returns the
+    views grown by as many, where DynamicCache would concatenate a copy of the whole past.
+    """
+
+    def __init__(self, keys: torch.Tensor, values: torch.Tensor, length: int):
+        super().__init__()
+        self.buffers = (keys, values)
+        self.length = length
+        num_layers = keys.shape[0]
+        if hasattr(self, "layers"):
+            from transformers.cache_utils import DynamicLayer
+
+            self.layers = []
+            for _ in range(num_layers):
+                layer = DynamicLayer()
+                layer.dtype, layer.device, layer.is_initialized = keys.dtype, keys.device, True
+                self.layers.append(layer)
+        else:
+            # Before transformers kept layer objects, the cache was two lists of tensors
+            self.key_cache, self.value_cache = [None] * num_layers, [None] * num_layers
+        for layer in range(num_layers):
+            self._set(layer, keys[layer, :, :, :length], values[layer, :, :, :length])
+
+    def _set(self, layer: int, key: torch.Tensor, value: torch.Tensor):
+        if hasattr(self, "layers"):
+            self.layers[layer].keys, self.layers[layer].values = key, value
+        else:
+            self.key_cache[layer], self.value_cache[layer] = key, value
+
+    def update(self, key_states, value_states, layer_idx, *args, **kwargs):
+        keys, values = self.buffers
+        end = self.length + key_states.shape[-2]
+        keys[layer_idx, :, :, self.length : end] = key_states
+        values[layer_idx, :, :, self.length : end] = value_states
+        self._set(layer_idx, keys[layer_idx, :, :, :end], values[layer_idx, :, :, :end])
+        return keys[layer_idx, :, :, :end], values[layer_idx, :, :, :end]
+
+
+class ContinuousBatcher:
+    """
+    Decodes up to `max_slots` sequences together, admitting and retiring them at every step.
+
+    Attributes:
+        model: the causal LM, called one step at a time with views of the shared cache
+        tokenizer: its tokenizer
+        max_slots (int): sequences decoded together
+        max_seq_len (int): columns of the preallocated KV cache
+        prefix_cache (PrefixCache): KV caches of the documents prompts are about
+        top_k (int): top-k of the sampled requests, 0 keeps every token
+        top_p (float): top-p of the sampled requests
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_slots: int = MAX_SLOTS,
+        max_seq_len: int = MAX_SEQ_LEN,
+        prefix_cache: PrefixCache = None,
+        top_k: int = 50,
+        top_p: float = 1.0,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_slots = max_slots
+        self.max_seq_len = max_seq_len
+        self.top_k = top_k
+        self.top_p = top_p
+
+        config = model.config
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = config.hidden_size // num_heads
+        parameter = next(model.parameters())
+        self.device = parameter.device
+        self.prefix_cache = prefix_cache or PrefixCache(self.device)
+
+        shape = (config.num_hidden_layers, max_slots, num_kv_heads, max_seq_len, head_dim)
+        self.keys = torch.zeros(shape, dtype=parameter.dtype, device=self.device)
+        self.values = torch.zeros(shape, dtype=parameter.dtype, device=self.device)
+        self.mask = torch.zeros((max_slots, max_seq_len), dtype=torch.long, device=self.device)
+        logging.info(
+            f"Continuous batching: {max_slots} slots x {max_seq_len} tokens, "
+            f"{2 * self.keys.numel() * self.keys.element_size() / 1024**3:.1f} GiB of KV cache"
+        )
+
+        # The column the next decoding step writes
+        self.t = 0
+        # Per slot: the request, its first cache column, prompt ids, generated ids, JSON constraint
+        self.requests = [None] * max_slots
+        self.starts = [0] * max_slots
+        self.prompt_ids = [None] * max_slots
+        self.generated = [None] * max_slots
+        self.constraints = [None] * max_slots
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="continuous-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        prompt: str,
+        num_prompt_tokens: int,
+        max_new_tokens: int,
+        streamer=None,
+        context: str = None,
+        response_format: dict = None,
+        temperature: float = 0.0,
+    ) -> Future:
+        """
+        Queues one prompt, same interface as DynamicBatcher. Streamed requests are decoded with the
+        others, their streamer gets each token as it comes out of the step, and so are sampled
+        requests, each slot picks its token with its own temperature.
+
+        Returns:
+            Future: resolves to (generated text, number of generated tokens)
+        """
+        request = GenerationRequest(
+            prompt, num_prompt_tokens, max_new_tokens, streamer, context, response_format, temperature
+        )
+        self._queue.put(request)
+        return request.future
+
+    def _active(self):
+        return [slot for slot, request in enumerate(self.requests) if request is not None]
+
+    def _shift(self, offset):
+        """Moves the live columns right (offset > 0) or left (offset < 0)."""
+        if offset > 0:
+            source, target, vacated = slice(0, self.t), slice(offset, offset + self.t), slice(0, offset)
+        else:
+            source, target = slice(-offset, self.t), slice(0, self.t + offset)
+            vacated = slice(self.t + offset, self.t)
+
+        for buffer in (self.keys, self.values):
+            buffer[..., target, :] = buffer[..., source, :].clone()
+        self.mask[:, target] = self.mask[:, source].clone()
+        self.mask[:, vacated] = 0
+
+        self.t += offset
+        self.starts = [start + offset for start in self.starts]
+
+    def _admit(self, request: GenerationRequest, slot: int):
+        """
+        Prefills a request on its own and copies its cache into the slot, ending at column t. The
+        KV cache of a request's context comes from the prefix cache, only the rest is prefilled.
+        """
+        context_ids, suffix_ids = encode(self.tokenizer, request.prompt, request.context)
+        input_ids = suffix_ids if context_ids is None else torch.cat([context_ids, suffix_ids])
+        length = len(input_ids)
+        if length + 1 >= self.max_seq_len:
+            end_stream(request)
+            request.future.set_exception(
+                ValueError(f"Prompt of {length} tokens doesn't fit in CONTINUOUS_MAX_SEQ_LEN={self.max_seq_len}")
+            )
+            return
+
+        # Make room on the left when the prompt is longer than the columns written so far
+        if length > self.t:
+            self._shift(length - self.t)
+
+        with torch.inference_mode():
+            if context_ids is None:
+                output = self.model(input_ids=input_ids.unsqueeze(0).to(self.device), use_cache=True)
+            else:
+                prefix = self.prefix_cache.get_or_prefill(self.model, context_ids, request.context)
+                positions = torch.arange(len(context_ids), length, device=self.device).unsqueeze(0)
+                output = self.model(
+                    input_ids=suffix_ids.unsqueeze(0).to(self.device),
+                    past_key_values=to_cache(prefix),
+                    position_ids=positions,
+                    use_cache=True,
+                )
+        for layer, (key, value) in enumerate(to_pairs(output.past_key_values)):
+            self.keys[layer, slot, :, self.t - length : self.t] = key[0]
+            self.values[layer, slot, :, self.t - length : self.t] = value[0]
+
+        self.mask[slot] = 0
+        self.mask[slot, self.t - length : self.t] = 1
+        self.requests[slot] = request
+        self.starts[slot] = self.t - length
+        self.prompt_ids[slot] = input_ids.to(self.device)
+        self.constraints[slot] = (
+            JsonConstraint(self.tokenizer, request.response_format) if request.response_format else None
+        )
+        self.generated[slot] = [self._pick(slot, output.logits[0, -1])]
+        if request.streamer is not None:
+            # Streamers skip the first thing they are given as the prompt
+            request.streamer.put(input_ids)
+            request.streamer.put(torch.tensor(self.generated[slot][-1:]))
+        self._retire_if_done(slot)
+
+    def _pick(self, slot: int, scores: torch.Tensor) -> int:
+        """
+        A slot's next token, greedy or sampled at the request's temperature, within its JSON
+        grammar if it has one.
+        """
+        constraint = self.constraints[slot]
+        if constraint is not None:
+            scores = constraint.mask(scores.float())
+        temperature = self.requests[slot].temperature
+        if temperature > 0:
+            token = sample_token(scores, temperature, self.top_k, self.top_p)
+        else:
+            token = int(scores.argmax())
+        if constraint is not None:
+            constraint.advance(token)
+        return token
+
+    def _try_admit(self, request: GenerationRequest, slot: int):
+        """Admits a request, failing only that request if its prefill fails."""
+        try:
+            self._admit(request, slot)
+        except Exception as e:
+            logging.exception("Prefill failed")
+            self.requests[slot] = None
+            self.mask[slot] = 0
+            end_stream(request)
+            request.future.set_exception(e)
+
+    def _retire_if_done(self, slot: int, force: bool = False):
+        request = self.requests[slot]
+        generated = self.generated[slot]
+        done = (
+            force
+            or generated[-1] == self.tokenizer.eos_token_id
+            or len(generated) >= request.max_new_tokens
+        )
+        if not done:
+            return
+
+        generated_ids = torch.tensor(generated, device=self.device)
+        if request.response_format is None:
+            generated_ids = torch.cat([self.prompt_ids[slot], generated_ids])
+        # A JSON completion is returned on its own so it parses as is
+        text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+        end_stream(request)
+        request.future.set_result((text, len(generated)))
+        self.requests[slot] = None
+        self.prompt_ids[slot] = None
+        self.generated[slot] = None
+        self.constraints[slot] = None
+        self.mask[slot] = 0
+
+    def _step(self):
+        """One decoding step: feeds the last token of every slot, writes column t."""
+        active = self._active()
+
+        if self.t + 1 > self.max_seq_len:
+            oldest = min(self.starts[slot] for slot in active)
+            if oldest == 0:
+                # The oldest sequence fills the whole cache, it ends here
+                for slot in active:
+                    if self.starts[slot] == 0:
+                        self._retire_if_done(slot, force=True)
+                return
+            self._shift(-oldest)
+
+        last_tokens = torch.full((self.max_slots, 1), self.tokenizer.pad_token_id, device=self.device)
+        positions = torch.zeros((self.max_slots, 1), dtype=torch.long, device=self.device)
+        for slot in active:
+            last_tokens[slot, 0] = self.generated[slot][-1]
+            positions[slot, 0] = len(self.prompt_ids[slot]) + len(self.generated[slot]) - 1
+
+        # Every row attends to the new column, empty slots then have one valid position and no NaNs
+        self.mask[:, self.t] = 1
+        # The model writes column t of every layer in place
+        past = SlotCache(self.keys, self.values, self.t)
+        with torch.inference_mode():
+            output = self.model(
+                input_ids=last_tokens,
+                attention_mask=self.mask[:, : self.t + 1],
+                position_ids=positions,
+                past_key_values=past,
+                use_cache=True,
+            )
+        self.t += 1
+
+        next_tokens = output.logits[:, -1].argmax(dim=-1).tolist()
+        for slot in range(self.max_slots):
+            if slot in active:
+                if self.constraints[slot] is not None or self.requests[slot].temperature > 0:
+                    next_tokens[slot] = self._pick(slot, output.logits[slot, -1])
+                self.generated[slot].append(next_tokens[slot])
+                if self.requests[slot].streamer is not None:
+                    self.requests[slot].streamer.put(torch.tensor(next_tokens[slot : slot + 1]))
+                self._retire_if_done(slot)
+            else:
+                self.mask[slot] = 0
+
+    def _run(self):
+        while True:
+            try:
+                if not self._active():
+                    # Nothing to decode: sleep on the queue, then start the cache over
+                    request = self._queue.get()
+                    self.t = 0
+                    self._try_admit(request, 0)
+
+                for slot in range(self.max_slots):
+                    if self.requests[slot] is None:
+                        try:
+                            self._try_admit(self._queue.get_nowait(), slot)
+                        except queue.Empty:
+                            break
+
+                if self._active():
+                    self._step()
+            except Exception as e:
+                logging.exception("Continuous batching step failed")
+                for slot in self._active():
+                    end_stream(self.requests[slot])
+                    self.requests[slot].future.set_exception(e)
+                    self.requests[slot] = None
+                    self.constraints[slot] = None
+                self.mask.zero_()
@@ -0,0 +1,92 @@
+"""
+CPU serving backend: the model's Linear layers dynamically quantized to int8, the rest in fp32.
+
+BACKEND=cpu makes LLMBaseModel load the model here instead of with DeepSpeed on GPUs, for cheap
+replicas serving the short explanation requests. The quantization is prune_model.py's, a
+torch.quantization.quantize_dynamic of every nn.Linear to qint8. It is applied when loading,
+to the same safetensors checkpoint the GPU replicas load: quantize_dynamic models can't be
+reloaded with from_pretrained. Decoder layers are converted one at a time, so the peak memory
+is the fp16 checkpoint plus a single layer in fp32 rather than the whole model in fp32.
+
+Matrix multiplies scale with the intra-op threads, which default to the physical cores available
+to the container. Hyperthreads and inter-op parallelism only add contention for one generate at a
+time, so a single inter-op thread is the default.
+"""
+import logging
+import os
+
+import torch
+from transformers import AutoModelForCausalLM
+
+# "int8": dynamically quantized Linear layers, "none": everything in fp32
+CPU_QUANTIZE = os.environ.get("CPU_QUANTIZE", "int8")
+# 0 uses the physical cores of the CPUs this process may run on
+CPU_INTRA_OP_THREADS = int(os.environ.get("CPU_INTRA_OP_THREADS", 0))
+CPU_INTER_OP_THREADS = int(os.environ.get("CPU_INTER_OP_THREADS", 1))
+
+
+def physical_cores() -> int:
+    """Cores of the CPUs this process may run on, without their hyperthread siblings."""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    try:
+        with open("/sys/devices/system/cpu/cpu0/topology/thread_siblings_list") as file:
+            # e.g. "0,64" or "0-1"
+            siblings = sum(
+                int(part.split("-")[1]) - int(part.split("-")[0]) + 1 if "-" in part else 1
+                for part in file.read().strip().split(",")
+            )
+    except (OSError, ValueError):
+        siblings = 1
+    return max(1, cpus // max(1, siblings))
+
+
+def configure_threads(intra_op: int = CPU_INTRA_OP_THREADS, inter_op: int = CPU_INTER_OP_THREADS) -> None:
+    """Sets torch's thread pools, before the first parallel operation of the process."""
+    intra_op = intra_op or physical_cores()
+    torch.set_num_threads(intra_op)
+    try:
+        torch.set_num_interop_threads(inter_op)
+    except RuntimeError:
+        # The inter-op pool can only be sized before it is first used
+        logging.warning(f"Inter-op threads already set to {torch.get_num_interop_threads()}")
+    logging.info(f"CPU threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def quantize_dynamic_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Quantizes every nn.Linear of a fp16 or fp32 model to int8 in place, decoder layer by decoder
+    layer, and casts the remaining weights (embeddings, norms) to fp32.
+    """
+    for layer in getattr(model.base_model, "layers", []):
+        layer.float()
+        torch.quantization.quantize_dynamic(layer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    # What is left: the embeddings, the final norm and the LM head. Quantized layers hold no
+    # floating point parameters, float() leaves them alone
+    model.float()
+    torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def load_cpu_model(model_dir: str, quantize: str = CPU_QUANTIZE) -> torch.nn.Module:
+    """
+    Loads a model for CPU inference.
+
+    Args:
+        model_dir (str): the local model folder, see weights.py
+        quantize (str): "int8" or "none", see CPU_QUANTIZE
+
+    Returns:
+        torch.nn.Module: the model in eval mode
+    """
+    if quantize not in ("int8", "none"):
+        raise ValueError(f"Unknown CPU_QUANTIZE [{quantize}], expected int8 or none")
+    configure_threads()
+    # Quantized layers are converted from the checkpoint's fp16 one at a time, see quantize_dynamic_int8
+    model = AutoModelForCausalLM.from_pretrained(
+        model_dir,
+        torch_dtype=torch.float16 if quantize == "int8" else torch.float32,
+        low_cpu_mem_usage=True,
+    )
+    if quantize == "int8":
+        quantize_dynamic_int8(model)
+    return model.eval()
@@ -0,0 +1,105 @@
+"""
+Load test for the /predict server with mixed MCQ / explanation traffic.
+
+MCQ requests ask for long completions, explanation requests for short ones, which is the mix where
+continuous batching should beat dynamic batching. Run it once against each BATCHING_MODE:
+
+    BATCHING_MODE=dynamic python3 main.py      # then
+    python3 load_test.py --url http://localhost:8080/predict --requests 200 --concurrency 16
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DOCUMENT = (
+    "The mitochondrion is the site of aerobic respiration in eukaryotic cells. Glycolysis happens "
+    "in the cytoplasm, the Krebs cycle in the mitochondrial matrix and oxidative phosphorylation "
+    "across the inner membrane, where ATP synthase uses the proton gradient to make ATP. "
+)
+
+# Both kinds send the document as the context, like the clients do, so its KV cache is shared
+KINDS = {
+    "mcq": {
+        "context": DOCUMENT,
+        "prompt": "Generate 5 MCQs to help me study from this document exclusively.",
+        "max_new_tokens": 256,
+    },
+    "explanation": {
+        "context": DOCUMENT,
+        "prompt": "Explain why the answer 'ATP synthase' to the question 'What makes ATP?' is correct.",
+        "max_new_tokens": 48,
+    },
+}
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def send(url, kind, timeout):
+    """
+    Sends one single-instance prediction request.
+
+    Returns:
+        tuple[str, float, int]: (kind, latency in seconds, generated tokens), tokens is -1 on error
+    """
+    body = json.dumps({"instances": [KINDS[kind]]}).encode()
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            prediction = json.load(response)["predictions"][0]
+        tokens = prediction.get("generated_tokens", 0)
+    except Exception as e:
+        print(f"Request failed: {e}")
+        tokens = -1
+    return kind, time.perf_counter() - started, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the /predict server.")
+    parser.add_argument("--url", default="http://localhost:8080/predict")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--explanation-share", type=float, default=0.7, help="fraction of short explanation requests")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    kinds = ["explanation" if random.random() < args.explanation_share else "mcq" for _ in range(args.requests)]
+
+    results = []
+    lock = threading.Lock()
+
+    def run(kind):
+        result = send(args.url, kind, args.timeout)
+        with lock:
+            results.append(result)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(run, kinds))
+    elapsed = time.perf_counter() - started
+
+    ok = [result for result in results if result[2] >= 0]
+    tokens = sum(result[2] for result in ok)
+    print(f"{len(ok)}/{len(results)} requests succeeded in {elapsed:.1f}s")
+    print(f"throughput: {len(ok) / elapsed:.2f} req/s, {tokens / elapsed:.1f} generated tokens/s")
+    for kind in ["all"] + list(KINDS):
+        latencies = [latency for name, latency, _ in ok if kind in ("all", name)]
+        if latencies:
+            print(
+                f"{kind:>12}: n={len(latencies):<4} p50={percentile(latencies, 0.5):.2f}s "
+                f"p90={percentile(latencies, 0.9):.2f}s p99={percentile(latencies, 0.99):.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
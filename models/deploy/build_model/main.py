@@ -1,12 +1,22 @@
-from flask import Flask, request, Response
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from flask import Flask, request, Response, stream_with_context
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList, TextIteratorStreamer
 import deepspeed
 import os
+import json
 import logging
-from typing import Mapping, Any
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
 import torch
 from google.cloud import storage
 
+from batching import DynamicBatcher
+from cpu_backend import load_cpu_model
+from continuous import ContinuousBatcher
+from prefix_cache import PrefixCache, encode, encode_context, encode_suffix, to_cache
+from structured import JsonConstraint, StructuredLogitsProcessor, parse_response_format
+from weights import MODEL_CACHE_DIR, download_model, log_timings, phase
+
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
@@ -15,7 +25,32 @@ app = Flask(__name__)
 BUCKET_NAME = 'hugging-face-models'
 MODEL_DIR = 'hugging-face-models/llama-7b-pruned'  
 
-llama_model = os.path.join("/tmp", MODEL_DIR)
+# MODEL_CACHE_DIR on a persistent disk keeps the weights across restarts, see weights.py
+llama_model = os.path.join(MODEL_CACHE_DIR, MODEL_DIR)
+
+# "gpu": fp16 with DeepSpeed on every GPU, "cpu": int8 dynamically quantized (see cpu_backend.py)
+BACKEND = os.environ.get("BACKEND", "gpu")
+# "dynamic": one generate per batch of queued requests, "continuous": sequences join and leave
+# the batch at every decoding step
+BATCHING_MODE = os.environ.get("BATCHING_MODE", "dynamic")
+# Seconds a /predict_stream reader waits for the next token before giving up
+STREAM_TIMEOUT = float(os.environ.get("STREAM_TIMEOUT", 120))
+# Batch sizes run before /health reports ready, "" skips the warm-up
+WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", "1,4,8").split(",") if size.strip()]
+WARMUP_NEW_TOKENS = int(os.environ.get("WARMUP_NEW_TOKENS", 16))
+# Temperature of the instances that ask for do_sample without giving one
+DEFAULT_TEMPERATURE = float(os.environ.get("DEFAULT_TEMPERATURE", 1.0))
+
+# Representative of the clients' requests: a document as the context, question and explanation prompts
+WARMUP_DOCUMENT = (
+    "The mitochondrion is the site of aerobic respiration in eukaryotic cells. Glycolysis happens "
+    "in the cytoplasm, the Krebs cycle in the mitochondrial matrix and oxidative phosphorylation "
+    "across the inner membrane, where ATP synthase uses the proton gradient to make ATP. "
+) * 4
+WARMUP_PROMPTS = [
+    "Generate 10 MCQs to help me study from this document exclusively, and each time tell me what you think the level of difficulty is: Easy, Medium, Hard.",
+    "Explain why the answer 'ATP synthase' to the question 'What makes ATP?' is correct, based on the text above.",
+]
 
 
 class LLMBaseModel:
@@ -24,8 +59,10 @@ class LLMBaseModel:
 
     Attributes:
         model_name (str): Name or path of the model.
-        top_p (float): Nucleus sampling parameter.
-        top_k (int): Top K sampling parameter.
+        do_sample (bool): Whether the instances that don't say how to decode are sampled, decoding
+            is greedy by default.
+        top_p (float): Nucleus sampling parameter, when sampling.
+        top_k (int): Top K sampling parameter, when sampling.
         world_size (int): Number of available GPUs.
         num_tokens (int): Maximum number of tokens for the generated output.
         tokenizer: Tokenizer associated with the model.
@@ -38,6 +75,7 @@ class LLMBaseModel:
         top_p: float = 0.92,
         top_k: int = 50,
         model_name: str = llama_model,
+        do_sample: bool = False,
     ):
         
         """
@@ -45,101 +83,382 @@ class LLMBaseModel:
 
         Args:
             num_tokens (int): Maximum number of tokens for the generated output.
-            top_p (float): Nucleus sampling parameter.
-            top_k (int): Top K sampling parameter.
+            top_p (float): Nucleus sampling parameter, when sampling.
+            top_k (int): Top K sampling parameter, when sampling.
             model_name (str): Name or path of the model.
+            do_sample (bool): Whether to sample the instances that don't ask for a temperature
+                or do_sample of their own, instead of decoding them greedily.
         """
 
-        self.download_model_from_gcs()
+        with phase("download"):
+            self.download_model_from_gcs()
         self.model_name = model_name
         self.top_p = top_p
         self.top_k = top_k
+        self.do_sample = do_sample
         self.world_size = torch.cuda.device_count()
         self.num_tokens = num_tokens
         logging.info(f"Using {self.world_size} gpus")
         
         # Initialize the tokenizer
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        with phase("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
 
         try:
-            logging.info(f"Loading model: {self.model_name}")
+            logging.info(f"Loading model: {self.model_name} on {BACKEND}")
+
+            if BACKEND == "cpu":
+                # int8 Linear layers on CPU threads, see cpu_backend.py
+                with phase("load weights"):
+                    self.model = load_cpu_model(self.model_name)
+            else:
+                self._load_on_gpus()
+            logging.info("model_loaded!")
+
+        except Exception:
+            raise ValueError(f"Failed to load the model from: {self.model_name}")
+
+        # Batched prompts are left-padded, so every row's new tokens start at the same position
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # KV caches of the documents the prompts are about, shared by every request
+        self.prefix_cache = PrefixCache(self.model.device)
 
-            # Construct model with fake meta tensors
-            with deepspeed.OnDevice(dtype=torch.float16, device="meta"):
-                self.model = AutoModelForCausalLM.from_pretrained(self.model_name)
+        if BATCHING_MODE == "continuous":
+            self.batcher = ContinuousBatcher(
+                self.model, self.tokenizer, prefix_cache=self.prefix_cache, top_k=self.top_k, top_p=self.top_p
+            )
+        else:
+            self.batcher = DynamicBatcher(self.generate_batch)
+        logging.info(f"Batching mode: {BATCHING_MODE}")
+
+    def _load_on_gpus(self) -> None:
+        """Loads the model in fp16, split over every GPU by DeepSpeed."""
+        # The safetensors shards are memory-mapped and copied once into fp16 parameters,
+        # without a randomly initialized model first
+        with phase("load weights"):
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.model_name, torch_dtype=torch.float16, low_cpu_mem_usage=True
+            )
 
-            # Since we already downloaded the model, no need for snapshot_download
+        # Since we already downloaded the model, no need for snapshot_download
 
-            # Initialize with DeepSpeed for inference
+        # Initialize with DeepSpeed for inference
+        with phase("deepspeed init"):
             self.model = deepspeed.init_inference(
                 self.model,
                 mp_size=self.world_size,
                 dtype=torch.float16
             )
             self.model = self.model.module
-            logging.info("model_loaded!")
 
-        except Exception:
-            raise ValueError(f"Failed to load the model from: {self.model_name}")
+    def warm_up(self, batch_sizes: List[int]) -> None:
+        """
+        Runs representative prompts through the batcher at each batch size, so that kernel
+        selection, allocator growth, the first prefill of a context and the structured output
+        vocabulary scan happen before the first request rather than during it.
+
+        Args:
+            batch_sizes (List[int]): How many prompts are submitted together, one round each.
+        """
+        for batch_size in batch_sizes:
+            started = time.perf_counter()
+            prompts = (WARMUP_PROMPTS * batch_size)[:batch_size]
+            futures = [
+                self.batcher.submit(
+                    prompt, self.count_tokens(prompt, WARMUP_DOCUMENT), WARMUP_NEW_TOKENS, context=WARMUP_DOCUMENT
+                )
+                for prompt in prompts
+            ]
+            for future in futures:
+                future.result()
+            logging.info(f"Warm-up at batch size {batch_size} took {time.perf_counter() - started:.1f}s")
+
+        if batch_sizes:
+            prompt = WARMUP_PROMPTS[0]
+            self.batcher.submit(
+                prompt,
+                self.count_tokens(prompt, WARMUP_DOCUMENT),
+                WARMUP_NEW_TOKENS,
+                context=WARMUP_DOCUMENT,
+                response_format=parse_response_format({"type": "mcq", "count": 1}),
+            ).result()
 
     def download_model_from_gcs(self):
         """
-        Downloads the model and its configuration from Google Cloud Storage.
+        Downloads the model, its configuration and tokenizer from Google Cloud Storage into the
+        local cache, in parallel ranges, skipping the files already there (see weights.py).
         """
 
         client = storage.Client()
         bucket = client.bucket(BUCKET_NAME)
-        
-        model_files = ['pytorch_model.bin', 'config.json']  # Add other required files if needed
-        
-        for file_name in model_files:
-            blob = bucket.blob(os.path.join(MODEL_DIR, file_name))
-            blob.download_to_filename(os.path.join(llama_model, file_name))
+
+        download_model(bucket, MODEL_DIR, llama_model)
         logging.info("Model downloaded from GCS!")
 
-    def generator(self, form: Mapping[str, Any]) -> str:
+    def generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: List[int],
+        streamer: TextIteratorStreamer = None,
+        context: str = None,
+        response_formats: List[Optional[Mapping[str, Any]]] = None,
+        temperature: float = 0.0,
+    ) -> List[Tuple[str, int]]:
+        """
+        Runs a single generate over several prompts, left-padded into one tensor batch.
+
+        Args:
+            prompts (List[str]): The prompts of the batch.
+            max_new_tokens (List[int]): How many tokens to generate for each prompt.
+            streamer (TextIteratorStreamer): Receives the tokens as they are generated, batches
+                with a streamer hold a single prompt.
+            context (str): The document every prompt of the batch follows. Its KV cache comes
+                from the prefix cache and only the prompts are prefilled, padded after the context.
+            response_formats (List[Optional[Mapping[str, Any]]]): Per prompt, the JSON schema its
+                completion is constrained to (see structured.py), None for free text.
+            temperature (float): Sampling temperature of the whole batch, 0 decodes greedily.
 
+        Returns:
+            List[Tuple[str, int]]: The decoded prompt and completion of each row, in order, with
+                the number of tokens generated for it. Constrained rows hold only the completion.
         """
-        Generate text based on the input form data.
+        response_formats = response_formats or [None] * len(prompts)
+        if context is None:
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.model.device)
+            past_key_values = None
+        else:
+            inputs, past_key_values = self._inputs_after_context(prompts, context)
+
+        prompt_length = inputs["input_ids"].shape[1]
+        logits_processor = LogitsProcessorList()
+        if any(response_formats):
+            constraints = [
+                JsonConstraint(self.tokenizer, response_format) if response_format else None
+                for response_format in response_formats
+            ]
+            logits_processor.append(StructuredLogitsProcessor(constraints, prompt_length))
+
+        # Set explicitly so the checkpoint's generation_config can't turn sampling on, both
+        # batching modes then give the same tokens to greedy requests
+        if temperature > 0:
+            sampling = dict(do_sample=True, temperature=temperature, top_k=self.top_k, top_p=self.top_p)
+        else:
+            sampling = dict(do_sample=False)
+        with torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                past_key_values=past_key_values,
+                logits_processor=logits_processor,
+                max_new_tokens=max(max_new_tokens),
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=streamer,
+                **sampling,
+            )
+
+        # Rows that wanted fewer tokens than the longest request are cut back to their own limit
+        results = []
+        for output, limit, response_format in zip(outputs, max_new_tokens, response_formats):
+            output = output[: prompt_length + limit]
+            generated = int((output[prompt_length:] != self.tokenizer.pad_token_id).sum())
+            if response_format:
+                # A JSON completion is returned on its own so it parses as is
+                output = output[prompt_length:]
+            results.append((self.tokenizer.decode(output, skip_special_tokens=True), generated))
+        return results
+
+    def _inputs_after_context(self, prompts: List[str], context: str):
+        """
+        Builds [context | padding | prompt] rows over the cached KV of the context, the attention
+        mask hides the padding.
+
+        Returns:
+            Tuple[Dict[str, torch.Tensor], Any]: the generate inputs, and the context's cache
+                expanded to the batch
+        """
+        context_ids = encode_context(self.tokenizer, context)
+        prefix = self.prefix_cache.get_or_prefill(self.model, context_ids, context)
+        suffixes = [encode_suffix(self.tokenizer, prompt) for prompt in prompts]
+
+        rows, width = len(prompts), max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((rows, len(context_ids) + width), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, : len(context_ids)] = context_ids
+        attention_mask[:, : len(context_ids)] = 1
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, input_ids.shape[1] - len(suffix) :] = suffix
+            attention_mask[row, input_ids.shape[1] - len(suffix) :] = 1
+
+        # generate appends to the cache it is given, expand() views keep the shared entry intact
+        past_key_values = to_cache(
+            [(key.expand(rows, -1, -1, -1), value.expand(rows, -1, -1, -1)) for key, value in prefix]
+        )
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        return {name: tensor.to(self.model.device) for name, tensor in inputs.items()}, past_key_values
+
+    def generator(self, form: Mapping[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+
+        """
+        Generate text for every instance of the request. Instances are queued on the batcher
+        and may share a generate call with instances of other requests.
 
         Args:
-            form (Mapping[str, Any]): Contains input data for text generation.
+            form (Mapping[str, Any]): Contains input data for text generation, the Vertex
+                {"instances": [{"prompt": ..., "context": ...}, ...], "parameters": {...}} body.
+                The optional context is the document the prompt is about, the model reads
+                context + "\n" + prompt and the context's KV cache is reused across requests.
+                The optional response_format {"type": "mcq" | "short_answer", "count": N}
+                constrains the response to a JSON array of N questions (see structured.py).
+                The optional temperature or do_sample choose how it is decoded, see temperature.
 
         Returns:
-            str: Generated text response.
+            Dict[str, List[Dict[str, Any]]]: {"predictions": [{"response": ..., "generated_tokens": ...}, ...]},
+                one per instance.
         """
 
         logging.info(f'this is the form: {form}')
-        prompt = form["instances"][0]["prompt"]
-        input_tokens = self.tokenizer.encode_plus(prompt, return_tensors="pt", padding=True)
-        response = self.model.generate(**input_tokens, max_length=self.num_tokens, top_k=self.top_k, top_p=self.top_p)
-        response = self.tokenizer.decode(response[0], skip_special_tokens=True)
-        return {"response": response}
+        parameters = form.get("parameters") or {}
+        futures = []
+        for instance in form["instances"]:
+            prompt, context = instance["prompt"], instance.get("context")
+            futures.append(
+                self.batcher.submit(
+                    prompt,
+                    self.count_tokens(prompt, context),
+                    self.max_new_tokens(instance, parameters),
+                    context=context,
+                    response_format=parse_response_format(instance.get("response_format")),
+                    temperature=self.temperature(instance, parameters),
+                )
+            )
+
+        predictions = []
+        for future in futures:
+            response, generated_tokens = future.result()
+            predictions.append({"response": response, "generated_tokens": generated_tokens})
+        return {"predictions": predictions}
+
+    def count_tokens(self, prompt: str, context: str = None) -> int:
+        context_ids, prompt_ids = encode(self.tokenizer, prompt, context)
+        return len(prompt_ids) + (len(context_ids) if context_ids is not None else 0)
+
+    def max_new_tokens(self, instance: Mapping[str, Any], parameters: Mapping[str, Any]) -> int:
+        """The instance's max_new_tokens, else the request parameters', else num_tokens."""
+        return int(instance.get("max_new_tokens", parameters.get("max_new_tokens", self.num_tokens)))
+
+    def temperature(self, instance: Mapping[str, Any], parameters: Mapping[str, Any]) -> float:
+        """
+        The sampling temperature of an instance, 0 for greedy decoding. Its own temperature or
+        do_sample win over the request parameters', which win over the server's do_sample.
+        do_sample true without a temperature samples at DEFAULT_TEMPERATURE.
+        """
+        for fields in (instance, parameters):
+            if fields.get("temperature") is not None:
+                return max(0.0, float(fields["temperature"]))
+            if fields.get("do_sample") is not None:
+                return DEFAULT_TEMPERATURE if fields["do_sample"] else 0.0
+        return DEFAULT_TEMPERATURE if self.do_sample else 0.0
+
+    def stream(self, form: Mapping[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Generate text for the first instance of the request, yielding it as it is generated.
+
+        Args:
+            form (Mapping[str, Any]): The same body as /predict, only instances[0] is used.
+
+        Yields:
+            Dict[str, Any]: {"token": text} for each decoded piece, then
+                {"done": True, "generated_tokens": ...}
+        """
+        instance = form["instances"][0]
+        parameters = form.get("parameters") or {}
+        prompt, context = instance["prompt"], instance.get("context")
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT
+        )
+        future = self.batcher.submit(
+            prompt,
+            self.count_tokens(prompt, context),
+            self.max_new_tokens(instance, parameters),
+            streamer=streamer,
+            context=context,
+            response_format=parse_response_format(instance.get("response_format")),
+            temperature=self.temperature(instance, parameters),
+        )
+
+        for text in streamer:
+            if text:
+                yield {"token": text}
+
+        # Raises if generation failed, the streamer was only ended early
+        _, generated_tokens = future.result()
+        yield {"done": True, "generated_tokens": generated_tokens}
 
-writer = LLMBaseModel()
+# Loading takes minutes, it runs on its own thread so /isalive and /health answer meanwhile.
+# writer is set once the model is loaded and warmed up, load_error if that failed.
+writer = None
+load_error = None
+ready = threading.Event()
+
+
+def load_model():
+    global writer, load_error
+    try:
+        model = LLMBaseModel()
+        with phase("warm-up"):
+            model.warm_up(WARMUP_BATCH_SIZES)
+        log_timings()
+        writer = model
+        ready.set()
+    except Exception as e:
+        logging.exception("Model failed to load")
+        load_error = str(e)
+
+
+threading.Thread(target=load_model, name="model-loader", daemon=True).start()
 
 @app.route("/isalive")
 def isalive():
     
     """
-    Endpoint to check if the service is alive.
+    Liveness: the process is up. Fails only if loading the model failed, so the container is
+    restarted rather than left unready forever.
 
     Returns:
         Response: HTTP response with status code.
     """
 
     print("/isalive request")
-    status_code = Response(status=200)
+    status_code = Response(status=500 if load_error is not None else 200)
     return status_code
 
+@app.route("/health")
+def health():
+    """
+    Readiness: 200 once the model is loaded and warmed up, 503 before, so no traffic is routed to
+    a replica that is still loading.
+
+    Returns:
+        Tuple[dict, int]: {"status": "ready" | "loading" | "failed"} and the status code.
+    """
+    if ready.is_set():
+        return {"status": "ready"}, 200
+    if load_error is not None:
+        return {"status": "failed", "error": load_error}, 503
+    return {"status": "loading"}, 503
+
 @app.route('/predict', methods = ['POST'])
 def predict():
     """
     Endpoint to generate text based on input.
 
     Returns:
-        Union[dict, Tuple[dict, int]]: Generated text or error message.
+        Union[dict, Tuple[dict, int]]: Generated text or error message, 503 until the model is ready.
     """
+    if not ready.is_set():
+        return {"error": "The model is still loading"}, 503
     try:
         form = request.get_json()
         return writer.generator(form)
@@ -147,6 +466,32 @@ def predict():
         logging.error(f"Error generating response: {e}")
         return {"error": str(e)}, 500
 
+@app.route('/predict_stream', methods = ['POST'])
+def predict_stream():
+    """
+    Endpoint streaming the generated text as server-sent events, one "data: {json}" event per
+    decoded piece so clients can render the first question before the last one is generated.
+
+    Returns:
+        Response: text/event-stream of {"token": ...} events, ending with {"done": true, ...}
+            or {"error": ...}. 503 until the model is ready.
+    """
+    if not ready.is_set():
+        return {"error": "The model is still loading"}, 503
+    form = request.get_json()
+
+    def events():
+        try:
+            for event in writer.stream(form):
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            logging.error(f"Error streaming response: {e}")
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+    # Proxies must not buffer the stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers=headers)
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8080))
     app.run(debug=True, host='0.0.0.0', port=port, use_reloader=False)
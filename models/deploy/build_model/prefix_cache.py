@@ -0,0 +1,180 @@
+"""
+KV cache reuse for shared prompt prefixes.
+
+Every question and explanation prompt about a document starts with the whole document. Clients send
+it as the instance's "context", the server prefills it once, keeps its KV cache keyed by a hash of
+the text, and later requests about the same document only prefill their own suffix.
+
+Entries live on the GPU while they fit in PREFIX_CACHE_GPU_BYTES, are moved to CPU memory when
+newer ones push them out, and are dropped past PREFIX_CACHE_CPU_BYTES, least recently used first.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import torch
+
+PREFIX_CACHE_GPU_BYTES = int(os.environ.get("PREFIX_CACHE_GPU_BYTES", 2 * 1024**3))
+PREFIX_CACHE_CPU_BYTES = int(os.environ.get("PREFIX_CACHE_CPU_BYTES", 8 * 1024**3))
+# Contexts shorter than this are prefilled every time, caching them isn't worth the memory
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", 64))
+
+
+def encode_context(tokenizer, context: str) -> torch.Tensor:
+    """The 1-D ids of a context, tokenized on its own so they are the same whatever follows."""
+    return tokenizer(context, return_tensors="pt")["input_ids"][0]
+
+
+def encode_suffix(tokenizer, prompt: str) -> torch.Tensor:
+    """The 1-D ids of what follows a context, the full text being context + "\n" + prompt."""
+    return tokenizer("\n" + prompt, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+
+
+def encode(tokenizer, prompt: str, context: Optional[str] = None) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+    """
+    Tokenizes a request: (context ids, suffix ids) with a context, (None, prompt ids) without.
+    """
+    if context is None:
+        return None, tokenizer(prompt, return_tensors="pt")["input_ids"][0]
+    return encode_context(tokenizer, context), encode_suffix(tokenizer, prompt)
+
+
+def to_pairs(past_key_values):
+    """The (key, value) tensors of each layer, whichever cache type the model returned."""
+    if hasattr(past_key_values, "layers"):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def to_cache(pairs):
+    """Wraps (key, value) tensors per layer in the cache type the model expects."""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        # Older transformers only take tuples of (key, value) per layer
+        return tuple(pairs)
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(pairs))
+    return DynamicCache(pairs)
+
+
+@dataclass
+class PrefixEntry:
+    """The KV cache of one context: (key, value) per layer, each [1, heads, tokens, head_dim]."""
+
+    input_ids: torch.Tensor
+    pairs: List[Tuple[torch.Tensor, torch.Tensor]]
+    num_bytes: int
+    on_gpu: bool = True
+
+    def to(self, device) -> None:
+        self.pairs = [(key.to(device), value.to(device)) for key, value in self.pairs]
+
+
+class PrefixCache:
+    """
+    LRU of context KV caches, bounded in bytes on the GPU and on the CPU.
+
+    Attributes:
+        device: where the model runs, entries are moved back there on a hit
+        max_gpu_bytes (int): budget of entries kept on the model's device
+        max_cpu_bytes (int): budget of entries moved to CPU memory
+    """
+
+    def __init__(
+        self,
+        device,
+        max_gpu_bytes: int = PREFIX_CACHE_GPU_BYTES,
+        max_cpu_bytes: int = PREFIX_CACHE_CPU_BYTES,
+        min_tokens: int = PREFIX_CACHE_MIN_TOKENS,
+    ):
+        self.device = device
+        self.max_gpu_bytes = max_gpu_bytes
+        self.max_cpu_bytes = max_cpu_bytes
+        self.min_tokens = min_tokens
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefilled_tokens = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def key_for(context: str) -> str:
+        return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+    def _bytes(self, on_gpu: bool) -> int:
+        return sum(entry.num_bytes for entry in self._entries.values() if entry.on_gpu == on_gpu)
+
+    def _evict(self) -> None:
+        """Moves the least recently used entries to the CPU, then drops the oldest CPU entries."""
+        for key, entry in self._entries.items():
+            if self._bytes(True) <= self.max_gpu_bytes:
+                break
+            if entry.on_gpu:
+                entry.to("cpu")
+                entry.on_gpu = False
+
+        while self._entries and self._bytes(False) > self.max_cpu_bytes:
+            oldest = next(key for key, entry in self._entries.items() if not entry.on_gpu)
+            del self._entries[oldest]
+
+    def get_or_prefill(self, model, context_ids: torch.Tensor, context: str) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns the KV cache of the context, prefilling it with the model on a miss.
+
+        Args:
+            model: the causal LM
+            context_ids (torch.Tensor): 1-D ids of the context, see encode
+            context (str): the context text, hashed into the key
+
+        Returns:
+            List[Tuple[torch.Tensor, torch.Tensor]]: (key, value) per layer on the model's device.
+            The tensors are shared, callers must not write into them.
+        """
+        key = self.key_for(context)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if not entry.on_gpu:
+                    entry.to(self.device)
+                    entry.on_gpu = True
+                # Keep hold of the device tensors, eviction may move the entry itself back out
+                pairs = entry.pairs
+                self._evict()
+                self.hits += 1
+                self.reused_tokens += len(context_ids)
+                return pairs
+
+        with torch.inference_mode():
+            output = model(input_ids=context_ids.unsqueeze(0).to(self.device), use_cache=True)
+        pairs = list(to_pairs(output.past_key_values))
+
+        with self._lock:
+            self.misses += 1
+            self.prefilled_tokens += len(context_ids)
+            if len(context_ids) >= self.min_tokens:
+                num_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in pairs)
+                self._entries[key] = PrefixEntry(context_ids, pairs, num_bytes)
+                self._evict()
+        return pairs
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "gpu_bytes": self._bytes(True),
+                "cpu_bytes": self._bytes(False),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "prefilled_tokens": self.prefilled_tokens,
+                "reused_tokens": self.reused_tokens,
+            }
@@ -0,0 +1,335 @@
+"""
+Schema-constrained JSON generation.
+
+An instance with "response_format": {"type": "mcq" | "short_answer", "count": N} is decoded under a
+grammar: at every step only the tokens that keep the text a valid prefix of a JSON array of N
+items of that schema can be picked, and the end of sequence only once the array is closed. The
+client then parses the response with json.loads instead of regexes, and no question is ever
+dropped because the model drifted from the expected layout.
+
+    mcq           {"question": str, "options": [str, str, str, str], "answer": "a".."d",
+                   "difficulty": "Easy" | "Medium" | "Hard"}
+    short_answer  {"question": str, "difficulty": "Easy" | "Medium" | "Hard"}
+
+The keys come in this order with this spacing, whitespace is only free between items, so the
+model spends its tokens on the content. Only the highest scoring candidates are checked against
+the grammar at each step, the rest of the vocabulary only when none of them fits.
+"""
+import os
+import re
+from typing import Any, List, Mapping, Optional
+
+import torch
+from transformers import LogitsProcessor
+
+# Candidates checked against the grammar per step, in score order, before scanning the vocabulary
+STRUCTURED_CANDIDATES = int(os.environ.get("STRUCTURED_CANDIDATES", 64))
+# Longest string value, past it the string can only be closed
+STRUCTURED_MAX_STRING_CHARS = int(os.environ.get("STRUCTURED_MAX_STRING_CHARS", 400))
+# Most whitespace characters between two items
+MAX_WHITESPACE = 4
+
+WHITESPACE = " \n\r\t"
+ESCAPABLE = '"\\/bfnrt'
+HEX_DIGITS = "0123456789abcdefABCDEF"
+DIFFICULTIES = ('"Easy"', '"Medium"', '"Hard"')
+
+# Template elements: a literal, a free string value, one of a few quoted values
+LITERAL, STRING, ENUM = "literal", "string", "enum"
+
+SCHEMAS = {
+    "mcq": [
+        (LITERAL, '{"question": "'),
+        (STRING, None),
+        (LITERAL, '", "options": ["'),
+        (STRING, None),
+        (LITERAL, '", "'),
+        (STRING, None),
+        (LITERAL, '", "'),
+        (STRING, None),
+        (LITERAL, '", "'),
+        (STRING, None),
+        (LITERAL, '"], "answer": '),
+        (ENUM, ('"a"', '"b"', '"c"', '"d"')),
+        (LITERAL, ', "difficulty": '),
+        (ENUM, DIFFICULTIES),
+        (LITERAL, "}"),
+    ],
+    "short_answer": [
+        (LITERAL, '{"question": "'),
+        (STRING, None),
+        (LITERAL, '", "difficulty": '),
+        (ENUM, DIFFICULTIES),
+        (LITERAL, "}"),
+    ],
+}
+
+# Where the automaton is: before "[", before an item, inside one, after one, after "]"
+START, BEFORE_ITEM, ITEM, AFTER_ITEM, DONE = range(5)
+
+
+def parse_response_format(response_format: Any) -> Optional[Mapping[str, Any]]:
+    """
+    Validates an instance's response_format.
+
+    Returns:
+        Optional[Mapping[str, Any]]: {"type": ..., "count": int or None}, None without a format
+
+    Raises:
+        ValueError: for an unknown type or a count that isn't a positive integer
+    """
+    if not response_format:
+        return None
+    schema = response_format.get("type")
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown response_format type [{schema}], expected one of {sorted(SCHEMAS)}")
+    count = response_format.get("count")
+    if count is not None and (not isinstance(count, int) or count < 1):
+        raise ValueError(f"response_format count must be a positive integer, got [{count}]")
+    return {"type": schema, "count": count}
+
+
+class JsonState:
+    """
+    Character-level automaton accepting the prefixes of a JSON array of schema items.
+    Cheap to copy, so every candidate token is fed to its own copy.
+    """
+
+    __slots__ = ("template", "count", "phase", "items", "element", "offset", "prefix", "escape", "whitespace")
+
+    def __init__(self, template, count=None):
+        self.template = template
+        self.count = count
+        self.phase = START
+        self.items = 0
+        # Position in the item template, characters of the current literal or string matched so
+        # far, and the text of the current enum value
+        self.element = 0
+        self.offset = 0
+        self.prefix = ""
+        # Inside a string: 0, 1 after a backslash, else hex digits left of a \u escape plus one
+        self.escape = 0
+        self.whitespace = 0
+
+    def copy(self) -> "JsonState":
+        state = JsonState.__new__(JsonState)
+        for name in JsonState.__slots__:
+            setattr(state, name, getattr(self, name))
+        return state
+
+    @property
+    def done(self) -> bool:
+        return self.phase == DONE
+
+    def feed(self, text: str) -> bool:
+        """Feeds characters, False as soon as one of them can't continue a valid document."""
+        for char in text:
+            if not self._feed(char):
+                return False
+        return True
+
+    def _next_element(self, offset=0):
+        self.element += 1
+        self.offset = offset
+        if self.element == len(self.template):
+            self.items += 1
+            self.phase = AFTER_ITEM
+            self.whitespace = 0
+        elif self.template[self.element][0] == LITERAL and offset == len(self.template[self.element][1]):
+            self._next_element()
+
+    def _space(self, char) -> bool:
+        if char in WHITESPACE and self.whitespace < MAX_WHITESPACE:
+            self.whitespace += 1
+            return True
+        return False
+
+    def _feed(self, char) -> bool:
+        if self.phase == START:
+            if char == "[":
+                self.phase = BEFORE_ITEM
+                self.whitespace = 0
+                return True
+            return self._space(char)
+
+        if self.phase == BEFORE_ITEM:
+            if char != "{":
+                return self._space(char)
+            self.phase, self.element, self.offset = ITEM, 0, 0
+
+        if self.phase == ITEM:
+            return self._feed_item(char)
+
+        if self.phase == AFTER_ITEM:
+            if char == "," and (self.count is None or self.items < self.count):
+                self.phase = BEFORE_ITEM
+                self.whitespace = 0
+                return True
+            if char == "]" and (self.count is None or self.items == self.count):
+                self.phase = DONE
+                return True
+            return self._space(char)
+
+        # Nothing may follow the closing bracket but the end of sequence
+        return False
+
+    def _feed_item(self, char) -> bool:
+        kind, value = self.template[self.element]
+
+        if kind == LITERAL:
+            if char != value[self.offset]:
+                return False
+            self.offset += 1
+            if self.offset == len(value):
+                self._next_element()
+            return True
+
+        if kind == ENUM:
+            prefix = self.prefix + char
+            if not any(option.startswith(prefix) for option in value):
+                return False
+            if prefix in value:
+                self.prefix = ""
+                self._next_element()
+            else:
+                self.prefix = prefix
+            return True
+
+        return self._feed_string(char)
+
+    def _feed_string(self, char) -> bool:
+        if self.escape == 1:
+            if char == "u":
+                self.escape = 5
+            elif char in ESCAPABLE:
+                self.escape = 0
+            else:
+                return False
+            return True
+        if self.escape > 1:
+            if char not in HEX_DIGITS:
+                return False
+            self.escape = self.escape - 1 if self.escape > 2 else 0
+            return True
+
+        if char == '"':
+            # Empty values are never useful, the closing quote is the next literal's first character
+            if self.offset == 0:
+                return False
+            self._next_element(offset=1)
+            return True
+        if ord(char) < 0x20 or self.offset >= STRUCTURED_MAX_STRING_CHARS:
+            return False
+        if char == "\\":
+            self.escape = 1
+        self.offset += 1
+        return True
+
+
+_token_texts = {}
+
+
+def token_texts(tokenizer) -> List[Optional[str]]:
+    """
+    The text each token id appends to a sequence, None for special tokens and partial UTF-8
+    bytes, which the grammar never allows. Computed once per tokenizer.
+    """
+    key = id(tokenizer)
+    if key not in _token_texts:
+        special = set(tokenizer.all_special_ids)
+        texts = []
+        for token_id, piece in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+            if token_id in special or piece is None:
+                texts.append(None)
+                continue
+            byte = re.fullmatch(r"<0x([0-9A-Fa-f]{2})>", piece)
+            if byte:
+                # Sentencepiece byte fallback, only ASCII bytes are whole characters
+                value = int(byte.group(1), 16)
+                texts.append(chr(value) if value < 0x80 else None)
+            elif "\u2581" in piece:
+                # Sentencepiece marks a leading space with U+2581
+                texts.append(piece.replace("\u2581", " "))
+            else:
+                text = tokenizer.convert_tokens_to_string([piece])
+                texts.append(None if "\ufffd" in text else text)
+        _token_texts[key] = texts
+    return _token_texts[key]
+
+
+class JsonConstraint:
+    """
+    The grammar state of one generated sequence, see mask and advance.
+
+    Attributes:
+        state (JsonState): the automaton after the tokens generated so far
+        texts (List[Optional[str]]): see token_texts
+        eos_token_id (int): the only token allowed once the array is closed
+    """
+
+    def __init__(self, tokenizer, response_format: Mapping[str, Any]):
+        self.state = JsonState(SCHEMAS[response_format["type"]], response_format.get("count"))
+        self.texts = token_texts(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+
+    def _fits(self, token_id: int) -> bool:
+        text = self.texts[token_id] if token_id < len(self.texts) else None
+        return bool(text) and self.state.copy().feed(text)
+
+    def mask(self, scores: torch.Tensor) -> torch.Tensor:
+        """
+        Keeps the scores of the tokens that continue a valid document, -inf elsewhere.
+
+        Args:
+            scores (torch.Tensor): [vocab] next-token scores of this sequence
+
+        Returns:
+            torch.Tensor: the masked scores
+        """
+        if self.state.done:
+            allowed = [self.eos_token_id]
+        else:
+            candidates = scores.topk(min(STRUCTURED_CANDIDATES, scores.shape[-1])).indices.tolist()
+            allowed = [token_id for token_id in candidates if self._fits(token_id)]
+            if not allowed:
+                # None of the likely tokens fits, take the best one that does
+                for token_id in scores.argsort(descending=True).tolist()[len(candidates) :]:
+                    if self._fits(token_id):
+                        allowed = [token_id]
+                        break
+
+        allowed = torch.tensor(allowed, device=scores.device)
+        masked = torch.full_like(scores, float("-inf"))
+        masked[allowed] = scores[allowed]
+        if torch.isinf(masked[allowed]).all():
+            # Sampling warpers already cut every allowed token, keep them uniformly likely
+            masked[allowed] = 0
+        return masked
+
+    def advance(self, token_id: int) -> None:
+        """Moves the automaton past a generated token. Tokens after the end are ignored."""
+        if not self.state.done:
+            self.state.feed(self.texts[token_id] or "")
+
+
+class StructuredLogitsProcessor(LogitsProcessor):
+    """
+    Applies one JsonConstraint per batch row to generate's scores, rows without one are left free.
+
+    Attributes:
+        constraints (List[Optional[JsonConstraint]]): per row
+        prompt_length (int): columns of the prompt, the tokens after it are the generated ones
+    """
+
+    def __init__(self, constraints: List[Optional[JsonConstraint]], prompt_length: int):
+        self.constraints = constraints
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row, constraint in enumerate(self.constraints):
+            if constraint is None:
+                continue
+            if input_ids.shape[1] > self.prompt_length:
+                constraint.advance(int(input_ids[row, -1]))
+            scores[row] = constraint.mask(scores[row])
+        return scores
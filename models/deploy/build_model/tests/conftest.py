@@ -0,0 +1,5 @@
+"""Makes the model server's flat modules importable, as they are when it runs from its folder."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from structured import SCHEMAS, JsonConstraint, JsonState, parse_response_format
+
+MCQ = {"question": "Where is the Calvin cycle?", "options": ["stroma", "nucleus", "wall", "membrane"], "answer": "a", "difficulty": "Hard"}
+SHORT = {"question": "Why is light needed?", "difficulty": "Easy"}
+
+
+def document(items):
+    """A JSON array written with the spacing the grammar expects."""
+    return "[" + ", ".join(json.dumps(item) for item in items) + "]"
+
+
+def accepts(schema, text, count=None):
+    state = JsonState(SCHEMAS[schema], count)
+    return state.feed(text) and state.done
+
+
+def test_parse_response_format():
+    assert parse_response_format(None) is None
+    assert parse_response_format({"type": "mcq", "count": 3}) == {"type": "mcq", "count": 3}
+    assert parse_response_format({"type": "short_answer"}) == {"type": "short_answer", "count": None}
+    with pytest.raises(ValueError):
+        parse_response_format({"type": "essay"})
+    with pytest.raises(ValueError):
+        parse_response_format({"type": "mcq", "count": 0})
+
+
+def test_accepts_arrays_of_the_schema():
+    assert accepts("mcq", document([MCQ, MCQ]))
+    assert accepts("short_answer", document([SHORT]), count=1)
+    assert accepts("short_answer", '[\n' + json.dumps(SHORT) + ',\n ' + json.dumps(SHORT) + '\n]', count=2)
+    assert accepts("short_answer", document([dict(SHORT, question='Say \\"hi\\" \\u00e9')]))
+
+
+def test_every_prefix_is_accepted_but_only_the_whole_array_is_done():
+    text = document([MCQ])
+    state = JsonState(SCHEMAS["mcq"])
+    for char in text[:-1]:
+        assert state.feed(char)
+        assert not state.done
+    assert state.feed(text[-1]) and state.done
+    # Nothing may follow the closing bracket
+    assert not state.copy().feed(" ")
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        document([dict(MCQ, answer="e")]),
+        document([dict(MCQ, difficulty="Trivial")]),
+        document([dict(MCQ, options=["a", "b", "c"])]),
+        document([dict(SHORT, question="")]),
+        '[{"difficulty": "Easy", "question": "Why?"}]',
+        '[{"question": "Bad \\x escape", "difficulty": "Easy"}]',
+        '[{"question": "Bad \\u00zz escape", "difficulty": "Easy"}]',
+        '[{"question": "Raw\nnewline", "difficulty": "Easy"}]',
+        "[" + " " * 5 + json.dumps(SHORT) + "]",
+    ],
+)
+def test_rejects_documents_off_the_schema(text):
+    schema = "mcq" if "options" in text else "short_answer"
+    assert not JsonState(SCHEMAS[schema]).feed(text)
+
+
+def test_count_fixes_the_number_of_items():
+    assert not accepts("short_answer", document([SHORT]), count=2)
+    assert not JsonState(SCHEMAS["short_answer"], 1).feed(document([SHORT, SHORT]))
+    assert accepts("short_answer", document([SHORT, SHORT]), count=2)
+
+
+def test_copies_are_independent():
+    state = JsonState(SCHEMAS["short_answer"])
+    state.feed('[{"question": "W')
+    branch = state.copy()
+    assert branch.feed('hy?", "difficulty": "Easy"}]') and branch.done
+    assert not state.done and state.feed('hat?"')
+
+
+class CharTokenizer():
+    """One token per character of a small alphabet, plus an end of sequence token."""
+
+    eos_token_id = 0
+
+    def __init__(self, alphabet):
+        self.pieces = ["</s>"] + list(alphabet)
+        self.all_special_ids = [self.eos_token_id]
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.pieces[i] for i in ids]
+
+    def convert_tokens_to_string(self, tokens):
+        return "".join(tokens)
+
+
+def test_mask_keeps_only_the_tokens_that_fit():
+    text = document([SHORT])
+    tokenizer = CharTokenizer(sorted(set(text)) + ["x"])
+    constraint = JsonConstraint(tokenizer, {"type": "short_answer", "count": 1})
+    scores = torch.ones(len(tokenizer))
+
+    # Before the array only "[" or whitespace fit, and the end of sequence never does
+    allowed = {tokenizer.pieces[i] for i in torch.isfinite(constraint.mask(scores.clone())).nonzero().flatten().tolist()}
+    assert allowed == {"[", " "}
+
+    for char in text:
+        masked = constraint.mask(scores.clone())
+        assert torch.isfinite(masked[tokenizer.pieces.index(char)])
+        constraint.advance(tokenizer.pieces.index(char))
+
+    # Once the array is closed only the end of sequence is left
+    masked = constraint.mask(scores.clone())
+    assert torch.isfinite(masked).nonzero().flatten().tolist() == [tokenizer.eos_token_id]
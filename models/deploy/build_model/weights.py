@@ -0,0 +1,239 @@
+"""
+Model weights: sharded safetensors in GCS, downloaded once into a local cache and memory-mapped.
+
+The weights are converted once, offline, from pytorch_model.bin to shards of at most
+SAFETENSORS_SHARD_SIZE bytes plus the model.safetensors.index.json transformers reads:
+
+    python3 weights.py convert /path/to/model_dir gs://hugging-face-models/hugging-face-models/llama-7b-pruned
+
+At startup download_model fetches the model's files into MODEL_CACHE_DIR, which survives restarts
+when it is on a persistent disk. A file whose recorded checksum matches the blob's is not
+downloaded again. Missing files are split in MODEL_RANGE_BYTES ranges fetched by
+MODEL_DOWNLOAD_WORKERS threads across all files; the ranges already written are recorded next to
+the partial file, so an interrupted download resumes where it stopped. from_pretrained then
+memory-maps the shards instead of reading a pickle into memory.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List
+
+import torch
+
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "/tmp")
+MODEL_DOWNLOAD_WORKERS = int(os.environ.get("MODEL_DOWNLOAD_WORKERS", 8))
+MODEL_RANGE_BYTES = int(os.environ.get("MODEL_RANGE_BYTES", 64 * 1024**2))
+SAFETENSORS_SHARD_SIZE = int(os.environ.get("SAFETENSORS_SHARD_SIZE", 2 * 1024**3))
+
+SAFETENSORS_INDEX = "model.safetensors.index.json"
+# Suffixes of the files kept next to a cached file: its checksum, and a partial download's state
+CHECKSUM_SUFFIX, PARTIAL_SUFFIX, RANGES_SUFFIX = ".md5", ".part", ".part.ranges"
+
+# Seconds spent in each cold start phase, in order
+timings: Dict[str, float] = {}
+
+
+@contextmanager
+def phase(name: str):
+    """Times a cold start phase into `timings` and logs it."""
+    started = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - started
+    logging.info(f"Cold start: {name} took {timings[name]:.1f}s")
+
+
+def log_timings():
+    logging.info(
+        "Cold start: "
+        + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in timings.items())
+        + f", {sum(timings.values()):.1f}s in total"
+    )
+
+
+def _checksum(blob) -> str:
+    """What identifies a blob's content: its MD5, or its generation for composite objects."""
+    return blob.md5_hash or f"generation-{blob.generation}-size-{blob.size}"
+
+
+def _file_md5(path: str) -> str:
+    """Base64 MD5 of a file, as GCS reports it."""
+    digest = hashlib.md5()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(16 * 1024**2), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+
+def _read(path: str) -> str:
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+class _PartialFile:
+    """
+    A file being downloaded in ranges, preallocated to its full size. Written range indices are
+    appended to a sidecar, along with the checksum of the blob they came from.
+    """
+
+    def __init__(self, path: str, blob, range_bytes: int):
+        self.path, self.blob = path, blob
+        self.ranges = [(start, min(start + range_bytes, blob.size)) for start in range(0, blob.size, range_bytes)]
+        self._lock = threading.Lock()
+
+        lines = _read(path + RANGES_SUFFIX).splitlines()
+        if lines and lines[0] == _checksum(blob) and os.path.exists(path + PARTIAL_SUFFIX):
+            self.done = {int(line) for line in lines[1:] if line.isdigit()}
+        else:
+            # Nothing written yet, or written from another version of the blob
+            self.done = set()
+            with open(path + RANGES_SUFFIX, "w") as file:
+                file.write(_checksum(blob) + "\n")
+        with open(path + PARTIAL_SUFFIX, "ab") as file:
+            file.truncate(blob.size)
+
+    def missing(self) -> List[int]:
+        return [index for index in range(len(self.ranges)) if index not in self.done]
+
+    def fetch(self, index: int):
+        """Downloads one range and records it once it is on disk."""
+        start, end = self.ranges[index]
+        # end is inclusive for GCS
+        data = self.blob.download_as_bytes(start=start, end=end - 1, checksum=None)
+        if len(data) != end - start:
+            raise IOError(f"Range {start}-{end} of {self.blob.name} came back with {len(data)} bytes")
+        fd = os.open(self.path + PARTIAL_SUFFIX, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, start)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self._lock:
+            self.done.add(index)
+            with open(self.path + RANGES_SUFFIX, "a") as file:
+                file.write(f"{index}\n")
+
+    def finish(self):
+        """Checks the assembled file against the blob's MD5 and moves it in place."""
+        if self.blob.md5_hash and _file_md5(self.path + PARTIAL_SUFFIX) != self.blob.md5_hash:
+            os.remove(self.path + RANGES_SUFFIX)
+            raise IOError(f"Checksum mismatch for {self.blob.name}, it will be downloaded again")
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+        with open(self.path + CHECKSUM_SUFFIX, "w") as file:
+            file.write(_checksum(self.blob))
+        os.remove(self.path + RANGES_SUFFIX)
+
+
+def _model_blobs(bucket, prefix: str) -> list:
+    """The model's blobs under prefix, only the safetensors shards when they exist."""
+    blobs = [blob for blob in bucket.list_blobs(prefix=prefix.rstrip("/") + "/") if not blob.name.endswith("/")]
+    if any(blob.name.endswith(SAFETENSORS_INDEX) for blob in blobs):
+        blobs = [blob for blob in blobs if not blob.name.endswith(".bin")]
+    else:
+        logging.warning(f"No {SAFETENSORS_INDEX} under {prefix}, loading the pickled weights (see weights.py convert)")
+    return blobs
+
+
+def download_model(bucket, prefix: str, local_dir: str, workers: int = MODEL_DOWNLOAD_WORKERS):
+    """
+    Makes local_dir a copy of the model files under prefix, downloading only what changed.
+
+    Args:
+        bucket (google.cloud.storage.Bucket): the bucket the model is in
+        prefix (str): the model's folder in the bucket
+        local_dir (str): the local copy, in the persistent MODEL_CACHE_DIR
+        workers (int): ranges downloaded at once, across every file
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    partials = []
+    for blob in _model_blobs(bucket, prefix):
+        path = os.path.join(local_dir, os.path.relpath(blob.name, prefix))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path) and _read(path + CHECKSUM_SUFFIX) == _checksum(blob):
+            continue
+        partials.append(_PartialFile(path, blob, MODEL_RANGE_BYTES))
+
+    work = [(partial, index) for partial in partials for index in partial.missing()]
+    total = sum(partial.blob.size for partial in partials)
+    logging.info(
+        f"Downloading {len(partials)} model files ({total / 1024**3:.2f} GiB), "
+        f"{len(work)} ranges left, {workers} at a time"
+    )
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # list() re-raises the first failed range, the recorded ones are kept for the next start
+        list(pool.map(lambda item: item[0].fetch(item[1]), work))
+    for partial in partials:
+        partial.finish()
+
+
+def convert_to_safetensors(model_dir: str, output_dir: str, shard_size: int = SAFETENSORS_SHARD_SIZE):
+    """
+    Converts a model's pytorch_model.bin into safetensors shards and their index.
+
+    Args:
+        model_dir (str): folder with pytorch_model.bin
+        output_dir (str): where the shards and model.safetensors.index.json are written
+        shard_size (int): most bytes in a shard
+    """
+    from safetensors.torch import save_file
+
+    state_dict = torch.load(os.path.join(model_dir, "pytorch_model.bin"), map_location="cpu")
+    shards, current, current_size, storages = [], {}, 0, set()
+    for name, tensor in state_dict.items():
+        # safetensors refuses tensors sharing memory, tied weights are stored twice
+        storage = tensor.storage().data_ptr()
+        tensor = tensor.clone() if storage in storages else tensor.contiguous()
+        storages.add(storage)
+        size = tensor.numel() * tensor.element_size()
+        if current and current_size + size > shard_size:
+            shards.append(current)
+            current, current_size = {}, 0
+        current[name] = tensor
+        current_size += size
+    shards.append(current)
+
+    os.makedirs(output_dir, exist_ok=True)
+    weight_map, total_size = {}, 0
+    for number, shard in enumerate(shards, 1):
+        file_name = f"model-{number:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, os.path.join(output_dir, file_name), metadata={"format": "pt"})
+        for name, tensor in shard.items():
+            weight_map[name] = file_name
+            total_size += tensor.numel() * tensor.element_size()
+    with open(os.path.join(output_dir, SAFETENSORS_INDEX), "w") as file:
+        json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, file, indent=2)
+    logging.info(f"Wrote {len(shards)} shards, {total_size / 1024**3:.2f} GiB, to {output_dir}")
+
+
+def upload_model(local_dir: str, destination: str):
+    """Uploads the converted shards and index to gs://bucket/prefix, next to the model's config."""
+    from google.cloud import storage
+
+    bucket_name, _, prefix = destination[len("gs://") :].partition("/")
+    bucket = storage.Client().bucket(bucket_name)
+    for file_name in sorted(os.listdir(local_dir)):
+        if file_name.endswith(".safetensors") or file_name == SAFETENSORS_INDEX:
+            bucket.blob(f"{prefix.rstrip('/')}/{file_name}").upload_from_filename(os.path.join(local_dir, file_name))
+            logging.info(f"Uploaded {file_name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 4 or sys.argv[1] != "convert":
+        sys.exit("Usage: python3 weights.py convert <model_dir> <gs://bucket/prefix | output_dir>")
+    _, _, model_dir, destination = sys.argv
+    if destination.startswith("gs://"):
+        output_dir = os.path.join(model_dir, "safetensors")
+        convert_to_safetensors(model_dir, output_dir)
+        upload_model(output_dir, destination)
+    else:
+        convert_to_safetensors(model_dir, destination)
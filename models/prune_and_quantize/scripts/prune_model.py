@@ -5,10 +5,37 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 import os
 from google.cloud import storage
 from google.oauth2.service_account import Credentials
+import argparse
+import fnmatch
 import gc
 import matplotlib.pyplot as plt
 import json
 
+# Weight matrices of the attention and MLP projections. Norm weights are scales around 1, zeroing
+# them would switch whole channels off, so they are left alone
+DEFAULT_PATTERNS = [
+    "model.layers.*.self_attn.*_proj.weight",
+    "model.layers.*.mlp.*_proj.weight",
+]
+# Bins of each of the two histogram passes that find the global threshold
+HISTOGRAM_BINS = 4096
+
+parser = argparse.ArgumentParser(description="Magnitude pruning then int8 dynamic quantization of a causal LM.")
+parser.add_argument("--model-path", default="openlm-research/open_llama_7b_v2")
+parser.add_argument("--sparsity", type=float, default=0.5, help="fraction of the matched weights set to zero")
+parser.add_argument(
+    "--scope",
+    choices=("per-layer", "global"),
+    default="per-layer",
+    help="per-layer: every matched tensor loses the same fraction of its weights, "
+    "global: one magnitude threshold over all of them",
+)
+parser.add_argument("--patterns", nargs="+", default=DEFAULT_PATTERNS, help="fnmatch patterns of the parameters to prune")
+parser.add_argument("--report", default="sparsity_report.json", help="per-tensor sparsity achieved, saved with the model")
+args = parser.parse_args()
+if not 0 <= args.sparsity < 1:
+    parser.error("--sparsity must be in [0, 1)")
+
 # Determine path for GCP credentials and load them
 key_path = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "secrets", "gcp_key.json"
@@ -34,7 +61,7 @@ def get_memory_usage():
 # Load the tokenizer and model without accumulating gradients
 # to save memory
 with torch.no_grad():
-    model_path = "openlm-research/open_llama_7b_v2"
+    model_path = args.model_path
     TOKENIZER = AutoTokenizer.from_pretrained(model_path)
     MODEL = AutoModelForCausalLM.from_pretrained(model_path)
     MODEL.eval()  # Set model to evaluation mode
@@ -43,95 +70,6 @@ with torch.no_grad():
 print(f"Initial Memory usage: {get_memory_usage():.2f} MB")
 
 
-# Function to get a nested attribute from an object
-def nested_getattr(obj, attr):
-    """
-    Retrieve a nested attribute from an object.
-
-    Args:
-        obj (object): The object to retrieve the attribute from.
-        attr (str): The nested attribute string.
-
-    Returns:
-        object: The retrieved attribute.
-    """
-    for a in attr.split("."):
-        obj = getattr(obj, a)
-    return obj
-
-
-# Function to set a value to a nested attribute in an object
-def nested_setattr(obj, attr, value):
-    """
-    Set a value to a nested attribute in an object.
-
-    Args:
-        obj (object): The object to set the attribute on.
-        attr (str): The nested attribute string.
-        value (Any): The value to set.
-    """
-    attrs = attr.split(".")
-    for a in attrs[:-1]:
-        obj = getattr(obj, a)
-    setattr(obj, attrs[-1], value)
-
-# Extract unique layer types from the computational graph
-def get_unique_layer_types_from_graph(graph_path):
-    """
-    Extract unique layer types from a computational graph JSON file.
-
-    Args:
-        graph_path (str): Path to the computational graph JSON file.
-
-    Returns:
-        list: List of unique layer types.
-    """
-    with open(graph_path, 'r') as f:
-        graph_data = json.load(f)
-
-    # Extract unique layer types based on the structure of your JSON file
-    weight_map = graph_data['weight_map']
-    unique_layers = set()
-    for layer_name in weight_map:
-        # Extract only those entries that have the format "model.layers.<layer_num>.<layer_type>.<attr>"
-        if layer_name.startswith("model.layers.") and ".weight" in layer_name:
-            # Extract the layer type and add it to the unique_layers set
-            layer_type = layer_name.split(".")[3]
-            unique_layers.add(layer_type)
-    return list(unique_layers)
-
-# Path to the computational graph
-graph_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "configs", "llama_computational_graph.json")
-
-# Get the unique layer types
-unique_layer_types = get_unique_layer_types_from_graph(graph_path)
-
-# construct the layers_to_prune list using these unique layer types
-num_layers = len(MODEL.model.layers)
-layers_to_prune = []
-
-# for layer_type in unique_layer_types:
-#     for i in range(num_layers):
-#         layers_to_prune.append(f"model.layers.{i}.{layer_type}.weight")
-
-
-###### The code above generates the list below we simply chose to use a hardcoded version for debugging purposes. 
-
-# List of layers to prune
-layers_to_prune = [
-    "model.layers.{}.input_layernorm.weight",
-    "model.layers.{}.mlp.down_proj.weight",
-    "model.layers.{}.mlp.gate_proj.weight",
-    "model.layers.{}.mlp.up_proj.weight",
-    "model.layers.{}.post_attention_layernorm.weight",
-    "model.layers.{}.self_attn.k_proj.weight",
-    "model.layers.{}.self_attn.o_proj.weight",
-    "model.layers.{}.self_attn.q_proj.weight",
-    "model.layers.{}.self_attn.rotary_emb.inv_freq",
-    "model.layers.{}.self_attn.v_proj.weight"
-]
-
-
 # Function to upload files to GCP bucket
 def upload_to_gcs(bucket_name, source_folder, destination_folder, credentials):
     """
@@ -156,51 +94,89 @@ def upload_to_gcs(bucket_name, source_folder, destination_folder, credentials):
             print(f"Uploaded {file} to {destination_blob_name}")
 
 
-# Create a tensor of zeros for pruning
-zero_tensor = torch.tensor(0.0, device=MODEL.device)
+def global_threshold(tensors, sparsity, bins=HISTOGRAM_BINS):
+    """
+    Magnitude under which `sparsity` of all the elements of tensors are, without concatenating
+    them: a histogram of |w| over [0, max] finds the bin holding that quantile, a second
+    histogram over that bin narrows it down to max / bins**2.
 
+    Args:
+        tensors (list[torch.Tensor]): the tensors to prune
+        sparsity (float): fraction of the elements to prune
 
-# Determine the number of layers in the model
-num_layers = len(MODEL.model.layers)
+    Returns:
+        float: the threshold, elements with |w| <= threshold are pruned
+    """
+    k = int(sparsity * sum(tensor.numel() for tensor in tensors))
+    if k == 0:
+        return -1.0
+    low, high = 0.0, max(float(tensor.abs().max()) for tensor in tensors)
+    below = 0
+    for _ in range(2):
+        # histc ignores the elements outside [low, high], one tensor's |w| is materialized at a time
+        counts = sum(torch.histc(tensor.abs().float(), bins, low, high) for tensor in tensors)
+        cumulative = below + counts.double().cumsum(0)
+        index = min(int(torch.searchsorted(cumulative, torch.tensor([float(k)], dtype=torch.float64))), bins - 1)
+        width = (high - low) / bins
+        below = float(cumulative[index - 1]) if index else below
+        low, high = low + index * width, low + (index + 1) * width
+    return high
+
+
+def tensor_threshold(tensor, sparsity):
+    """Magnitude of the k-th smallest |w| of one tensor, -1 when nothing is pruned."""
+    k = int(sparsity * tensor.numel())
+    if k == 0:
+        return -1.0
+    return float(tensor.abs().flatten().float().kthvalue(k).values)
+
+
+# The parameters matching any pattern, in model order
+targets = [
+    (name, parameter)
+    for name, parameter in MODEL.named_parameters()
+    if any(fnmatch.fnmatchcase(name, pattern) for pattern in args.patterns)
+]
+if not targets:
+    raise ValueError(f"No parameter matches {args.patterns}")
+print(f"Pruning {len(targets)} tensors to {args.sparsity:.0%} sparsity ({args.scope})")
 
-# List to store memory usages after pruning each layer
+# List to store memory usages after pruning each tensor
 memory_usages = []
+report = {}
 
-# Prune each layer of the model
-for layer_format in layers_to_prune:
-    for i in range(num_layers):
-        layer_name = layer_format.format(i)
-
-        # Perform pruning without accumulating gradients
-        with torch.no_grad():
-            weights = nested_getattr(MODEL, layer_name)
-            mask = torch.abs(weights) >= 0.01
-
-            # Prune weights that are smaller than a threshold
-            pruned_weights = torch.where(mask, weights, zero_tensor)
-            nested_setattr(MODEL, layer_name, torch.nn.Parameter(pruned_weights))
-
-            # Free up memory
-            del weights, mask, pruned_weights
+# Perform pruning without accumulating gradients, in place: the only temporaries are one tensor's
+# |w| and its boolean mask
+with torch.no_grad():
+    if args.scope == "global":
+        threshold = global_threshold([parameter for _, parameter in targets], args.sparsity)
+        print(f"Global magnitude threshold: {threshold:.6f}")
 
-        # Collect garbage to free up more memory
-        gc.collect()
-        torch.cuda.empty_cache()
+    for name, parameter in targets:
+        if args.scope == "per-layer":
+            threshold = tensor_threshold(parameter, args.sparsity)
+        parameter.masked_fill_(parameter.abs() <= threshold, 0)
 
-        # Display memory usage after pruning this layer
-        print(
-            f"Memory usage after pruning layer {layer_name}: {get_memory_usage():.2f} MB"
-        )
+        zeros = int((parameter == 0).sum())
+        report[name] = {"numel": parameter.numel(), "zeros": zeros, "sparsity": zeros / parameter.numel()}
         memory_usages.append(get_memory_usage())
 
-# Plot the memory usage after pruning each layer
-layers = [f"Layer {i+1}" for i in range(len(memory_usages))]
+# Report the sparsity achieved per tensor, and over all of them
+for name, row in report.items():
+    print(f"{name:<50} {row['sparsity']:>7.2%} of {row['numel']:,}")
+total_zeros = sum(row["zeros"] for row in report.values())
+total_numel = sum(row["numel"] for row in report.values())
+print(f"Overall sparsity of the pruned tensors: {total_zeros / total_numel:.2%} of {total_numel:,} weights")
+print(f"Memory usage after pruning: {get_memory_usage():.2f} MB")
+
+# Plot the memory usage after pruning each tensor
+layers = list(range(1, len(memory_usages) + 1))
 
 
 plt.figure(figsize=(10, 6))
 plt.plot(layers, memory_usages, marker="o", linestyle="-", color="r")
 plt.title("Memory Usage Evolution During Pruning")
-plt.xlabel("Layers")
+plt.xlabel("Pruned tensors")
 plt.ylabel("Memory Usage (MB)")
 plt.grid(True, which="both", linestyle="--", linewidth=0.5)
 plt.tight_layout()
@@ -224,9 +200,11 @@ quantized_model = torch.quantization.quantize_dynamic(
 # Display memory usage after quantization
 print(f"Memory usage after quantization: {get_memory_usage():.2f} MB")
 
-# Save the quantized model locally
+# Save the quantized model locally, with the sparsity report
 local_path = "llama_7b_pruned"
 quantized_model.save_pretrained(local_path)
+with open(os.path.join(local_path, args.report), "w") as f:
+    json.dump({"sparsity": args.sparsity, "scope": args.scope, "patterns": args.patterns, "tensors": report}, f, indent=2)
 
 # Free up memory by deleting models
 del MODEL, quantized_model
@@ -14,6 +14,12 @@ cd ../grade_and_explain
 docker build -t gcr.io/ac215-bitesize/grade-and-explain:v1 .
 docker push gcr.io/ac215-bitesize/grade-and-explain:v1
 
+# For the prewarm worker, it builds the question banks of every upload
+cd ../../preprocessing_question_gen
+docker build -t gcr.io/ac215-bitesize/prewarm:v1 -f Dockerfile.prewarm .
+docker push gcr.io/ac215-bitesize/prewarm:v1
+cd ../build_backend/deploy
+
 # Build Kubernetes cluster
 
 gcloud container --project "ac215-bitesize" clusters create-auto "bitesize-backend" \\
@@ -1,25 +1,39 @@
-import PyPDF2
-from docx import Document
-import textract
 import os
-import tempfile
 import re
 import json
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask_cors import cross_origin
 
 app = Flask(__name__)
 
 from infer import LlamaTextGenerator
+from gcp import Bucket
+from testbank import ANONYMOUS_USER, TestBank
+from customerrors import DocumentLength
+from response_cache import get_cache
+from extraction import extract_docx, extract_pdf, extract_text, extract_texts, iter_page_records, ndjson_lines
+
+# Service account used for every bucket call, the client behind it is shared process-wide
+KEY_PATH = "secrets/generate_mcq_account_key.json"
+# Where /extract-text reads the documents from, shared with the prewarm worker
+DOCUMENTS_BUCKET = os.environ.get("DOCUMENTS_BUCKET", "bite-size-documents")
+DOCUMENTS_FOLDER = os.environ.get("DOCUMENTS_FOLDER", "documents_to_be_summarized")
+# Ask the model server for schema-constrained JSON questions, "0" goes back to parsing free text
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "1") == "1"
+# Questions in a test, drawn from the document's bank when the prewarm worker has built it
+NUM_QUESTIONS = 10
+# /generate-questions choice -> TestBank bank option
+BANK_OPTIONS = {"1": "mcq", "2": "short answer"}
 
 # Defining a dictionary to store the answers:
 
 
 class QuestionGenerator:
-    def __init__(self, api_key_file_path):
+    def __init__(self, api_key_file_path=KEY_PATH):
         """Initialize the QuestionGenerator with the given LlamaTextGenerator instance."""
         self.text_generator = LlamaTextGenerator()
 
@@ -29,14 +43,12 @@ class QuestionGenerator:
         Extracts text from a PDF file content.
 
         Args:
-            pdf_file_content (BytesIO): Content of the PDF file.
+            pdf_file_content (bytes | BytesIO): Content of the PDF file.
 
         Returns:
             str: Extracted text from the PDF file.
         """
-        pdf_reader = PyPDF2.PdfReader(pdf_file_content)
-        text = "".join([page.extract_text() for page in pdf_reader.pages])
-        return text
+        return extract_pdf(pdf_file_content)
 
     @staticmethod
     def extract_text_from_docx(docx_file_content):
@@ -44,30 +56,125 @@ class QuestionGenerator:
         Extracts text from a DOCX file content.
 
         Args:
-            docx_file_content (BytesIO): Content of the DOCX file.
+            docx_file_content (bytes | BytesIO): Content of the DOCX file.
 
         Returns:
             str: Extracted text from the DOCX file.
         """
-        doc = Document(docx_file_content)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        return extract_docx(docx_file_content)
 
     @staticmethod
-    def extract_text_from_other_formats(file_content):
+    def extract_text_from_other_formats(file_content, file_name=None):
         """
-        Extracts text from other file formats using textract.
+        Extracts text from other file formats (txt, md, html, rtf, pptx, odt ...),
+        detected from the content and parsed in memory. textract is only the last resort.
 
         Args:
-            file_content (BytesIO): Content of the file.
+            file_content (bytes | BytesIO): Content of the file.
+            file_name (str): Original file name, lets textract pick its parser.
 
         Returns:
             str: Extracted text from the file.
         """
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            temp_file.write(file_content.read())
-            return textract.process(temp_file.name).decode("utf-8")
+        return extract_text(file_content, file_name)
+
+    @staticmethod
+    def format_structured_question(number, item):
+        """
+        Formats one JSON question (see LlamaTextGenerator.generate_structured_questions) like the
+        questions parsed from free text.
+
+        Args:
+            number (int): the question's number in the test
+            item (dict): the generated question
+
+        Returns:
+            dict: {"difficulty", "options", "question_text"}, without options for short answers
+        """
+        formatted = {
+            "difficulty": item.get("difficulty", ""),
+            "question_text": f"{number}. {item.get('question', '').strip()}",
+        }
+        if "options" in item:
+            formatted["options"] = [
+                f"{letter}) {option.strip()}" for letter, option in zip("abcd", item["options"])
+            ]
+        return formatted
+
+    @staticmethod
+    def renumber(question_text, number):
+        """Gives a question drawn from a bank its number in the test."""
+        return re.sub(r"^\s*\d+\.", f"{number}.", question_text, count=1)
+
+    def format_bank_questions(self, items, choice):
+        """
+        Formats questions drawn from a bank (see TestBank.drawTest). A bank item is one question
+        of the model's free text answers, an MCQ with its options and its difficulty.
+
+        Args:
+            items (list[str]): the drawn bank items
+            choice (str): "1" for MCQs, "2" for short answers
+
+        Returns:
+            list[dict]: the questions format_questions or format_short_answers would give,
+                numbered from 1
+        """
+        formatted_data = []
+        for item in items:
+            item = item.replace("\\n", "\n")
+            if choice == "2":
+                formatted_data.extend(self.format_short_answers([item]))
+                continue
+
+            question_text_search = re.search(r"^\d+\..+?(?=\na\))", item, re.DOTALL)
+            options = [option.strip() for option in re.findall(r"\b[a-d]\) .+?(?=\n|$)", item)]
+            if not question_text_search or not options:
+                print("Skipping bank item:", item)  # Debug print
+                continue
+            difficulty_search = re.search(r"Difficulty:\s*(.+)", item, re.IGNORECASE)
+            formatted_data.append(
+                {
+                    "difficulty": difficulty_search.group(1).strip() if difficulty_search else "",
+                    "options": options,
+                    "question_text": question_text_search.group(0).strip(),
+                }
+            )
+
+        for number, question in enumerate(formatted_data, 1):
+            question["question_text"] = self.renumber(question["question_text"], number)
+        return formatted_data
+
+    def draw_from_bank(self, text, choice, user_id=ANONYMOUS_USER):
+        """
+        Draws a test from the document's bank in the bank store, questions the learner hasn't
+        seen first (see TestBank.drawTest). Nothing is generated here: the banks are built by
+        the prewarm worker when the document is uploaded, and refilled in the background.
+
+        Args:
+            text (str): the document text, the same /extract-text returns
+            choice (str): "1" for MCQs, "2" for short answers
+            user_id (str): the learner
+
+        Returns:
+            list[dict]: the formatted questions, None when the document has no bank yet
+        """
+        option = BANK_OPTIONS[choice]
+        bank = TestBank(generator=self.text_generator)
+        try:
+            bank.initalizeText(text)
+        except DocumentLength:
+            return None
+        if not bank.loadBank(option):
+            return None
+        questions = self.format_bank_questions(bank.drawTest(option, NUM_QUESTIONS, False, user_id), choice)
+        # A short-answer bank item can hold several questions
+        return questions[:NUM_QUESTIONS] or None
 
     def format_questions(self, data):
+        if data and isinstance(data[0], dict):
+            # Structured questions are already parsed, every one of them is kept
+            return [self.format_structured_question(number, item) for number, item in enumerate(data, 1)]
+
         formatted_data = []
         # We expect that each question is followed by its difficulty, hence the step of 2
         for i in range(0, len(data), 2):
@@ -114,6 +221,9 @@ class QuestionGenerator:
         return formatted_data
 
     def format_short_answers(self, data):
+        if data and isinstance(data[0], dict):
+            return [self.format_structured_question(number, item) for number, item in enumerate(data, 1)]
+
         formatted_data = []
         # Split the string into individual questions
         questions = data[0].split("\n")
@@ -133,15 +243,57 @@ class QuestionGenerator:
         return formatted_data
 
     def generate_mcqs(self, text):
-        """Generate MCQs using the Llama model."""
+        """Generate MCQs using the Llama model, as JSON when the model server supports it."""
         num_questions = 10  # Define the number of MCQs to generate
+        if STRUCTURED_OUTPUT:
+            questions = self.text_generator.generate_structured_questions(text, num_questions, "mcq")
+            if questions:
+                return questions
         return self.text_generator.generate_questions(text, num_questions)
 
     def generate_short_answers(self, text):
-        """Generate short answer questions using the Llama model."""
+        """Generate short answer questions using the Llama model, as JSON when the model server supports it."""
         num_questions = 10  # Define the number of short answer questions to generate
+        if STRUCTURED_OUTPUT:
+            questions = self.text_generator.generate_structured_questions(text, num_questions, "short_answer")
+            if questions:
+                return questions
         return self.text_generator.generate_short_answers(text, num_questions)
 
+    def stream_formatted_questions(self, text, choice):
+        """
+        Streams formatted questions as the model generates them.
+
+        Args:
+            text (str): the document text
+            choice (str): "1" for MCQs, "2" for short answers
+
+        Yields:
+            dict: {"MCQ": question} or {"ShortAnswer": question}, one per question
+        """
+        if STRUCTURED_OUTPUT:
+            question_type, kind = ("MCQ", "mcq") if choice == "1" else ("ShortAnswer", "short_answer")
+            number = 0
+            for number, item in enumerate(self.text_generator.stream_structured_questions(text, 10, kind), 1):
+                yield {question_type: self.format_structured_question(number, item)}
+            if number:
+                return
+            # Nothing parsed, the model server predates structured output
+
+        if choice == "1":
+            # format_questions expects each question followed by its difficulty
+            pending = []
+            for item in self.text_generator.stream_questions(text, 10):
+                pending.append(item)
+                if len(pending) == 2:
+                    for question in self.format_questions(pending):
+                        yield {"MCQ": question}
+                    pending = []
+        elif choice == "2":
+            for item in self.text_generator.stream_short_answers(text, 10):
+                for question in self.format_short_answers([item]):
+                    yield {"ShortAnswer": question}
+
     def generate_mix(self, text):
         """Generate a mix of MCQs and short answer questions using the Llama model."""
         return self.text_generator.generate_mixed_questions(text)
@@ -153,23 +305,12 @@ class QuestionGenerator:
     @staticmethod
     def list_files_in_gcp_bucket(bucket_name, folder_name):
         """List all files in a GCP bucket within a specific folder."""
-        KEY_PATH = "secrets/generate_mcq_account_key.json"
-        storage_client = storage.Client.from_service_account_json(KEY_PATH)
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=folder_name)
-        return [blob.name for blob in blobs if not blob.name.endswith("/")]
+        return Bucket(KEY_PATH, bucket_name).list_files(folder_name)
 
     @staticmethod
     def get_file_from_gcp_bucket(bucket_name, file_name):
         """Get a file from GCP bucket."""
-        KEY_PATH = "secrets/generate_mcq_account_key.json"
-        storage_client = storage.Client.from_service_account_json(KEY_PATH)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-
-        # Download as bytes
-        content = blob.download_as_bytes()
-        return content
+        return Bucket(KEY_PATH, bucket_name).get_file(file_name)
 
     def write_to_gcp(self, data, bucket_name, destination_file_name):
         """
@@ -183,105 +324,49 @@ class QuestionGenerator:
         # Convert the dictionary to JSON
         data_json = json.dumps(data)
 
-        # Initialize the GCP Storage client
-        storage_client = storage.Client()
-
-        # Get the bucket object
-        bucket = storage_client.bucket(bucket_name)
-
-        # Specify the Blob path in the bucket
-        blob = bucket.blob(destination_file_name)
-
-        # Upload the JSON data
-        blob.upload_from_string(data_json, content_type="application/json")
+        # Upload the JSON data through the shared client (default credentials)
+        Bucket(None, bucket_name).upload_string(
+            data_json, destination_file_name, content_type="application/json"
+        )
         print()
         print(f"Your answers have been recorded!")
 
-    def return_text(self, bucket_name, folder_name):
-        generator = QuestionGenerator()
-
-        bucket_name = "bite-size-documents"
-
-        folder_name = "documents_to_be_summarized"
-
-        # Get files from GCP Bucket
-        files = generator.list_files_in_gcp_bucket(bucket_name, folder_name)
-        parsed_texts = []
-
-        # Parsing different file formats and extracting text
-        for file in files:
-            _, extension = os.path.splitext(file)
-
-            file_in_memory = BytesIO(
-                generator.get_file_from_gcp_bucket(bucket_name, file)
-            )
-
-            if extension == ".pdf":
-                parsed_texts.append(generator.extract_text_from_pdf(file_in_memory))
-            elif extension == ".docx":
-                parsed_texts.append(generator.extract_text_from_docx(file_in_memory))
-            else:
-                print(f"Unsupported file format: {extension}")
-                continue
-
-            print("\n" * 4)
-
-            # Process each parsed text and print questions based on the user's choice
-            for text in parsed_texts:
-                _, extension = os.path.splitext(file)
-                file_in_memory = BytesIO(
-                    generator.get_file_from_gcp_bucket(bucket_name, file)
-                )
-
-                if extension == ".pdf":
-                    text = generator.extract_text_from_pdf(file_in_memory)
-                elif extension == ".docx":
-                    text = generator.extract_text_from_docx(file_in_memory)
-                else:
-                    print(f"Unsupported file format: {extension}")
-                    continue
+    def return_text(self, bucket_name=DOCUMENTS_BUCKET, folder_name=DOCUMENTS_FOLDER):
+        """
+        Extracts every supported document of a bucket folder, through the extraction package
+        like /extract-text.
 
-                print("\n" * 4)
+        Args:
+            bucket_name (str): the name of the GCP bucket
+            folder_name (str): the folder within the bucket
 
-        return text
+        Returns:
+            str: the documents' text joined with newlines, what the frontend sends to /generate-questions
+        """
+        bucket = Bucket(KEY_PATH, bucket_name)
+        return "\n".join(extract_texts(bucket, bucket.list_blobs(folder_name)))
 
     @app.route("/extract-text", methods=["GET"])
     @cross_origin()
     def extract_text():
         try:
-            # Get data from the request here, e.g., specific file names to process
-            # data = request.get_json()
-            # Assuming data contains 'files' which is a list of file names to process
-            text_generator = MCQGenerator()
-            bucket_name = "bite-size-documents"
-            folder_name = "documents_to_be_summarized"
-            files = text_generator.list_files_in_gcp_bucket(bucket_name, folder_name)
-
-            parsed_texts = []
-
-            # Parsing different file formats and extracting text
-            # Parsing different file formats and extracting text
-            for file_name in files:
-                _, extension = os.path.splitext(file_name)
-                file_content = text_generator.get_file_from_gcp_bucket(
-                    bucket_name, file_name
+            bucket_name = DOCUMENTS_BUCKET
+            folder_name = DOCUMENTS_FOLDER
+            bucket = Bucket(KEY_PATH, bucket_name)
+
+            # Listed blobs carry their MD5, so cached documents are neither downloaded nor parsed again
+            files = bucket.list_blobs(folder_name)
+
+            # ?stream=ndjson sends one line per page as soon as it is decoded, instead of one body at the end
+            if request.args.get("stream") == "ndjson":
+                records = iter_page_records(bucket, files)
+                return Response(
+                    stream_with_context(ndjson_lines(records)),
+                    mimetype="application/x-ndjson",
                 )
-                file_in_memory = BytesIO(
-                    file_content
-                )  # Create a BytesIO object from the content
-
-                # Pass the BytesIO object directly to the extraction functions
-                if extension == ".pdf":
-                    parsed_texts.append(
-                        text_generator.extract_text_from_pdf(file_in_memory)
-                    )
-                elif extension == ".docx":
-                    parsed_texts.append(
-                        text_generator.extract_text_from_docx(file_in_memory)
-                    )
-                else:
-                    app.logger.error(f"Unsupported file format: {extension}")
-                    continue  # Skip unsupported files
+
+            # Downloads and parsing overlap, results come back in the order of the files
+            parsed_texts = extract_texts(bucket, files)
 
             # print("PARSED TEXTS", parsed_texts)
             # Create a response with all parsed texts
@@ -298,9 +383,35 @@ class QuestionGenerator:
         data = request.get_json()
         text = data.get("text")
         choice = data.get("choice")
+        user_id = data.get("user_id") or ANONYMOUS_USER
 
         if text and choice:
-            generator = LlamaTextGenerator()
+            generator = QuestionGenerator()
+
+            # A prewarmed bank answers without calling the model, live generation is the fallback
+            if choice in BANK_OPTIONS:
+                try:
+                    banked = generator.draw_from_bank(text, choice, user_id)
+                except Exception as e:
+                    app.logger.error(f"Could not draw from the question bank: {e}")
+                    banked = None
+                if banked:
+                    question_type = "MCQ" if choice == "1" else "ShortAnswer"
+                    if request.args.get("stream") == "ndjson":
+                        return Response(
+                            ndjson_lines({question_type: question} for question in banked),
+                            mimetype="application/x-ndjson",
+                        )
+                    return jsonify({question_type: banked})
+
+            # ?stream=ndjson sends one line per question as soon as the model has written it
+            if request.args.get("stream") == "ndjson":
+                if choice not in ("1", "2"):
+                    return jsonify({"error": "Invalid choice!"}), 400
+                return Response(
+                    stream_with_context(ndjson_lines(generator.stream_formatted_questions(text, choice))),
+                    mimetype="application/x-ndjson",
+                )
 
             if choice == "1":
                 questions_data = generator.generate_mcqs(text)
@@ -320,6 +431,12 @@ class QuestionGenerator:
 
         return jsonify({"error": "Missing text or choice parameter!"}), 400
 
+    @app.route("/response-cache", methods=["GET"])
+    def response_cache_stats():
+        """Hit rate of this process's LLM response cache, see response_cache.py."""
+        cache = get_cache()
+        return jsonify(cache.stats() if cache is not None else {"enabled": False})
+
 
 # if __name__ == "__main__":
 #     port = os.environ.get("PORT", 80)  # Use PORT if it's there.
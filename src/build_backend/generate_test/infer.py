@@ -1,7 +1,17 @@
 from google.cloud import aiplatform
 from google.protobuf.struct_pb2 import Value
 import json
+import os
+import requests
 
+from batching import MAX_BATCH_SIZE, get_batcher
+from response_cache import get_cache
+from retrieval import select_context
+
+# Token budget of one question in a structured response, an MCQ with its options is ~100 tokens
+STRUCTURED_TOKENS_PER_QUESTION = int(os.environ.get("STRUCTURED_TOKENS_PER_QUESTION", 160))
+# Temperature of fresh requests, the model server decodes the others greedily
+FRESH_TEMPERATURE = float(os.environ.get("FRESH_TEMPERATURE", 0.8))
 
 class LlamaTextGenerator:
     """
@@ -22,6 +32,8 @@ class LlamaTextGenerator:
         config = self.read_config(CONFIG_PATH)
         endpoint_id = config["endpointId"]
         project_id = config["projectId"]
+        # Optional: the model server's /predict_stream route, for the stream_* methods
+        self.stream_url = config.get("streamUrl")
 
         aiplatform.init(project=project_id, location=location)
         self.endpoint = aiplatform.Endpoint(endpoint_id)
@@ -41,44 +53,280 @@ class LlamaTextGenerator:
             config = json.load(file)
         return config
 
-    def _send_prediction_request(self, prompt):
+    @staticmethod
+    def _instance(prompt, context=None, **fields):
+        """
+        A prediction instance. The model reads context + "\n" + prompt; sending the document as
+        the context lets the server reuse its KV cache across every prompt about it. Extra fields
+        (response_format, max_new_tokens) are sent as they are.
+        """
+        instance = {"prompt": prompt}
+        if context is not None:
+            instance["context"] = context
+        instance.update(fields)
+        return instance
+
+    def predict_many(self, prompts):
         """
-        Sends a prediction request to the deployed model on Vertex AI.
+        Sends several prompts to the deployed model, as few multi-instance requests as possible.
+
+        Args:
+            prompts (list[str]): The input prompts for text generation.
+
+        Returns:
+            list[str]: Generated text for each prompt, in order. "" for the prompts that failed.
+        """
+        return self.predict_instances([self._instance(prompt) for prompt in prompts])
+
+    def predict_instances(self, instances):
+        """
+        Sends prediction instances to the deployed model, as few multi-instance requests as possible.
+
+        Args:
+            instances (list[dict]): {"prompt": ..., "context": ...} instances, see _instance.
+
+        Returns:
+            list[str]: Generated text for each instance, in order. "" for the instances that failed.
+        """
+        responses = []
+        remaining = list(instances)
+        while remaining:
+            chunk = remaining[:MAX_BATCH_SIZE]
+            try:
+                predictions = self.endpoint.predict(instances=chunk, timeout=120).predictions
+            except Exception as e:
+                print(f"Error while getting prediction: {e}")
+                predictions = []
+
+            if not predictions:
+                # Nothing came back, give up on this chunk rather than retrying forever
+                responses.extend("" for _ in chunk)
+                remaining = remaining[len(chunk):]
+                continue
+
+            # A server that answers fewer instances than it was sent gets the rest again
+            for prediction in predictions[: len(chunk)]:
+                responses.append(prediction.get("response", "") if isinstance(prediction, dict) else "")
+            remaining = remaining[min(len(predictions), len(chunk)):]
+        return responses
+
+    def _send_prediction_request(self, prompt, context=None, fresh=False, **fields):
+        """
+        Sends a prediction request to the deployed model on Vertex AI. Concurrent requests are
+        coalesced into one multi-instance call (see batching.py).
 
         Args:
             prompt (str): The input prompt for text generation.
+            context (str, optional): The document the prompt is about, read before the prompt.
+            fresh (bool): Ask for a sampled response, without looking the cache up. A greedy
+                server gives the same text to the same prompt, only sampling makes it new.
+            **fields: Extra instance fields, see _instance.
 
         Returns:
-            str: Generated text.
+            str: Generated text, from the response cache when it has it (see response_cache.py).
         """
-        instance = {"prompt": prompt}
+        if fresh:
+            fields.setdefault("temperature", FRESH_TEMPERATURE)
+        instance = self._instance(prompt, context, **fields)
+        cache = get_cache()
+        if cache is not None and not fresh:
+            cached = cache.get(instance, self.endpoint.resource_name)
+            if cached is not None:
+                return cached
+
+        batcher = get_batcher(self.endpoint.resource_name, self.predict_instances)
         try:
-            predictions = self.endpoint.predict(
-                instances=[instance], timeout=120
-            )  # Add a timeout of 30 seconds
-            # Extract and return the generated text from the predictions
-            if predictions.predictions and "response" in predictions.predictions[0]:
-                return predictions.predictions[0]["response"]
+            response = batcher.submit(instance).result()
+            if cache is not None:
+                cache.put(instance, response, self.endpoint.resource_name)
+            return response
         except Exception as e:
             print(f"Error while getting prediction: {e}")
         return ""
 
-    def generate_questions(self, text, numQuestions):
+    def stream_prediction(self, prompt, context=None, **fields):
+        """
+        Streams the generated text of one prompt from the model server's /predict_stream route,
+        configured as "streamUrl". Without it the whole prediction comes back as a single piece.
+
+        Args:
+            prompt (str): The input prompt for text generation.
+            context (str, optional): The document the prompt is about, read before the prompt.
+            **fields: Extra instance fields, see _instance.
+
+        Yields:
+            str: The generated text, piece by piece as the model produces it. A cached response
+                comes as a single piece.
+        """
+        if not self.stream_url:
+            yield self._send_prediction_request(prompt, context, **fields)
+            return
+
+        instance = self._instance(prompt, context, **fields)
+        cache = get_cache()
+        if cache is not None:
+            cached = cache.get(instance, self.endpoint.resource_name)
+            if cached is not None:
+                yield cached
+                return
+
+        body = {"instances": [instance]}
+        pieces = []
+        try:
+            with requests.post(self.stream_url, json=body, stream=True, timeout=120) as response:
+                response.raise_for_status()
+                # Server-sent events: one "data: {json}" line per event
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    event = json.loads(line[len("data:"):])
+                    if "token" in event:
+                        pieces.append(event["token"])
+                        yield event["token"]
+                    elif "error" in event:
+                        print(f"Error while streaming prediction: {event['error']}")
+                        return
+                    elif event.get("done") and cache is not None:
+                        cache.put(instance, "".join(pieces), self.endpoint.resource_name)
+        except Exception as e:
+            print(f"Error while streaming prediction: {e}")
+
+    @staticmethod
+    def split_stream(pieces, separator="\n\n"):
+        """
+        Regroups streamed text into the items generate_* would have split it into.
+
+        Args:
+            pieces (iterable[str]): streamed text
+            separator (str): what separates two items
+
+        Yields:
+            str: each item as soon as the separator after it arrives, the last one at the end
+        """
+        buffer = ""
+        for piece in pieces:
+            buffer += piece
+            *items, buffer = buffer.split(separator)
+            for item in items:
+                if item.strip():
+                    yield item
+        if buffer.strip():
+            yield buffer
+
+    @staticmethod
+    def iter_json_array(pieces):
+        """
+        Parses a streamed JSON array of objects in a single pass, tracking only brace depth and
+        whether the current character is inside a string.
+
+        Args:
+            pieces (iterable[str]): streamed text of a JSON array, e.g. a structured prediction
+
+        Yields:
+            dict: each object of the array as soon as its closing brace arrives. An object that
+                doesn't parse, e.g. one cut off by the token limit, is skipped.
+        """
+        item, depth, in_string, escaped = [], 0, False, False
+        for piece in pieces:
+            for char in piece:
+                if depth or char == "{":
+                    item.append(char)
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char == "{":
+                    depth += 1
+                elif char == "}" and depth:
+                    depth -= 1
+                    if not depth:
+                        try:
+                            yield json.loads("".join(item))
+                        except ValueError:
+                            pass
+                        item = []
+
+    @staticmethod
+    def structured_query(kind, numQuestions):
+        if kind == "mcq":
+            return f"Generate {numQuestions} MCQs to help me study from this document exclusively, as a JSON array of objects with the question, its four options, the letter of the right answer and the level of difficulty: Easy, Medium, Hard."
+        return f"Generate {numQuestions} short answer questions based on the text above, as a JSON array of objects with the question and its level of difficulty: Easy, Medium, Hard."
+
+    def _structured_fields(self, kind, numQuestions):
+        """The instance fields asking the model server for a JSON array of numQuestions items."""
+        return {
+            "response_format": {"type": kind, "count": numQuestions},
+            "max_new_tokens": numQuestions * STRUCTURED_TOKENS_PER_QUESTION,
+        }
+
+    def generate_structured_questions(self, text, numQuestions, kind="mcq"):
+        """
+        Generates questions as JSON, the model server only lets the model write a JSON array of
+        numQuestions items of the kind's schema, so nothing is lost to parsing:
+
+            mcq           {"question", "options": [4 options], "answer": "a".."d", "difficulty"}
+            short_answer  {"question", "difficulty"}
+
+        Args:
+            text (str): The input text from which questions will be generated.
+            numQuestions (int): The number of questions to generate from the text.
+            kind (str): "mcq" or "short_answer"
+
+        Returns:
+            list[dict]: The generated questions, [] when the request failed.
+        """
+        output = self._send_prediction_request(
+            self.structured_query(kind, numQuestions),
+            context=select_context(text),
+            **self._structured_fields(kind, numQuestions),
+        )
+        return list(self.iter_json_array([output]))
+
+    def stream_structured_questions(self, text, numQuestions, kind="mcq"):
+        """
+        Streaming version of generate_structured_questions.
+
+        Yields:
+            dict: The same items generate_structured_questions returns, one at a time.
+        """
+        yield from self.iter_json_array(
+            self.stream_prediction(
+                self.structured_query(kind, numQuestions),
+                context=select_context(text),
+                **self._structured_fields(kind, numQuestions),
+            )
+        )
+
+    @staticmethod
+    def mcq_query(numQuestions):
+        return f"Generate {numQuestions} MCQs to help me study from this document exclusively, and each time tell me what you think the level of difficulty is: Easy, Medium, Hard."
+
+    @staticmethod
+    def short_answer_query(numQuestions):
+        return f"Generate {numQuestions} short answer questions based on the following text:"
+
+    def generate_questions(self, text, numQuestions, fresh=False):
         """
         Generates multiple-choice questions (MCQs) from a given text using the model.
 
         Args:
             text (str): The input text from which MCQs will be generated.
             numQuestions (int): The number of questions to generate from the text.
+            fresh (bool): Ask the model for new questions, sampled rather than cached.
 
         Returns:
             list[str]: List of generated MCQs.
         """
-        query = f"Generate {numQuestions} MCQs to help me study from this document exclusively, and each time tell me what you think the level of difficulty is: Easy, Medium, Hard."
-        prompt = f"{text}\n{query}"
+        query = self.mcq_query(numQuestions)
 
-        # Send prediction request to Vertex AI
-        output = self._send_prediction_request(prompt)
+        # Send prediction request to Vertex AI, the text (or the chunks that fit, see retrieval.py)
+        # goes first as the shared context
+        output = self._send_prediction_request(query, context=select_context(text), fresh=fresh)
 
         # Extract and return the generated questions
         if output:
@@ -86,28 +334,59 @@ class LlamaTextGenerator:
             return questions
         return []
 
-    def generate_short_answers(self, text, numQuestions):
+    def generate_short_answers(self, text, numQuestions, fresh=False):
         """
         Generates short answer questions from a given text using the model.
 
         Args:
             text (str): The input text from which short answer questions will be generated.
             numQuestions (int): The number of questions to generate from the text.
+            fresh (bool): Ask the model for new questions, sampled rather than cached.
 
         Returns:
             list[str]: List of generated short answer questions.
         """
-        query = f"Generate {numQuestions} short answer questions based on the following text:"
-        prompt = f"{text}\n{query}"
+        query = self.short_answer_query(numQuestions)
 
         # Send prediction request to Vertex AI
-        output = self._send_prediction_request(prompt)
+        output = self._send_prediction_request(query, context=select_context(text), fresh=fresh)
 
         if output:
             questions = output.split("\n\n")
             return questions
         return []
 
+    def stream_questions(self, text, numQuestions):
+        """
+        Streaming version of generate_questions, for rendering the first MCQ before the last one
+        is generated.
+
+        Args:
+            text (str): The input text from which MCQs will be generated.
+            numQuestions (int): The number of questions to generate from the text.
+
+        Yields:
+            str: The same items generate_questions returns, one at a time.
+        """
+        yield from self.split_stream(
+            self.stream_prediction(self.mcq_query(numQuestions), context=select_context(text))
+        )
+
+    def stream_short_answers(self, text, numQuestions):
+        """
+        Streaming version of generate_short_answers.
+
+        Args:
+            text (str): The input text from which short answer questions will be generated.
+            numQuestions (int): The number of questions to generate from the text.
+
+        Yields:
+            str: The same items generate_short_answers returns, one at a time.
+        """
+        yield from self.split_stream(
+            self.stream_prediction(self.short_answer_query(numQuestions), context=select_context(text))
+        )
+
     def generate_custom_prompt_questions(self, text, custom_prompt):
         """
         Generates questions based on a custom prompt. Still tied to the text.
@@ -119,8 +398,10 @@ class LlamaTextGenerator:
         Returns:
             list[str]: List of generated questions.
         """
-        prompt = f"{text}\n{custom_prompt}"
-        output = self._send_prediction_request(prompt)
+        # Retrieve the parts of the text the custom prompt asks about
+        output = self._send_prediction_request(
+            custom_prompt, context=select_context(text, custom_prompt)
+        )
 
         if output:
             questions = output.split("\n\n")
@@ -0,0 +1,252 @@
+"""
+Cache of model responses, in front of the prediction requests.
+
+The same document with "Generate 10 MCQs...", or the same question, answer and text for an
+explanation, keeps being sent to the endpoint. Responses are looked up under a key made of the
+normalized prompt and context and every generation parameter of the instance, in two tiers:
+    memory  an LRU of RESPONSE_CACHE_SIZE keys per process
+    sqlite  optional (RESPONSE_CACHE_PATH), shared by the processes of a host and across restarts,
+            trimmed to the RESPONSE_CACHE_MAX_ROWS most recently used keys
+Entries expire RESPONSE_CACHE_TTL seconds after their last response was added.
+
+The model server decodes greedily (do_sample=False in both of its BATCHING_MODEs), so a prompt
+has one response and a key keeps a single one. Only instances that explicitly ask for sampling
+(do_sample true or a temperature above 0) have many good responses, and callers asking again may
+want another one: their keys hold up to RESPONSE_CACHE_VARIANTS responses. Until a key has them
+all, lookups miss and the new response is added, then lookups pick one of them at random.
+
+Note: vendored next to each copy of infer.py, edit this copy and sync the others.
+"""
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# "0" sends every request to the endpoint
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+# SQLite file of the on-disk tier, memory only when unset
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH")
+RESPONSE_CACHE_MAX_ROWS = int(os.environ.get("RESPONSE_CACHE_MAX_ROWS", 100000))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+# Responses kept per key of the instances asking for sampling, the others keep one
+RESPONSE_CACHE_VARIANTS = int(os.environ.get("RESPONSE_CACHE_VARIANTS", 3))
+# The disk tier is trimmed once every this many writes
+TRIM_EVERY = 256
+# Bump whenever what a key covers changes, entries stored under the old keys are never hit again
+KEY_VERSION = 2
+
+
+def normalize(text):
+    """
+    Unicode NFC without the surrounding whitespace. Line breaks, indentation and runs of spaces
+    are tokenized, so prompts that differ in them get responses of their own.
+    """
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def cache_key(instance, namespace=""):
+    """
+    Key of a prediction instance.
+
+    Args:
+        instance (dict): {"prompt": ..., "context": ..., and generation parameters}
+        namespace (str): what else the response depends on, e.g. the endpoint
+
+    Returns:
+        str: the key
+    """
+    fields = dict(instance)
+    for name in ("prompt", "context"):
+        if isinstance(fields.get(name), str):
+            fields[name] = normalize(fields[name])
+    payload = json.dumps([KEY_VERSION, namespace, fields], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def is_sampled(instance):
+    """Whether the instance explicitly asks for sampling, the model server decodes greedily otherwise."""
+    return instance.get("do_sample") is True or (instance.get("temperature") or 0) > 0
+
+
+class ResponseCache():
+    def __init__(
+        self,
+        size=RESPONSE_CACHE_SIZE,
+        path=RESPONSE_CACHE_PATH,
+        ttl=RESPONSE_CACHE_TTL,
+        variants=RESPONSE_CACHE_VARIANTS,
+        max_rows=RESPONSE_CACHE_MAX_ROWS,
+    ):
+        """
+        Creates the cache, and the SQLite tier when a path is given.
+
+        Args:
+            size (int): keys kept in memory
+            path (str): SQLite database file of the on-disk tier, None for memory only
+            ttl (float): seconds an entry lives after its last response was added
+            variants (int): responses kept per key of the instances asking for sampling
+            max_rows (int): keys kept on disk
+        """
+        self.size = size
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.max_rows = max_rows
+        # key -> (expires_at, [responses]), least recently used first
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = self.misses = self.disk_hits = self.evictions = 0
+
+        self._connection = None
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            with self._connection:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute(
+                    """CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        responses TEXT NOT NULL,
+                        expires_at REAL NOT NULL,
+                        used_at REAL NOT NULL
+                    )"""
+                )
+                self._connection.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+
+    def _wanted(self, instance):
+        return self.variants if is_sampled(instance) else 1
+
+    def _remember(self, key, entry):
+        """Puts an entry in the memory LRU, evicting the least recently used keys past size."""
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key, now):
+        """The entry of a key from the disk tier, None when it isn't there or expired."""
+        if self._connection is None:
+            return None
+        row = self._connection.execute(
+            "SELECT responses, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        with self._connection:
+            self._connection.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        return row[1], json.loads(row[0])
+
+    def get(self, instance, namespace=""):
+        """
+        Looks a response up.
+
+        Args:
+            instance (dict): the prediction instance, see cache_key
+            namespace (str): see cache_key
+
+        Returns:
+            str: a cached response, None on a miss or while the key has fewer responses than it keeps
+        """
+        key = cache_key(instance, namespace)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._memory[key]
+                entry = None
+            from_disk = False
+            if entry is None:
+                entry = self._load(key, now)
+                from_disk = entry is not None
+                if from_disk:
+                    self._remember(key, entry)
+            else:
+                self._memory.move_to_end(key)
+
+            if entry is None or len(entry[1]) < self._wanted(instance):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += from_disk
+            return random.choice(entry[1])
+
+    def put(self, instance, response, namespace=""):
+        """
+        Adds a response to its key, replacing the oldest one when the key is full. Empty
+        responses are the failed requests and are never cached.
+
+        Args:
+            instance (dict): the prediction instance, see cache_key
+            response (str): the generated text
+            namespace (str): see cache_key
+        """
+        if not response:
+            return
+        key = cache_key(instance, namespace)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key) or self._load(key, now)
+            responses = [cached for cached in (entry[1] if entry else []) if cached != response]
+            responses = (responses + [response])[-self._wanted(instance):]
+            self._remember(key, (now + self.ttl, responses))
+
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                        (key, json.dumps(responses), now + self.ttl, now),
+                    )
+                self._writes += 1
+                if self._writes % TRIM_EVERY == 0:
+                    self._trim(now)
+
+    def _trim(self, now):
+        """Drops the expired rows, then the least recently used ones past max_rows."""
+        with self._connection:
+            self._connection.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,),
+            )
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, hit rate, hits served from disk, memory evictions and keys in memory
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "entries": len(self._memory),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the process-wide response cache, None when RESPONSE_CACHE is "0".
+
+    Returns:
+        ResponseCache: the shared cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None and RESPONSE_CACHE:
+            _cache = ResponseCache()
+    return _cache
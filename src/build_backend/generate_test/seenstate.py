@@ -0,0 +1,107 @@
+"""
+Which questions of a bank one learner hasn't been tested on yet.
+
+The bank itself is shared by every learner of a document, each learner only keeps a permutation
+of the bank's indices whose first `remaining` entries are the unseen questions. Drawing a question
+swaps a random unseen index with the last unseen one and shrinks `remaining`, so a test of k
+questions costs O(k) whatever the size of the bank, duplicates in the bank are tracked separately
+and the bank order is untouched. The state is 4 bytes per question plus a small header.
+
+Note: vendored into build_backend/generate_test, edit this copy and sync the other.
+"""
+import random
+import struct
+
+import numpy as np
+
+# Format version, size of the bank and number of unseen questions
+HEADER = struct.Struct("<BII")
+FORMAT_VERSION = 1
+# Little-endian so states move between hosts
+INDEX_DTYPE = np.dtype("<u4")
+
+
+class SeenState():
+    def __init__(self, size, order=None, remaining=None):
+        """
+        Creates the state of a learner who hasn't seen any question of a bank yet.
+
+        Args:
+            size (int): the number of questions in the bank
+            order (np.ndarray): a permutation of range(size), unseen indices first (deserialization)
+            remaining (int): how many of the indices in order are unseen (deserialization)
+        """
+        self.size = size
+        self.order = np.arange(size, dtype=INDEX_DTYPE) if order is None else order
+        self.remaining = size if remaining is None else remaining
+
+    def draw(self, k, rng=random):
+        """
+        Draws k unseen questions at random and marks them seen, with a partial Fisher-Yates shuffle.
+
+        Args:
+            k (int): how many questions, at most self.remaining
+            rng (random.Random): the source of randomness
+
+        Returns:
+            list[int]: the bank indices of the drawn questions
+        """
+        k = min(k, self.remaining)
+        drawn = []
+        for _ in range(k):
+            pick = rng.randrange(self.remaining)
+            last = self.remaining - 1
+            self.order[pick], self.order[last] = self.order[last], self.order[pick]
+            drawn.append(int(self.order[last]))
+            self.remaining = last
+        return drawn
+
+    def sample(self, k, rng=random):
+        """
+        Draws k distinct questions among all of them, seen or not, without changing the state.
+
+        Returns:
+            list[int]: the bank indices of the drawn questions
+        """
+        # Sampling from a range doesn't materialize it, this stays O(k)
+        return rng.sample(range(self.size), min(k, self.size))
+
+    def grow(self, size):
+        """
+        Adds the questions appended to the bank since the state was made, all unseen.
+
+        Args:
+            size (int): the new number of questions in the bank, at least self.size
+        """
+        added = np.arange(self.size, size, dtype=INDEX_DTYPE)
+        self.order = np.concatenate([self.order[: self.remaining], added, self.order[self.remaining :]])
+        self.remaining += len(added)
+        self.size = size
+
+    def reset(self):
+        """Marks every question unseen again. The permutation stays valid as it is."""
+        self.remaining = self.size
+
+    def to_bytes(self):
+        """
+        Returns:
+            bytes: the compact serialized state, see from_bytes
+        """
+        return HEADER.pack(FORMAT_VERSION, self.size, self.remaining) + self.order.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restores a state serialized with to_bytes.
+
+        Args:
+            data (bytes): the serialized state
+
+        Returns:
+            SeenState: the restored state
+        """
+        version, size, remaining = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unknown seen state format version [{version}]")
+        order = np.frombuffer(data, dtype=INDEX_DTYPE, count=size, offset=HEADER.size).copy()
+        return cls(size, order, remaining)
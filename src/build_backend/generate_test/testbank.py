@@ -0,0 +1,499 @@
+"""
+The LLamaText Generator connects to and sends predictions.
+We want an inference call to be made once per document, reducing cost and later test generation.
+Given we offer multiple services, we create containers for the generates question banks and allow for easy storage and retrival of answers.
+
+Note: vendored into build_backend/generate_test with bankstore.py, seenstate.py and customerrors.py,
+edit this copy and sync the other.
+"""
+
+# General
+from random import choices, randint
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+import threading
+
+# Custom
+from infer import LlamaTextGenerator
+from retrieval import chunk_text
+from bankstore import bank_type, document_hash, get_store
+from seenstate import SeenState
+from customerrors import OverwriteError, DocumentLength, UnknownTestType
+
+# Long documents are split in chunks of about this many characters (about 1.5k tokens), each prompted on its own
+BANK_CHUNK_CHARS = int(os.environ.get("BANK_CHUNK_CHARS", 6000))
+# How many chunk prompts are in flight at once
+BANK_CONCURRENCY = int(os.environ.get("BANK_CONCURRENCY", 8))
+# Questions whose word sets overlap at least this much are the same question asked twice
+DUPLICATE_JACCARD = float(os.environ.get("DUPLICATE_JACCARD", 0.8))
+
+# A numbered question, "3. ...", "Question 3: ..." or "3) ..."
+QUESTION_START = re.compile(r'^\s*(question\s*)?\d+\s*[.):]', re.IGNORECASE)
+# The first option of an MCQ, on a line of its own
+FIRST_OPTION = re.compile(r'^\s*a\)', re.MULTILINE)
+# An MCQ's difficulty, "Difficulty: Easy", "Level of difficulty: Hard" or a bare "Medium"
+DIFFICULTY = re.compile(r'difficulty[^:\n]*:\s*(easy|medium|hard)|^\W*(easy|medium|hard)\W*$', re.IGNORECASE)
+
+# buildBank option -> bank attribute
+BANK_ATTRIBUTES = {
+    'mcq': 'mcqs',
+    'short answer': 'short_answers',
+    'custom': 'custom',
+}
+# Learner of the callers that don't identify their users
+ANONYMOUS_USER = 'anonymous'
+
+# When a learner has fewer unseen questions than this, more are generated in the background
+REFILL_WATERMARK = int(os.environ.get("REFILL_WATERMARK", 5))
+# How many questions one refill asks for, before deduplication
+REFILL_QUESTIONS = int(os.environ.get("REFILL_QUESTIONS", 10))
+# Refills of every TestBank of the process share these workers
+_refiller = ThreadPoolExecutor(max_workers=int(os.environ.get("REFILL_WORKERS", 2)), thread_name_prefix="bank-refill")
+
+class TestBank():
+    def __init__(self, store=None, generator=None):
+        """
+        Args:
+            store (SQLiteBankStore | GCSBankStore): where banks persist across processes, the
+                BANK_STORE configured one by default
+            generator (LlamaTextGenerator): the model connection, a new one by default
+        """
+        # Document info
+        self.text = None
+        self.docHash = None
+        # Resonable number of questions given the document length
+        self.numQuestions = None
+
+        # Create connection to the text service model
+        self.generator = generator if generator is not None else LlamaTextGenerator()
+
+        # Banks already generated for a document, by this process or any other
+        self.store = store if store is not None else get_store()
+        
+        # Original STATIC question banks (mixed will be sampled from mcqs and short_answers)
+        self.mcqs = None
+        self.short_answers = None
+        self.custom = None
+
+        # Per learner record of the questions they haven't been tested on, (bank type, user id) -> SeenState
+        self.seen = {}
+
+        # Options whose bank is being refilled in the background
+        self._refilling = set()
+        self._refillLock = threading.Lock()
+
+        # Constants
+        self.divFactor = 212
+
+    def _validateDocument(self, N):
+        """
+        Check that the document has enough text to test from. If it does, create the right number of questions based on that.
+        """
+        if N < self.divFactor:
+            raise DocumentLength()
+        
+        else:
+            self.numQuestions = round(N / self.divFactor)
+
+    def initalizeText(self, text):
+        """
+        Assigns the document information. Trips on the user's first call to generate a test.
+        """
+        # Make sure this document is long enough to make a test from and assign proper number of questions
+        self._validateDocument(len(text))
+        # Assign to the object only after it passes the validation 
+        self.text = text
+        docHash = document_hash(text)
+
+        # A new document starts from empty banks, its own are loaded or generated on demand
+        if docHash != self.docHash:
+            self.docHash = docHash
+            self.mcqs = None
+            self.short_answers = None
+            self.custom = None
+            self.seen = {}
+
+    def _chunkQuotas(self, chunks):
+        """
+        Shares self.numQuestions between the chunks in proportion to their length, the same
+        one question per divFactor characters as the whole document gets. The rounding is
+        given to the chunks with the largest remainders so the quotas add up exactly.
+        """
+        total = sum(len(chunk) for chunk in chunks)
+        exact = [self.numQuestions * len(chunk) / total for chunk in chunks]
+        quotas = [int(share) for share in exact]
+        byRemainder = sorted(range(len(chunks)), key=lambda i: exact[i] - quotas[i], reverse=True)
+        for i in byRemainder[: self.numQuestions - sum(quotas)]:
+            quotas[i] += 1
+        return quotas
+
+    @staticmethod
+    def _refillQuotas(chunks, numQuestions):
+        """
+        Spreads a refill's questions over chunks drawn at random, weighted by length, so successive
+        refills don't keep prompting the same chunks.
+        """
+        drawn = Counter(choices(range(len(chunks)), weights=[len(chunk) for chunk in chunks], k=numQuestions))
+        return [drawn[i] for i in range(len(chunks))]
+
+    @staticmethod
+    def _mcqItems(blocks):
+        """
+        Bank items of one MCQ answer. The model writes each question, with its options, and its
+        difficulty as two blocks: the difficulty is joined to the question before it, and blocks
+        that aren't questions (an introduction, a stray difficulty) are dropped.
+
+        Args:
+            blocks (list[str]): the answer split on blank lines, see LlamaTextGenerator.generate_questions
+
+        Returns:
+            list[str]: one item per question, "N. question\na) ..\n...\nDifficulty: X"
+        """
+        items = []
+        for block in blocks:
+            block = block.replace('\\n', '\n').strip()
+            if QUESTION_START.match(block) and FIRST_OPTION.search(block):
+                items.append(block)
+            elif items and DIFFICULTY.search(block) and not DIFFICULTY.search(items[-1]):
+                items[-1] = f'{items[-1]}\n{block}'
+        return items
+
+    @staticmethod
+    def _shortAnswerItems(blocks):
+        """
+        Bank items of one short-answer answer: one item per numbered question, whether the model
+        put them in one block or several, without the lines that aren't questions.
+        """
+        return [line.strip() for block in blocks for line in block.split('\n') if QUESTION_START.match(line)]
+
+    def _generateItems(self, option, chunk, quota, fresh=False):
+        """Asks the model for one chunk's questions, as bank items."""
+        if option == 'mcq':
+            return self._mcqItems(self.generator.generate_questions(chunk, quota, fresh=fresh))
+        return self._shortAnswerItems(self.generator.generate_short_answers(chunk, quota, fresh=fresh))
+
+    def _mapChunks(self, generate, refill=False):
+        """
+        Map step: splits the text into context-sized chunks and calls generate(chunk, quota) on
+        each of them concurrently. Short documents are a single chunk, i.e. one call as before.
+
+        Args:
+            generate (callable): (chunk, quota) -> the bank items of the chunk, see _generateItems
+            refill (bool): ask for REFILL_QUESTIONS from random chunks instead of the whole bank
+
+        Returns:
+            list[str]: the questions of all the chunks, in document order
+        """
+        chunks = chunk_text(self.text, BANK_CHUNK_CHARS, overlap=0)
+        quotas = self._refillQuotas(chunks, REFILL_QUESTIONS) if refill else self._chunkQuotas(chunks)
+        work = [(chunk, quota) for chunk, quota in zip(chunks, quotas) if quota > 0]
+
+        # Concurrent calls are coalesced into multi-instance predictions by the generator's batcher
+        with ThreadPoolExecutor(max_workers=max(1, min(BANK_CONCURRENCY, len(work)))) as pool:
+            results = list(pool.map(lambda item: generate(*item), work))
+        return [question for questions in results for question in questions]
+
+    @staticmethod
+    def _normalizeQuestion(question):
+        """Lower case words without the numbering, punctuation and spacing the model varies."""
+        question = re.sub(r'^\W*(question\s*)?\d+\s*[.):-]', '', question.strip(), flags=re.IGNORECASE)
+        return ' '.join(re.findall(r'\w+', question.lower()))
+
+    @classmethod
+    def _dedupe(cls, questions, existing=()):
+        """
+        Reduce step: drops empty items and questions already in the bank, either identical once
+        normalized or with a Jaccard word overlap of at least DUPLICATE_JACCARD. The first copy
+        is kept, in order.
+
+        Args:
+            questions (list[str]): the new questions
+            existing (list[str]): questions already in the bank, never dropped nor returned
+        """
+        seenKeys = set(cls._normalizeQuestion(question) for question in existing)
+        seenWords = [set(key.split()) for key in seenKeys if key]
+        kept = []
+        for question in questions:
+            key = cls._normalizeQuestion(question)
+            if not key or key in seenKeys:
+                continue
+            words = set(key.split())
+            if any(len(words & other) / len(words | other) >= DUPLICATE_JACCARD for other in seenWords):
+                continue
+            kept.append(question)
+            seenKeys.add(key)
+            seenWords.append(words)
+        return kept
+
+    def loadBank(self, option, prompt=None):
+        """
+        Lazily loads one bank of this document from the store, leaving the other types alone.
+
+        Returns:
+            bool: whether the store had the bank
+        """
+        if self.store is None:
+            return False
+        try:
+            questions = self.store.get(self.docHash, bank_type(option, prompt))
+        except Exception as e:
+            # The store is an optimization, generating the bank again is always possible
+            print(f'Could not load the {option} bank: {e}')
+            return False
+        if questions is None:
+            return False
+
+        setattr(self, BANK_ATTRIBUTES[option], questions)
+        return True
+
+    def saveBank(self, option, prompt=None):
+        """
+        Writes one bank to the store.
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.put(self.docHash, bank_type(option, prompt), getattr(self, BANK_ATTRIBUTES[option]))
+        except Exception as e:
+            print(f'Could not save the {option} bank: {e}')
+
+    def seenState(self, option, userId=ANONYMOUS_USER, prompt=None):
+        """
+        The seen state of one learner for one bank: from memory, else from the store, else a fresh one.
+        A state recorded against a bank of another size (the bank was regenerated) starts over.
+
+        Args:
+            option (str): mcq, short answer or custom
+            userId (str): the learner
+            prompt (str): the custom prompt of a custom bank
+
+        Returns:
+            SeenState: the learner's state, shared with later calls
+        """
+        key = (bank_type(option, prompt), userId)
+        size = len(getattr(self, BANK_ATTRIBUTES[option]))
+        state = self.seen.get(key)
+
+        if state is None and self.store is not None:
+            try:
+                data = self.store.get_seen(self.docHash, key[0], userId)
+                state = SeenState.from_bytes(data) if data is not None else None
+            except Exception as e:
+                print(f'Could not load the seen questions of [{userId}]: {e}')
+
+        if state is None or state.size > size:
+            state = SeenState(size)
+        elif state.size < size:
+            # The bank was refilled, the new questions are unseen
+            state.grow(size)
+        self.seen[key] = state
+        return state
+
+    def saveSeenState(self, option, userId=ANONYMOUS_USER, prompt=None):
+        """
+        Writes one learner's seen state of one bank to the store, a few bytes per question.
+        """
+        key = (bank_type(option, prompt), userId)
+        if self.store is None or key not in self.seen:
+            return
+        try:
+            self.store.put_seen(self.docHash, key[0], userId, self.seen[key].to_bytes())
+        except Exception as e:
+            print(f'Could not save the seen questions of [{userId}]: {e}')
+
+    def refillBank(self, option):
+        """
+        Generates more questions from random chunks of the text and appends the new ones to the bank.
+        Appending keeps every learner's seen state valid, they see the new questions as unseen.
+
+        Args:
+            option (str): mcq or short answer
+
+        Returns:
+            int: how many questions were added
+        """
+        if option not in ('mcq', 'short answer'):
+            raise UnknownTestType()
+        bankAttribute = BANK_ATTRIBUTES[option]
+
+        # A cached or greedy response would only give back questions the bank already has, fresh
+        # requests are sampled
+        fresh = lambda chunk, quota: self._generateItems(option, chunk, quota, fresh=True)
+        added = self._dedupe(self._mapChunks(fresh, refill=True), getattr(self, bankAttribute))
+        if added:
+            # Swap in a new list, tests being drawn meanwhile keep indexing the old one
+            setattr(self, bankAttribute, getattr(self, bankAttribute) + added)
+            self.saveBank(option)
+        return len(added)
+
+    def _refillInBackground(self, option):
+        with self._refillLock:
+            if option in self._refilling:
+                return
+            self._refilling.add(option)
+
+        def refill():
+            try:
+                print(f'Refilled the {option} bank with {self.refillBank(option)} questions')
+            except Exception as e:
+                print(f'Could not refill the {option} bank: {e}')
+            finally:
+                with self._refillLock:
+                    self._refilling.discard(option)
+
+        _refiller.submit(refill)
+
+    def buildBank(self, option: str, prompt = None):
+        """
+        Called from the MCQGenerator to build the specific test bank for the test type (expect mixed).
+        MCQs and short answers are generated per chunk of the text concurrently, then deduplicated into one bank.
+        A bank already in the store for this document is loaded instead, and new banks are saved to it.
+
+        Args:
+            option (str): Switches the case for which question bank to build (thus how to prompt the model)
+            prompt (str): IF the developer wants to have a prompt, they can use this argument
+
+        """
+        option = option.lower()
+        if option in BANK_ATTRIBUTES and self.loadBank(option, prompt):
+            return
+
+        if option.lower() == 'mcq':
+            # Create the original question bank, every learner starts with all of it unseen
+            self.mcqs = self._dedupe(self._mapChunks(lambda chunk, quota: self._generateItems('mcq', chunk, quota)))
+
+        elif option.lower() == 'short answer':
+             # Create the original question bank, every learner starts with all of it unseen
+            self.short_answers = self._dedupe(
+                self._mapChunks(lambda chunk, quota: self._generateItems('short answer', chunk, quota))
+            )
+
+        elif option.lower() == 'custom':
+             # Create the original question bank, every learner starts with all of it unseen
+            self.custom = self.generator.generate_custom_prompt_questions(self.text, prompt)
+
+        else:
+            # Something happened during dev
+            raise UnknownTestType()
+
+        # Pay for the inference once per document, across processes and restarts
+        self.saveBank(option, prompt)
+        
+    def drawTest(self, option, numQuestions, repeats, userId=ANONYMOUS_USER):
+        """
+        Draws a test from one bank, loaded or built beforehand. Default behavior is no repeats.
+        Drawing a test costs O(numQuestions) whatever the size of the bank, see SeenState.
+
+        Args:
+            option (str): mcq or short answer
+            numQuestions (int): The number of questions the user wants this test to have.
+            repeats (bool): Indictaes if the user is okay with seeing repeats.
+            userId (str): The learner whose unseen questions the test is drawn from.
+
+        Returns:
+            list[str]: List of questions from the bank.
+        """
+        # Make sure the parameter is some type of singular number
+        try:
+            numQuestions = int(numQuestions)
+
+        except:
+            raise TypeError('Please enter a whole number of how many questions you\'d like for this test')
+        
+        bank = getattr(self, BANK_ATTRIBUTES[option])
+        state = self.seenState(option, userId)
+
+        # If the user has gone through all their unseen questions, reset and inform
+        if not repeats and state.remaining == 0:
+            print('You\'ve completed seen all the questions, congrats! Resetting the set.')
+            state.reset()
+
+        # If the user wants no repeats but they want more questions than we generated for the whole QB, tell them no and fix it
+        if not repeats and len(bank) < numQuestions:
+            print(f'You requested {numQuestions} unique questions, but only {len(bank)} exist')
+            # For now, just make the test shorter, but we could ask the user what they prefer -- repeats or this
+            print('We\'ll generate a shorter test to keep the questions unique.')
+            numQuestions = len(bank)
+
+        # If the user asked for more questions than they have left in the unseen set, let them know and make a test only that big
+        if not repeats and state.remaining < numQuestions:
+            print(f'You only have {state.remaining} unseen questions left. We\'ll make a test out of those first.')
+            numQuestions = state.remaining
+
+        # Check if the user wants repeats or not
+        if repeats:
+            # Generate directly from the originalQB, sampled indices so we don't get repeat questions in the SAME test
+            return [bank[i] for i in state.sample(numQuestions)]
+
+        else:
+            # Swap-remove random unseen indices so we ensure no repeats in this set or bewteen the others
+            testQs = [bank[i] for i in state.draw(numQuestions)]
+            self.saveSeenState(option, userId)
+
+            # Pre-generate more before the learner runs out, not when they ask for the next test
+            if state.remaining < REFILL_WATERMARK:
+                self._refillInBackground(option)
+
+            return testQs
+
+    def generate_mcq_test(self, numQuestions, repeats, userId=ANONYMOUS_USER):
+        """
+        Generates the MCQ test by pulling from the created bank. Default behavior is no repeats, 10 questions.
+
+        Args:
+            numQuestions (int): The number of questions the user wants this test to have.
+            repeats (bool): Indictaes if the user is okay with seeing repeats.
+            userId (str): The learner whose unseen questions the test is drawn from.
+
+        Returns:
+            list[str]: List of multiple choice questions.
+        """
+        return self.drawTest('mcq', numQuestions, repeats, userId)
+
+    def generate_short_answer_test(self, numQuestions, repeats, userId=ANONYMOUS_USER):
+        """
+        Generates the short answer test by pulling from the created bank. Default behavior is no repeats, 10 question.
+
+        Args:
+            numQuestions (int): The number of questions the user wants this test to have.
+            repeats (bool): Indictaes if the user is okay with seeing repeats.
+            userId (str): The learner whose unseen questions the test is drawn from.
+
+        Returns:
+            list[str]: List of short answer questions.
+        """
+        return self.drawTest('short answer', numQuestions, repeats, userId)
+
+
+    def generate_mixed_test(self, numQuestions, repeats):
+        """
+        Generates a mix of MCQs and short answers. Default behavior is no repeats, 10 questions.
+
+        Args:
+            numQuestions (int): The number of questions the user wants this test to have.
+            repeats (bool): Indictaes if the user is okay with seeing repeats.
+
+        Returns:
+            list[str]: List of mixed questions.
+        """
+        # mcqs = self.generate_questions(text, max_length)
+        # short_answers = self.generate_short_answers(text, max_length)
+
+        # # Interleave MCQs and short answers or just concatenate, based on your preference
+        # mixed_questions = mcqs + short_answers
+        # return mixed_questions
+        raise NotImplementedError('Generating the mixed format test in [TestBank] is not finished yet.')
+
+    def generate_custom_test(self, repeats):
+        """
+        Generates a test based on a custom prompt. Default behavior is no repeats.
+
+        Args:
+            repeats (bool): Indictaes if the user is okay with seeing repeats.
+
+        Returns:
+            list[str]: List of mixed questions.
+        """
+        raise NotImplementedError('Generating the custom prompt test in [TestBank] is not finished yet.')
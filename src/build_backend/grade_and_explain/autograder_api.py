@@ -1,26 +1,29 @@
 #!/usr/bin/env python3
 
-import PyPDF2
-from docx import Document
-import textract
 import os
-import tempfile
 import re
 import json
 import warnings
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from infer_explanation import (
     ExplanationGenerator,
 )  # Import the ExplanationGenerator class
 
 # Imports for GCP
-from google.cloud import storage
-from io import BytesIO
+from gcp import Bucket
+from response_cache import get_cache
+from extraction import extract_docx, extract_pdf, extract_text, extract_texts, iter_page_records, ndjson_lines
 from flask_cors import cross_origin, CORS
 
 app = Flask(__name__)
 CORS(app)
 
+# Service account used for every bucket call, the client behind it is shared process-wide
+KEY_PATH = "secrets/generate_mcq_account_key.json"
+# Where /extract-text reads the documents from, shared with the prewarm worker
+DOCUMENTS_BUCKET = os.environ.get("DOCUMENTS_BUCKET", "bite-size-documents")
+DOCUMENTS_FOLDER = os.environ.get("DOCUMENTS_FOLDER", "documents_to_be_summarized")
+
 
 class Autograder:
     def __init__(self):
@@ -35,14 +38,12 @@ class Autograder:
         Extract text from a PDF file.
 
         Args:
-            pdf_file_content (BytesIO): Content of the PDF file.
+            pdf_file_content (bytes | BytesIO): Content of the PDF file.
 
         Returns:
             str: Extracted text from the PDF file.
         """
-        pdf_reader = PyPDF2.PdfReader(pdf_file_content)
-        text = "".join([page.extract_text() for page in pdf_reader.pages])
-        return text
+        return extract_pdf(pdf_file_content)
 
     @staticmethod
     def extract_text_from_docx(docx_file_content):
@@ -50,28 +51,27 @@ class Autograder:
         Extract text from a DOCX file.
 
         Args:
-            docx_file_content (BytesIO): Content of the DOCX file.
+            docx_file_content (bytes | BytesIO): Content of the DOCX file.
 
         Returns:
             str: Extracted text from the DOCX file.
         """
-        doc = Document(docx_file_content)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        return extract_docx(docx_file_content)
 
     @staticmethod
-    def extract_text_from_other_formats(file_content):
+    def extract_text_from_other_formats(file_content, file_name=None):
         """
-        Extract text from other file formats using textract.
+        Extract text from other file formats (txt, md, html, rtf, pptx, odt ...),
+        detected from the content and parsed in memory. textract is only the last resort.
 
         Args:
-            file_content (BytesIO): Content of the file.
+            file_content (bytes | BytesIO): Content of the file.
+            file_name (str): Original file name, lets textract pick its parser.
 
         Returns:
             str: Extracted text from the file.
         """
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            temp_file.write(file_content.read())
-            return textract.process(temp_file.name).decode("utf-8")
+        return extract_text(file_content, file_name)
 
     def grade_user_answers(self, user_answers, llm_output):
         """
@@ -198,11 +198,7 @@ class Autograder:
         Returns:
             list: List of file names in the specified folder.
         """
-        KEY_PATH = "secrets/generate_mcq_account_key.json"
-        storage_client = storage.Client.from_service_account_json(KEY_PATH)
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=folder_name)
-        return [blob.name for blob in blobs if not blob.name.endswith("/")]
+        return Bucket(KEY_PATH, bucket_name).list_files(folder_name)
 
     @staticmethod
     def get_file_from_gcp_bucket(bucket_name, file_name):
@@ -216,14 +212,7 @@ class Autograder:
         Returns:
             bytes: Content of the file as bytes.
         """
-        KEY_PATH = "secrets/generate_mcq_account_key.json"
-        storage_client = storage.Client.from_service_account_json(KEY_PATH)
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-
-        # Download as bytes
-        content = blob.download_as_bytes()
-        return content
+        return Bucket(KEY_PATH, bucket_name).get_file(file_name)
 
     @staticmethod
     def load_user_answers_from_gcp(bucket_name, answers_file_name):
@@ -248,32 +237,29 @@ class Autograder:
     
         This endpoint processes files with '.pdf' and '.docx' extensions found within the specified
         folder in the bucket and returns the concatenated text from all processed files.
+        With `?stream=ndjson` the text is streamed instead, one JSON line per page as it is parsed.
     
         Returns:
             A JSON response containing the extracted text or an error message.
         """
         try:
-            text_generator = Autograder()
-            bucket_name = "bite-size-documents"
-            folder_name = "documents_to_be_summarized"
-            files = text_generator.list_files_in_gcp_bucket(bucket_name, folder_name)
+            bucket_name = DOCUMENTS_BUCKET
+            folder_name = DOCUMENTS_FOLDER
+            bucket = Bucket(KEY_PATH, bucket_name)
     
-            parsed_texts = []
+            # Listed blobs carry their MD5, so cached documents are neither downloaded nor parsed again
+            files = bucket.list_blobs(folder_name)
     
-            # Parsing different file formats and extracting text
-            for file_name in files:
-                _, extension = os.path.splitext(file_name)
-                file_content = text_generator.get_file_from_gcp_bucket(bucket_name, file_name)
-                file_in_memory = BytesIO(file_content)  # Create a BytesIO object from the content
+            # ?stream=ndjson sends one line per page as soon as it is decoded, instead of one body at the end
+            if request.args.get("stream") == "ndjson":
+                records = iter_page_records(bucket, files)
+                return Response(
+                    stream_with_context(ndjson_lines(records)),
+                    mimetype="application/x-ndjson",
+                )
     
-                # Pass the BytesIO object directly to the extraction functions
-                if extension == ".pdf":
-                    parsed_texts.append(text_generator.extract_text_from_pdf(file_in_memory))
-                elif extension == ".docx":
-                    parsed_texts.append(text_generator.extract_text_from_docx(file_in_memory))
-                else:
-                    app.logger.error(f"Unsupported file format: {extension}")
-                    continue  # Skip unsupported files
+            # Downloads and parsing overlap, results come back in the order of the files
+            parsed_texts = extract_texts(bucket, files)
     
             response = {"document_text": parsed_texts}
             return jsonify(response)
@@ -372,19 +358,10 @@ class Autograder:
         if not folder_name.endswith("/"):
             folder_name += "/"
     
-        # Initialize the GCP Storage client
-        client = storage.Client(project="ac215-bitesize")
-        bucket = client.bucket(bucket_name)
+        # Delete the objects through the shared client, excluding the folder placeholder
+        deleted = Bucket(None, bucket_name).delete_folder(folder_name)
     
-        # List all objects in the specified folder
-        blobs = list(client.list_blobs(bucket, prefix=folder_name))
-        blobs_to_delete = [
-            blob for blob in blobs if blob.name != folder_name
-        ]  # Exclude the folder placeholder
-    
-        if blobs_to_delete:
-            # Delete the objects, excluding the folder placeholder
-            bucket.delete_blobs(blobs_to_delete)
+        if deleted:
             return (
                 f"Successfully deleted all objects in folder {folder_name} from bucket {bucket_name}",
                 200,
@@ -392,6 +369,12 @@ class Autograder:
         else:
             return f"No objects found in folder {folder_name} in bucket {bucket_name}", 404
 
+    @app.route("/response-cache", methods=["GET"])
+    def response_cache_stats():
+        """Hit rate of this process's LLM response cache, see response_cache.py."""
+        cache = get_cache()
+        return jsonify(cache.stats() if cache is not None else {"enabled": False})
+
 
 
 # if __name__ == "__main__":
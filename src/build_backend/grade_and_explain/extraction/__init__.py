@@ -0,0 +1,36 @@
+"""
+Document text extraction shared by every service.
+
+Formats are detected from their magic bytes by a registry of handlers, every handler takes the same
+zero-copy input (a memoryview, see as_buffer) and extraction time is recorded per format. On top
+of the handlers sit the bucket pipeline (concurrent download + parse) and the extraction cache.
+
+Note: this package is vendored into each service directory, since each one is its own Docker build
+context. Edit the copy in src/preprocessing_question_gen and sync the others.
+"""
+from .buffer import BufferStream, as_buffer
+from .metrics import timings
+from .registry import (
+    UnsupportedFormat,
+    detect_format,
+    extract_text,
+    handler_for,
+    iter_pages,
+    register,
+    supported_formats,
+)
+
+# Importing the handler modules registers them, natives first and the fallback last
+from .pdf import count_pages, extract_pdf, iter_pdf_pages
+from .office import extract_docx, extract_odt, extract_pptx, iter_pptx_slides
+from .text import extract_html, extract_plain_text, extract_rtf
+from .fallback import extract_with_textract
+
+from .cache import ExtractionCache, get_cache
+from .pipeline import (
+    extract_pdf_parallel,
+    extract_texts,
+    iter_extracted_texts,
+    iter_page_records,
+    ndjson_lines,
+)
@@ -0,0 +1,165 @@
+"""
+Compares the native in-memory handlers with the textract fallback on the same documents.
+
+    python -m extraction.benchmark                     # synthetic txt, md, html, rtf, pptx, odt
+    python -m extraction.benchmark notes.pptx a.odt    # real documents
+    python -m extraction.benchmark --repeat 20 --size 200
+
+The synthetic pptx/odt are minimal archives the native handlers accept, textract's parsers may
+reject them, pass real documents to compare those formats.
+"""
+import argparse
+import io
+import os
+import statistics
+import zipfile
+from xml.sax.saxutils import escape
+
+from . import fallback
+from .registry import detect_format, extract_timed
+
+PARAGRAPH = (
+    "Photosynthesis converts light energy into chemical energy stored in glucose. "
+    "It takes place in the chloroplasts & uses water and carbon dioxide."
+)
+
+
+def _zip(members):
+    """Builds a ZIP archive in memory, members stored in the given order."""
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w") as archive:
+        for name, data, compression in members:
+            archive.writestr(name, data, compress_type=compression)
+    return output.getvalue()
+
+
+def sample_documents(paragraphs):
+    """
+    Builds one synthetic document per native format.
+
+    Args:
+        paragraphs (int): number of paragraphs (slides for pptx) in each document
+
+    Returns:
+        dict: file name -> bytes
+    """
+    lines = [f"{i}. {PARAGRAPH}" for i in range(paragraphs)]
+
+    html = "<!DOCTYPE html><html><head><style>p {color: red}</style></head><body>"
+    html += "".join(f"<p>{escape(line)}</p>" for line in lines) + "</body></html>"
+
+    rtf = r"{\rtf1\ansi{\fonttbl{\f0 Times;}}\f0 " + "".join(
+        line.replace("&", r"\'26") + r"\par " for line in lines
+    ) + "}"
+
+    slide = (
+        '<p:sld xmlns:p="http://schemas.openxmlformats.org/presentationml/2006/main" '
+        'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"><p:cSld><p:spTree>'
+        "<p:sp><p:txBody><a:p><a:r><a:t>{}</a:t></a:r></a:p></p:txBody></p:sp>"
+        "</p:spTree></p:cSld></p:sld>"
+    )
+    pptx = _zip(
+        [("ppt/presentation.xml", "<presentation/>", zipfile.ZIP_DEFLATED)]
+        + [
+            (f"ppt/slides/slide{i + 1}.xml", slide.format(escape(line)), zipfile.ZIP_DEFLATED)
+            for i, line in enumerate(lines)
+        ]
+    )
+
+    content = (
+        '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+        'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0"><office:body><office:text>'
+        + "".join(f"<text:p>{escape(line)}</text:p>" for line in lines)
+        + "</office:text></office:body></office:document-content>"
+    )
+    odt = _zip(
+        [
+            ("mimetype", "application/vnd.oasis.opendocument.text", zipfile.ZIP_STORED),
+            ("content.xml", content, zipfile.ZIP_DEFLATED),
+        ]
+    )
+
+    return {
+        "sample.txt": "\n".join(lines).encode(),
+        "sample.md": ("# Biology\n\n" + "\n\n".join(f"- **{line}**" for line in lines)).encode(),
+        "sample.html": html.encode(),
+        "sample.rtf": rtf.encode(),
+        "sample.pptx": pptx,
+        "sample.odt": odt,
+    }
+
+
+def _time(content, file_name, format, repeat):
+    """
+    Returns:
+        tuple[float, int]: median milliseconds and length of the extracted text, (None, error) on failure
+    """
+    seconds = []
+    for _ in range(repeat):
+        try:
+            _, elapsed, text = extract_timed(content, file_name, format)
+        except Exception as e:
+            return None, type(e).__name__
+        seconds.append(elapsed)
+    return statistics.median(seconds) * 1000, len(text)
+
+
+def run(documents, repeat):
+    """
+    Times every document with its native handler and with textract.
+
+    Args:
+        documents (dict): file name -> bytes
+        repeat (int): runs per document and path, the median is reported
+
+    Returns:
+        list[dict]: one row per document
+    """
+    rows = []
+    for file_name, content in documents.items():
+        handler = detect_format(content, file_name)
+        native = handler.name if handler is not None else None
+
+        row = {"file": file_name, "format": native, "bytes": len(content)}
+        if native is not None and native != "textract":
+            row["native_ms"], row["native_chars"] = _time(content, file_name, native, repeat)
+        if fallback.textract is not None:
+            row["textract_ms"], row["textract_chars"] = _time(content, file_name, "textract", repeat)
+        rows.append(row)
+    return rows
+
+
+def _cell(value):
+    if value is None:
+        return "-"
+    return f"{value:.2f}" if isinstance(value, float) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="documents to extract, synthetic samples if omitted")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per document and path")
+    parser.add_argument("--size", type=int, default=100, help="paragraphs per synthetic document")
+    args = parser.parse_args()
+
+    if args.files:
+        documents = {}
+        for path in args.files:
+            with open(path, "rb") as file:
+                documents[os.path.basename(path)] = file.read()
+    else:
+        documents = sample_documents(args.size)
+
+    if fallback.textract is None:
+        print("textract is not installed, only the native path is timed")
+
+    columns = ["file", "format", "bytes", "native_ms", "native_chars", "textract_ms", "textract_chars"]
+    rows = [[_cell(row.get(column)) for column in columns] for row in run(documents, args.repeat)]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Office document handlers: Office Open XML (docx, pptx) and OpenDocument text (odt).
+
+pptx and odt are read straight from the ZIP archive with the standard library.
+"""
+import re
+import zipfile
+from xml.etree import ElementTree
+
+from docx import Document
+
+from .buffer import BufferStream, as_buffer
+from .registry import register, zip_names
+
+# XML namespaces
+_DRAWINGML = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_ODF_TEXT = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+
+_SLIDE_NAME = re.compile(r"ppt/slides/slide(\d+)\.xml$")
+
+
+def is_docx(buffer, file_name=None):
+    """DOCX files are ZIP archives holding word/document.xml."""
+    return "word/document.xml" in zip_names(buffer)
+
+
+def extract_docx(docx_file_content, file_name=None):
+    """
+    Extracts text from a DOCX file content.
+
+    Args:
+        docx_file_content: Content of the DOCX file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the DOCX file.
+    """
+    doc = Document(BufferStream(as_buffer(docx_file_content)))
+    return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+
+
+register("docx", is_docx, extract_docx)
+
+
+# PowerPoint
+
+
+def is_pptx(buffer, file_name=None):
+    """PPTX files are ZIP archives holding ppt/presentation.xml."""
+    return "ppt/presentation.xml" in zip_names(buffer)
+
+
+def iter_pptx_slides(pptx_file_content, file_name=None):
+    """
+    Extracts text from a PPTX one slide at a time, slides are the pages of a presentation.
+
+    Args:
+        pptx_file_content: Content of the PPTX file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Yields:
+        tuple[int, str]: (slide number starting at 1, text of that slide, one line per paragraph)
+    """
+    with zipfile.ZipFile(BufferStream(as_buffer(pptx_file_content))) as archive:
+        slides = []
+        for name in archive.namelist():
+            match = _SLIDE_NAME.match(name)
+            if match:
+                slides.append((int(match.group(1)), name))
+        # slide10.xml sorts before slide2.xml as a string, order by the number
+        slides.sort()
+        for slide_no, (_, name) in enumerate(slides, 1):
+            root = ElementTree.fromstring(archive.read(name))
+            paragraphs = (
+                "".join(run.text or "" for run in paragraph.iter(f"{_DRAWINGML}t"))
+                for paragraph in root.iter(f"{_DRAWINGML}p")
+            )
+            yield slide_no, "\n".join(text for text in paragraphs if text)
+
+
+def join_slides(texts):
+    """The text of a presentation from its slides': a blank line between slides, empty ones dropped."""
+    return "\n\n".join(text for text in texts if text)
+
+
+def extract_pptx(pptx_file_content, file_name=None):
+    """
+    Extracts text from a PPTX file content.
+
+    Args:
+        pptx_file_content: Content of the PPTX file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the PPTX file, slides separated by a blank line.
+    """
+    return join_slides(text for _, text in iter_pptx_slides(pptx_file_content))
+
+
+register("pptx", is_pptx, extract_pptx, iter_pptx_slides, join_slides)
+
+
+# OpenDocument text
+
+_ODT_MIMETYPE = b"application/vnd.oasis.opendocument.text"
+
+
+def is_odt(buffer, file_name=None):
+    """
+    ODT files are ZIP archives whose first member is an uncompressed "mimetype" file, so the
+    mimetype sits at a fixed offset (30 bytes of local header + the 8 byte name).
+    """
+    return bytes(buffer[30:38]) == b"mimetype" and bytes(buffer[38 : 38 + len(_ODT_MIMETYPE)]) == _ODT_MIMETYPE
+
+
+def _odf_text(element):
+    """The text of an ODF paragraph, with its spacing elements expanded."""
+    parts = [element.text or ""]
+    for child in element:
+        if child.tag == f"{_ODF_TEXT}s":
+            parts.append(" " * int(child.get(f"{_ODF_TEXT}c", 1)))
+        elif child.tag == f"{_ODF_TEXT}tab":
+            parts.append("\t")
+        elif child.tag == f"{_ODF_TEXT}line-break":
+            parts.append("\n")
+        elif child.tag not in (f"{_ODF_TEXT}p", f"{_ODF_TEXT}h"):
+            # Spans, links ... nested paragraphs (in notes, frames) are collected on their own
+            parts.append(_odf_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def extract_odt(odt_file_content, file_name=None):
+    """
+    Extracts text from an ODT file content, headings and paragraphs in document order.
+
+    Args:
+        odt_file_content: Content of the ODT file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the ODT file.
+    """
+    with zipfile.ZipFile(BufferStream(as_buffer(odt_file_content))) as archive:
+        root = ElementTree.fromstring(archive.read("content.xml"))
+    blocks = (f"{_ODF_TEXT}p", f"{_ODF_TEXT}h")
+    return "\n".join(_odf_text(element) for element in root.iter() if element.tag in blocks)
+
+
+register("odt", is_odt, extract_odt)
@@ -0,0 +1,325 @@
+"""
+Pipelined text extraction for a bucket folder.
+
+Downloads run on a bounded thread pool while the CPU-bound parsing runs on a process pool,
+so network wait and PDF parsing overlap. At most `max_in_flight` documents are held between
+download and parse at any time, which keeps a large folder from being loaded into RAM at once,
+and results are always handed back in the order of the input file list. Documents found in the
+extraction cache skip both the download and the parser.
+
+For clients that want to start before a long document is fully parsed, iter_page_records streams
+the same folder page by page, and ndjson_lines serialises those records for a chunked response.
+"""
+import json
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from .cache import ExtractionCache, get_cache
+from .metrics import timings
+from .pdf import is_pdf, submit_pdf
+from .registry import UnsupportedFormat, extract_timed, handler_for, iter_pages
+
+# Tunables, all overridable per call
+DOWNLOAD_WORKERS = int(os.environ.get("EXTRACT_DOWNLOAD_WORKERS", 8))
+PARSE_WORKERS = int(os.environ.get("EXTRACT_PARSE_WORKERS", os.cpu_count() or 1))
+MAX_IN_FLIGHT = int(os.environ.get("EXTRACT_MAX_IN_FLIGHT", 16))
+
+logger = logging.getLogger(__name__)
+
+# Pools are created lazily and reused across requests, spawning processes per request is expensive
+_download_pool = None
+_parse_pool = None
+_pools_lock = threading.Lock()
+
+
+def _pools():
+    """Returns the shared (download, parse) executors, creating them on first use."""
+    global _download_pool, _parse_pool
+    with _pools_lock:
+        if _download_pool is None:
+            _download_pool = ThreadPoolExecutor(
+                DOWNLOAD_WORKERS, thread_name_prefix="extract-download"
+            )
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(PARSE_WORKERS)
+    return _download_pool, _parse_pool
+
+
+def parse_document(file_name, content):
+    """
+    Runs inside a worker process: extracts a single document with the handler matching its content.
+
+    Args:
+        file_name (str): the full filename, only a hint for the fallback handler
+        content (bytes): the raw file content
+
+    Returns:
+        tuple[str, float, str]: (format name, seconds, parsed text), text is None if the format
+            isn't supported
+    """
+    try:
+        return extract_timed(content, file_name)
+    except UnsupportedFormat:
+        return None, 0.0, None
+
+
+def extract_pdf_parallel(content, **kwargs):
+    """
+    Extracts text from a PDF on the shared process pool, falling back to serial for small files.
+
+    Args:
+        content (bytes): the raw PDF
+        **kwargs: forwarded to submit_pdf (page-count threshold, pages per task)
+
+    Returns:
+        str: Extracted text from the PDF file.
+    """
+    _, parse_pool = _pools()
+    name, seconds, text = submit_pdf(parse_pool, content, **kwargs).result()
+    timings.record(name, seconds, len(content))
+    return text
+
+
+def _name(item):
+    """File name of a listed blob or of a plain name."""
+    return getattr(item, "name", item)
+
+
+def _done(value):
+    """Wraps an already known result in a completed future."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def _download(bucket, item):
+    """Downloads a listed blob or a named file."""
+    if hasattr(item, "download_as_bytes"):
+        return item.download_as_bytes()
+    return bucket.get_file(item)
+
+
+def _fetch_and_submit(bucket, item, key, parse_pool, cache):
+    """
+    Downloads one file (on a download thread) and hands it to the parse pool.
+
+    Returns:
+        tuple[str, bool, Future, int]: the cache key, whether the text still has to be cached, a
+            future resolving to (format, seconds, text), and the document size
+    """
+    content = _download(bucket, item)
+
+    # No usable metadata (plain name or composite object), address the entry by content instead
+    if key is None:
+        key = ExtractionCache.key_for_content(content)
+        text = cache.get(key)
+        if text is not None:
+            return key, False, _done((None, 0.0, text)), 0
+
+    # Large PDFs are split into page ranges across the pool
+    if is_pdf(memoryview(content)):
+        return key, True, submit_pdf(parse_pool, content), len(content)
+    return key, True, parse_pool.submit(parse_document, _name(item), content), len(content)
+
+
+def iter_extracted_texts(
+    bucket,
+    files,
+    download_workers=None,
+    parse_workers=None,
+    max_in_flight=MAX_IN_FLIGHT,
+    cache=None,
+):
+    """
+    Extracts text from every file, yielding results in the original order as they become available.
+
+    A window of at most `max_in_flight` documents is kept between download and parse. Once the
+    window is full the oldest document has to be parsed and yielded before the next download
+    is started, which is the backpressure that bounds memory use.
+
+    Args:
+        bucket (Bucket): the instantiated custom GCP Bucket object
+        files (list[str | storage.Blob]): file names or listed blobs, in the order results should
+            come back. Listed blobs carry their MD5, so cache hits skip the download entirely
+        download_workers (int): size of a dedicated download pool, None to use the shared one
+        parse_workers (int): size of a dedicated parse pool, None to use the shared one
+        max_in_flight (int): the maximum number of documents held in memory at once
+        cache (ExtractionCache): the extraction cache, None to use the process-wide one
+
+    Yields:
+        tuple[str, str]: (file name, parsed text); unsupported formats yield None as the text
+    """
+    max_in_flight = max(1, max_in_flight)
+    cache = cache if cache is not None else get_cache(bucket)
+    owned = []
+
+    if download_workers is None or parse_workers is None:
+        shared_download, shared_parse = _pools()
+    if download_workers is None:
+        download_pool = shared_download
+    else:
+        download_pool = ThreadPoolExecutor(download_workers)
+        owned.append(download_pool)
+    if parse_workers is None:
+        parse_pool = shared_parse
+    else:
+        parse_pool = ProcessPoolExecutor(parse_workers)
+        owned.append(parse_pool)
+
+    pending = deque()
+    try:
+        for item in files:
+            # Window is full, the oldest document has to finish before we download another
+            while len(pending) >= max_in_flight:
+                yield _collect(cache, *pending.popleft())
+
+            # Listed blobs can be looked up before anything is downloaded
+            key = ExtractionCache.key_for_blob(item) if hasattr(item, "md5_hash") else None
+            text = cache.get(key) if key is not None else None
+            if text is not None:
+                pending.append((_name(item), _done((key, False, _done((None, 0.0, text)), 0))))
+                continue
+
+            pending.append(
+                (_name(item), download_pool.submit(_fetch_and_submit, bucket, item, key, parse_pool, cache))
+            )
+
+        while pending:
+            yield _collect(cache, *pending.popleft())
+
+    finally:
+        # If the consumer stops early, don't leave queued downloads behind
+        for _, future in pending:
+            future.cancel()
+        for pool in owned:
+            pool.shutdown(wait=False)
+
+
+def _collect(cache, file_name, download_future):
+    """Waits for a document to be downloaded and parsed, caches it and returns (file name, text)."""
+    key, store, parse_future, num_bytes = download_future.result()
+    format_name, seconds, text = parse_future.result()
+    if format_name is not None:
+        # Workers time themselves, aggregate here where the metrics are read
+        timings.record(format_name, seconds, num_bytes)
+    if store and text is not None:
+        cache.put(key, text)
+    return file_name, text
+
+
+def extract_texts(bucket, files, **kwargs):
+    """
+    Extracts text from every supported file, in the original order.
+
+    Args:
+        bucket (Bucket): the instantiated custom GCP Bucket object
+        files (list[str | storage.Blob]): the file names or listed blobs to extract
+        **kwargs: forwarded to iter_extracted_texts (concurrency limits, cache)
+
+    Returns:
+        list[str]: the parsed text of every supported file
+    """
+    parsed_texts = []
+    for file_name, text in iter_extracted_texts(bucket, files, **kwargs):
+        if text is None:
+            # Warn the user the file isn't supported, but don't stop the execution
+            logger.error(f"Unsupported file format: {os.path.splitext(file_name)[1]}")
+            continue
+        parsed_texts.append(text)
+
+    cache = kwargs.get("cache") or get_cache(bucket)
+    logger.info(f"Extraction cache: {cache.stats()}, timings: {timings.stats()}")
+    return parsed_texts
+
+
+def iter_page_records(bucket, files, max_in_flight=MAX_IN_FLIGHT, cache=None):
+    """
+    Streams the text of every file page by page, in the original file order.
+
+    Downloads are prefetched on the shared download pool (at most `max_in_flight` documents
+    ahead) while pages are parsed on the calling thread and handed out as soon as each is decoded.
+
+    Args:
+        bucket (Bucket): the instantiated custom GCP Bucket object
+        files (list[str | storage.Blob]): file names or listed blobs
+        max_in_flight (int): the maximum number of downloaded documents held in memory at once
+        cache (ExtractionCache): the extraction cache, None to use the process-wide one
+
+    Yields:
+        dict: {"file", "page", "text"} per page, then {"file", "done": True, "pages"} per document,
+            or {"file", "error"} for a document that couldn't be downloaded or parsed. A cached document arrives
+            as one record with "page" set to None.
+    """
+    max_in_flight = max(1, max_in_flight)
+    cache = cache if cache is not None else get_cache(bucket)
+    download_pool, _ = _pools()
+    pending = deque()
+
+    def _stream(name, key, text, future):
+        if text is None:
+            try:
+                content = future.result()
+            except Exception as e:
+                logger.error(f"Could not download [{name}]: {e}")
+                yield {"file": name, "error": str(e)}
+                return
+            # No usable metadata, address the entry by content instead
+            if key is None:
+                key = ExtractionCache.key_for_content(content)
+                text = cache.get(key)
+
+        if text is not None:
+            yield {"file": name, "page": None, "text": text}
+            yield {"file": name, "done": True, "pages": None}
+            return
+
+        pages = []
+        try:
+            handler = handler_for(content, name)
+            for page_no, page_text in iter_pages(content, name, handler.name):
+                pages.append(page_text)
+                yield {"file": name, "page": page_no, "text": page_text}
+        except Exception as e:
+            logger.error(f"Could not parse [{name}]: {e}")
+            yield {"file": name, "error": str(e)}
+            return
+
+        # Joined as the whole-document extractor joins them, whichever path fills the cache
+        cache.put(key, handler.join_pages(pages))
+        yield {"file": name, "done": True, "pages": len(pages)}
+
+    try:
+        for item in files:
+            while len(pending) >= max_in_flight:
+                yield from _stream(*pending.popleft())
+
+            # Listed blobs can be looked up before anything is downloaded
+            key = ExtractionCache.key_for_blob(item) if hasattr(item, "md5_hash") else None
+            text = cache.get(key) if key is not None else None
+            future = download_pool.submit(_download, bucket, item) if text is None else None
+            pending.append((_name(item), key, text, future))
+
+        while pending:
+            yield from _stream(*pending.popleft())
+
+    finally:
+        for *_, future in pending:
+            if future is not None:
+                future.cancel()
+
+
+def ndjson_lines(records):
+    """
+    Serialises records as newline-delimited JSON for a chunked HTTP response.
+
+    Args:
+        records (iterable[dict]): e.g. the output of iter_page_records
+
+    Yields:
+        str: one JSON document per line
+    """
+    for record in records:
+        yield json.dumps(record) + "\n"
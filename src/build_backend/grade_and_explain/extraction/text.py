@@ -0,0 +1,239 @@
+"""
+Handlers for text based formats: RTF, HTML and plain text (which covers Markdown).
+All of them work on the in-memory buffer, no temp file and no subprocess.
+"""
+import codecs
+import re
+from html.parser import HTMLParser
+
+from .registry import register, starts_with
+
+# Bytes looked at when sniffing text formats
+SNIFF_BYTES = 8192
+
+
+def _decode(buffer):
+    """Decodes a text document, UTF-8 (with or without BOM) first, then Latin-1 which never fails."""
+    data = bytes(buffer)
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+# RTF
+
+
+def is_rtf(buffer, file_name=None):
+    """RTF files start with {\\rtf."""
+    return starts_with(buffer, b"{\\rtf")
+
+
+# Groups whose content is metadata, not document text. Newer optional groups are marked with \*
+# and skipped through that instead.
+_RTF_DESTINATIONS = {
+    "author", "buptim", "colortbl", "comment", "creatim", "doccomm", "fldinst", "fonttbl",
+    "footer", "footerf", "footerl", "footerr", "footnote", "ftncn", "ftnsep", "ftnsepc",
+    "header", "headerf", "headerl", "headerr", "info", "keycode", "keywords", "listtable",
+    "listoverridetable", "listtext", "object", "objdata", "operator", "pict", "pntext",
+    "pntxta", "pntxtb", "printim", "private", "revtbl", "revtim", "rsidtbl", "stylesheet",
+    "subject", "themedata", "title", "xmlnstbl",
+}
+
+# Control words that stand for a character
+_RTF_SPECIALS = {
+    "par": "\n", "sect": "\n\n", "page": "\n\n", "line": "\n", "tab": "\t",
+    "emdash": "\u2014", "endash": "\u2013", "emspace": "\u2003", "enspace": "\u2002",
+    "qmspace": "\u2005", "bullet": "\u2022", "lquote": "\u2018", "rquote": "\u2019",
+    "ldblquote": "\u201c", "rdblquote": "\u201d", "cell": " ", "row": "\n",
+}
+
+_RTF_TOKEN = re.compile(
+    r"\\([a-zA-Z]{1,32})(-?\d{1,10})? ?|\\'([0-9a-fA-F]{2})|\\([^a-zA-Z])|([{}])|[\r\n]+|(.)",
+    re.S,
+)
+
+
+def extract_rtf(buffer, file_name=None):
+    """
+    Extracts text from an RTF document with a single pass over its control words.
+
+    Args:
+        buffer (memoryview): Content of the RTF file.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the RTF file.
+    """
+    # RTF is 7-bit, 8-bit characters come as \'xx escapes in the document code page
+    document = bytes(buffer).decode("latin-1")
+
+    stack = []
+    ignorable = False
+    # Characters to skip after a \uN escape, the ANSI replacement RTF writers add
+    uc_skip = 1
+    skip = 0
+    out = []
+
+    pos = 0
+    while pos < len(document):
+        # Every position matches, the last alternative takes any single character
+        match = _RTF_TOKEN.match(document, pos)
+        pos = match.end()
+        word, arg, hex_code, symbol, brace, char = match.groups()
+
+        if brace:
+            skip = 0
+            if brace == "{":
+                stack.append((uc_skip, ignorable))
+            elif stack:
+                uc_skip, ignorable = stack.pop()
+
+        elif symbol:
+            skip = 0
+            if symbol == "~":
+                if not ignorable:
+                    out.append("\xa0")
+            elif symbol in "{}\\":
+                if not ignorable:
+                    out.append(symbol)
+            elif symbol == "*":
+                ignorable = True
+
+        elif word:
+            skip = 0
+            if word == "bin":
+                # \binN is followed by N bytes of binary data, in ignored groups too
+                pos += max(0, int(arg)) if arg is not None else 0
+            elif word in _RTF_DESTINATIONS:
+                ignorable = True
+            elif ignorable:
+                pass
+            elif word in _RTF_SPECIALS:
+                out.append(_RTF_SPECIALS[word])
+            elif word == "uc":
+                # A bare \uc is malformed, the count in force stays
+                if arg is not None:
+                    uc_skip = max(0, int(arg))
+            elif word == "u":
+                # A bare \u is malformed and has no character to add
+                if arg is not None:
+                    # Signed 16-bit in the spec, code points past 32767 come negative
+                    code = int(arg) % 0x10000 if int(arg) < 0 else int(arg)
+                    if code < 0x110000:
+                        out.append(chr(code))
+                    skip = uc_skip
+
+        elif hex_code:
+            if skip > 0:
+                skip -= 1
+            elif not ignorable:
+                out.append(bytes([int(hex_code, 16)]).decode("cp1252", errors="replace"))
+
+        elif char:
+            if skip > 0:
+                skip -= 1
+            elif not ignorable:
+                out.append(char)
+
+    return "".join(out).strip()
+
+
+register("rtf", is_rtf, extract_rtf)
+
+
+# HTML
+
+
+def is_html(buffer, file_name=None):
+    """HTML documents open with a doctype or an <html> tag, after an optional BOM and whitespace."""
+    head = bytes(buffer[:1024]).lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    return head.startswith(b"<!doctype html") or head.startswith(b"<html")
+
+
+class _HTMLText(HTMLParser):
+    """Collects the visible text of an HTML document, one line per block element."""
+
+    SKIP = {"script", "style", "noscript", "template", "head"}
+    BLOCKS = {
+        "p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+        "section", "article", "blockquote", "pre", "table", "ul", "ol", "title",
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skipping += 1
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self.BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def extract_html(buffer, file_name=None):
+    """
+    Extracts the visible text of an HTML document.
+
+    Args:
+        buffer (memoryview): Content of the HTML file.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the HTML file.
+    """
+    parser = _HTMLText()
+    parser.feed(_decode(buffer))
+    parser.close()
+
+    # Collapse the whitespace HTML doesn't render, keep one line per block
+    lines = (" ".join(line.split()) for line in "".join(parser.parts).split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+register("html", is_html, extract_html)
+
+
+# Plain text and Markdown
+
+
+def is_text(buffer, file_name=None):
+    """Text has no NUL bytes and its beginning decodes as UTF-8."""
+    head = bytes(buffer[:SNIFF_BYTES])
+    if not head or b"\x00" in head:
+        return False
+    try:
+        # final=False, the sniffed window may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def extract_plain_text(buffer, file_name=None):
+    """
+    Plain text and Markdown are already text, Markdown syntax is kept as the model reads it fine.
+
+    Args:
+        buffer (memoryview): Content of the file.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: the decoded text
+    """
+    return _decode(buffer)
+
+
+# Sniffing for text only rules out binaries, so it is registered last among the native handlers
+register("text", is_text, extract_plain_text)
@@ -3,7 +3,32 @@
 from google.cloud import aiplatform
 from google.protobuf import json_format
 from google.protobuf.struct_pb2 import Value
+import asyncio
 import json
+import os
+import re
+
+from response_cache import get_cache
+from retrieval import RETRIEVAL_MAX_CONTEXT_CHARS, select_context
+
+# How many explanation requests are in flight at once, and how long each one may take
+EXPLANATION_CONCURRENCY = int(os.environ.get("EXPLANATION_CONCURRENCY", 8))
+EXPLANATION_TIMEOUT = float(os.environ.get("EXPLANATION_TIMEOUT", 120))
+
+# "batched": one prompt explains a whole group of answers, "per_question": one prompt per answer
+EXPLANATION_MODE = os.environ.get("EXPLANATION_MODE", "batched")
+# Token budget of one batched prompt: the document, the numbered questions and the explanations
+EXPLANATION_CONTEXT_TOKENS = int(os.environ.get("EXPLANATION_CONTEXT_TOKENS", 4096))
+# Tokens generated for each explanation of a group, and the most answers one group explains
+EXPLANATION_TOKENS_PER_ANSWER = int(os.environ.get("EXPLANATION_TOKENS_PER_ANSWER", 120))
+EXPLANATION_GROUP_SIZE = int(os.environ.get("EXPLANATION_GROUP_SIZE", 10))
+# Rough size of a token, for sizing groups without loading the tokenizer
+CHARS_PER_TOKEN = 4
+
+# "Explanation 2:", also with the markdown emphasis models like to add around it
+EXPLANATION_HEADER = re.compile(
+    r"^[^\w\n]*Explanation\s+(\d+)[*_ \t]*[:.)-]?[*_ \t]*", re.IGNORECASE | re.MULTILINE
+)
 
 
 class ExplanationGenerator:
@@ -26,78 +51,206 @@ class ExplanationGenerator:
             config = json.load(file)
         return config
 
-    def _send_prediction_request(self, prompt):
+    async def _predict_async(self, instance, semaphore):
         """
-        Sends a prediction request to the deployed model on Vertex AI.
+        Sends one prediction request without blocking the event loop.
 
         Args:
-            prompt (str): The input prompt for text generation.
+            instance (dict): {"prompt": ...} and optionally the "context" the model reads first.
+            semaphore (asyncio.Semaphore): bounds the requests in flight
 
         Returns:
-            str: Generated text.
+            str: Generated text, "" if the request failed or timed out. Cached responses don't
+            take a slot of the semaphore.
         """
-        instance = {"prompt": prompt}
-        try:
-            predictions = self.endpoint.predict(
-                instances=[instance], timeout=120
-            )  # Add a timeout of 30 seconds
-            # Extract and return the generated text from the predictions
-            if predictions.predictions and "response" in predictions.predictions[0]:
-                return predictions.predictions[0]["response"]
-        except Exception as e:
-            print(f"Error while getting prediction: {e}")
+        cache = get_cache()
+        if cache is not None:
+            cached = cache.get(instance, self.endpoint.resource_name)
+            if cached is not None:
+                return cached
+
+        async with semaphore:
+            try:
+                predictions = await asyncio.wait_for(
+                    self.endpoint.predict_async(
+                        instances=[instance], timeout=EXPLANATION_TIMEOUT
+                    ),
+                    EXPLANATION_TIMEOUT,
+                )
+                if predictions.predictions and "response" in predictions.predictions[0]:
+                    response = predictions.predictions[0]["response"]
+                    if cache is not None:
+                        cache.put(instance, response, self.endpoint.resource_name)
+                    return response
+            except asyncio.TimeoutError:
+                print(f"Prediction timed out after {EXPLANATION_TIMEOUT}s")
+            except Exception as e:
+                print(f"Error while getting prediction: {e}")
         return ""
 
-    def _generate_explanations_with_query(
-        self, text, user_answers, explanation_type, query
-    ):
-        explanations = {}
+    async def _gather_predictions(self, instances):
+        semaphore = asyncio.Semaphore(EXPLANATION_CONCURRENCY)
+        return await asyncio.gather(
+            *(self._predict_async(instance, semaphore) for instance in instances)
+        )
+
+    def predict_concurrently(self, prompts, context=None, max_new_tokens=None):
+        """
+        Sends all prompts concurrently, at most EXPLANATION_CONCURRENCY at a time.
+
+        Args:
+            prompts (list[str]): The input prompts for text generation.
+            context (str | list[str], optional): What the prompts are about, read by the model
+                before each prompt: one text for all of them, whose KV cache the server reuses
+                across them, or one per prompt.
+            max_new_tokens (list[int], optional): How many tokens to generate for each prompt,
+                the server's default otherwise.
+
+        Returns:
+            list[str]: Generated text for each prompt, in order. Prompts that failed or timed
+            out get "", so the others are still returned.
+        """
+        if not prompts:
+            return []
+        instances = [{"prompt": prompt} for prompt in prompts]
+        contexts = context if isinstance(context, list) else [context] * len(prompts)
+        for i, instance in enumerate(instances):
+            if contexts[i] is not None:
+                instance["context"] = contexts[i]
+            if max_new_tokens is not None:
+                instance["max_new_tokens"] = max_new_tokens[i]
+        return asyncio.run(self._gather_predictions(instances))
+
+    @staticmethod
+    def _explanation_query(question, user_answer):
+        # The text comes first as the context, so explanations of a short document share its prefix
+        return f"Explain why the answer '{user_answer}' to the question '{question}' is correct or incorrect based on the text above."
+
+    @staticmethod
+    def _grouped_query(answers):
+        """One prompt asking for a numbered explanation of each (question, answer) pair."""
+        numbered = "\n\n".join(
+            f"Question {i}: {question}\nAnswer {i}: {user_answer}"
+            for i, (question, user_answer) in enumerate(answers, 1)
+        )
+        return (
+            "For each numbered question below, explain why the given answer is correct or incorrect "
+            "based on the text above. Write one paragraph per question, in order, each starting with "
+            f"'Explanation <number>:'.\n\n{numbered}"
+        )
+
+    @staticmethod
+    def _group_answers(text, answers):
+        """
+        Splits the answers into as few groups as fit the context window, next to the document.
+
+        Args:
+            text (str): the document, sent with every group (at most the retrieved part of it)
+            answers (list[tuple]): (question, user answer) pairs
+
+        Returns:
+            list[list[tuple]]: the pairs of each group, in order
+        """
+        budget = EXPLANATION_CONTEXT_TOKENS - min(len(text), RETRIEVAL_MAX_CONTEXT_CHARS) // CHARS_PER_TOKEN
+        groups, group, used = [], [], 0
+        for question, user_answer in answers:
+            cost = len(f"{question}{user_answer}") // CHARS_PER_TOKEN + EXPLANATION_TOKENS_PER_ANSWER
+            if group and (used + cost > budget or len(group) >= EXPLANATION_GROUP_SIZE):
+                groups.append(group)
+                group, used = [], 0
+            # A question that doesn't fit even alone still gets a group of its own
+            group.append((question, user_answer))
+            used += cost
+        if group:
+            groups.append(group)
+        return groups
 
-        if explanation_type == "MCQ":
-            for question, user_answer in user_answers.items():
-                chat_history = (
-                    []
-                )  # This might need to be maintained outside the loop if context is important
-                # COMMENTED OUT QUERY
-                query = f"Explain why the answer '{user_answer}' to the question '{question}' is correct or incorrect based on the following text: {text}."
-                input_data = {"question": query, "chat_history": chat_history}
-                explanation = self._send_prediction_request(input_data)
-                explanations[question] = explanation
-
-        elif explanation_type == "ShortAnswers":
-            for question, user_answer in user_answers.items():
-                chat_history = (
-                    []
-                )  # This might need to be maintained outside the loop if context is important
-                input_data = {"question": query, "chat_history": chat_history}
-                explanation = self._send_prediction_request(input_data)
-                explanations[question] = explanation
+    @staticmethod
+    def _parse_grouped(output, count):
+        """
+        Splits a grouped answer on its "Explanation N:" headers.
 
+        Returns:
+            list[str]: the explanation of each of the count questions, "" where it is missing
+        """
+        explanations = [""] * count
+        headers = list(EXPLANATION_HEADER.finditer(output))
+        for header, following in zip(headers, headers[1:] + [None]):
+            number = int(header.group(1))
+            end = following.start() if following else len(output)
+            if 1 <= number <= count and not explanations[number - 1]:
+                explanations[number - 1] = output[header.end() : end].strip()
         return explanations
 
-    def generate_mcq_explanations(self, text, user_answers):
-        return self._generate_explanations_with_query(
-            text, user_answers, "MCQ", query=None
+    def explain_answers(self, text, answers):
+        """
+        Explains each (question, answer) pair, batching the pairs into grouped prompts unless
+        EXPLANATION_MODE is "per_question". The document is sent once per group instead of once
+        per question; the questions a grouped answer skipped are asked again on their own.
+        Of a long document, only the chunks retrieved for the questions are sent (see
+        retrieval.py).
+
+        Args:
+            text (str): the document the questions were generated from
+            answers (list[tuple]): (question, user answer) pairs
+
+        Returns:
+            list[str]: the explanation of each pair, in order
+        """
+        if EXPLANATION_MODE == "per_question":
+            return self.predict_concurrently(
+                [self._explanation_query(question, user_answer) for question, user_answer in answers],
+                [select_context(text, question) for question, _ in answers],
+            )
+
+        groups = self._group_answers(text, answers)
+        outputs = self.predict_concurrently(
+            [self._grouped_query(group) for group in groups],
+            # Retrieval is keyed on the questions of the group
+            [select_context(text, "\n".join(question for question, _ in group)) for group in groups],
+            [EXPLANATION_TOKENS_PER_ANSWER * len(group) for group in groups],
         )
+        explanations = []
+        for group, output in zip(groups, outputs):
+            explanations.extend(self._parse_grouped(output, len(group)))
+
+        missing = [i for i, explanation in enumerate(explanations) if not explanation]
+        if missing:
+            retried = self.predict_concurrently(
+                [self._explanation_query(*answers[i]) for i in missing],
+                [select_context(text, answers[i][0]) for i in missing],
+            )
+            for i, explanation in zip(missing, retried):
+                explanations[i] = explanation
+        return explanations
+
+    def generate_mcq_explanations(self, text, user_answers):
+        """
+        Explains each MCQ answer in grouped prompts, see explain_answers.
+
+        Args:
+            text (str): the document the questions were generated from
+            user_answers (dict): question -> the user's answer
+
+        Returns:
+            dict: question -> explanation, in question order
+        """
+        return dict(zip(user_answers, self.explain_answers(text, list(user_answers.items()))))
 
     def generate_short_answer_explanations(self, text, user_answers):
+        answers = [
+            (question, user_response["selected_option"])
+            for question, user_response in user_answers.items()
+        ]
         explanations = {}
-        for question, user_response in user_answers.items():
-            selected_option = user_response["selected_option"]
-            query = f"Explain why the answer '{selected_option}' to the question '{question}' is correct or incorrect based on the following text: {text}."
-            explanation = self._generate_explanations_with_query(
-                text, {question: user_response}, "ShortAnswers", query
-            )
-            explanations[question] = explanation
+        for question, explanation in zip(user_answers, self.explain_answers(text, answers)):
+            explanations[question] = {question: explanation}
         return explanations
 
     def generate_mixed_explanations(self, text, user_answers):
-        return self._generate_explanations_with_query(
-            text, user_answers, "MixedAnswers"
-        )
+        # Not supported yet, no explanation for any question
+        return {}
 
     def generate_custom_prompt_explanations(self, text, user_answers):
-        return self._generate_explanations_with_query(
-            text, user_answers, "CustomPrompt"
-        )
-
+        # Not supported yet, no explanation for any question
+        return {}
@@ -0,0 +1,225 @@
+"""
+Retrieval of the parts of a document a prompt needs.
+
+Sending a whole textbook with every prompt overflows the model's context and spends most of the
+prefill on pages the prompt has nothing to do with. Instead the extracted text is split into
+overlapping chunks, each chunk is embedded on the CPU and the vectors are kept in an index per
+document. A prompt then only carries the top-k chunks for its query, picked with maximal marginal
+relevance so they don't all repeat the same paragraph, and put back in document order.
+
+The embeddings are hashed TF-IDF vectors in numpy: no model to download, deterministic, and a few
+milliseconds for a long document. Documents short enough to fit RETRIEVAL_MAX_CONTEXT_CHARS are
+sent whole, as before.
+"""
+import hashlib
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+RETRIEVAL_CHUNK_CHARS = int(os.environ.get("RETRIEVAL_CHUNK_CHARS", 1200))
+RETRIEVAL_CHUNK_OVERLAP = int(os.environ.get("RETRIEVAL_CHUNK_OVERLAP", 200))
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 6))
+# Most characters of retrieved text one prompt carries, about 2k tokens
+RETRIEVAL_MAX_CONTEXT_CHARS = int(os.environ.get("RETRIEVAL_MAX_CONTEXT_CHARS", 8000))
+# How many document indexes are kept in memory, least recently used are dropped first
+RETRIEVAL_MAX_DOCUMENTS = int(os.environ.get("RETRIEVAL_MAX_DOCUMENTS", 16))
+EMBEDDING_DIM = 2**12
+# Relevance vs. novelty trade-off of the maximal marginal relevance selection
+MMR_LAMBDA = 0.7
+
+WORD = re.compile(r"[a-z0-9]+")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+STOP_WORDS = frozenset(
+    "a an and are as at be been but by can do does for from had has have how i if in into is it its "
+    "me my no not of on or our so than that the their them then there these they this to was we "
+    "were what when where which who why will with you your".split()
+)
+
+
+def _split_long(paragraph, chunk_chars):
+    """Splits a paragraph longer than a chunk on sentence ends, and on words if it must."""
+    pieces = []
+    for sentence in SENTENCE_END.split(paragraph):
+        while len(sentence) > chunk_chars:
+            cut = sentence.rfind(" ", 0, chunk_chars)
+            cut = cut if cut > 0 else chunk_chars
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        pieces.append(sentence)
+    return pieces
+
+
+def chunk_text(text, chunk_chars=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    """
+    Splits text into chunks of about chunk_chars characters, on paragraph and sentence boundaries.
+
+    Args:
+        text (str): the extracted document
+        chunk_chars (int): target size of a chunk
+        overlap (int): characters of the end of a chunk repeated at the start of the next one, so
+            a sentence cut between two chunks can still be retrieved whole
+
+    Returns:
+        list[str]: the chunks, in document order
+    """
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if paragraph:
+            pieces.extend(_split_long(paragraph, chunk_chars))
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > chunk_chars:
+            chunks.append(current)
+            tail = current[-overlap:] if overlap > 0 else ""
+            # Start the overlap on a word
+            current = tail[tail.find(" ") + 1 :] if " " in tail else ""
+        current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _terms(text):
+    """Lower-cased words without stop words, plus the bigrams they form."""
+    words = [word for word in WORD.findall(text.lower()) if word not in STOP_WORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def term_counts(texts, dim=EMBEDDING_DIM):
+    """
+    Hashed term counts: row i counts the terms of texts[i] in dim buckets.
+
+    Returns:
+        np.ndarray: [len(texts), dim] float32
+    """
+    counts = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        buckets = [zlib.crc32(term.encode("utf-8")) % dim for term in _terms(text)]
+        if buckets:
+            np.add.at(counts[row], buckets, 1.0)
+    return counts
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class DocumentIndex:
+    """
+    The chunks of one document and their embeddings.
+
+    Attributes:
+        chunks (list[str]): the document's chunks, in order
+        idf (np.ndarray): [dim] inverse document frequency of each bucket over the chunks
+        vectors (np.ndarray): [chunks, dim] L2-normalized TF-IDF vector of each chunk
+    """
+
+    def __init__(self, text, chunk_chars=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+        self.chunks = chunk_text(text, chunk_chars, overlap)
+        counts = term_counts(self.chunks)
+        document_frequency = np.count_nonzero(counts, axis=0)
+        self.idf = np.log((1 + len(self.chunks)) / (1 + document_frequency)).astype(np.float32) + 1
+        # Sublinear term frequency, so a word repeated 20 times doesn't drown the others
+        self.vectors = _normalize(np.log1p(counts) * self.idf)
+
+    def embed(self, query):
+        """The L2-normalized TF-IDF vector of a query, weighted with this document's idf."""
+        return _normalize(np.log1p(term_counts([query])[0]) * self.idf)
+
+    def search(self, query=None, k=RETRIEVAL_TOP_K, max_chars=RETRIEVAL_MAX_CONTEXT_CHARS):
+        """
+        Picks the chunks most relevant to a query with maximal marginal relevance: each pick
+        maximizes relevance minus similarity to the chunks already picked.
+
+        Args:
+            query (str, optional): what the prompt asks about. Without one, the chunks are picked
+                for coverage of the whole document (relevance to its centroid).
+            k (int): most chunks picked
+            max_chars (int): most characters picked, the chunk that would go over is skipped
+
+        Returns:
+            list[int]: indices of the picked chunks, in document order
+        """
+        if not self.chunks:
+            return []
+        if query and query.strip():
+            target = self.embed(query)
+        else:
+            target = _normalize(self.vectors.mean(axis=0))
+        relevance = self.vectors @ target
+
+        picked, size = [], 0
+        redundancy = np.zeros(len(self.chunks), dtype=np.float32)
+        candidates = np.ones(len(self.chunks), dtype=bool)
+        while len(picked) < k and candidates.any():
+            scores = MMR_LAMBDA * relevance - (1 - MMR_LAMBDA) * redundancy
+            best = int(np.argmax(np.where(candidates, scores, -np.inf)))
+            candidates[best] = False
+            if size + len(self.chunks[best]) > max_chars and picked:
+                continue
+            picked.append(best)
+            size += len(self.chunks[best])
+            redundancy = np.maximum(redundancy, self.vectors @ self.vectors[best])
+        return sorted(picked)
+
+    def context_for(self, query=None, k=RETRIEVAL_TOP_K, max_chars=RETRIEVAL_MAX_CONTEXT_CHARS):
+        """The text of the chunks search picks, in document order, separated by blank lines."""
+        return "\n\n".join(self.chunks[i] for i in self.search(query, k, max_chars))
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(text):
+    """
+    The index of a document, built on first use and kept in an LRU of RETRIEVAL_MAX_DOCUMENTS.
+
+    Args:
+        text (str): the extracted document
+
+    Returns:
+        DocumentIndex: the document's index
+    """
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    # Indexing a long document takes a moment, don't hold the lock over it
+    index = DocumentIndex(text)
+    with _indexes_lock:
+        _indexes[key] = index
+        _indexes.move_to_end(key)
+        while len(_indexes) > RETRIEVAL_MAX_DOCUMENTS:
+            _indexes.popitem(last=False)
+    return index
+
+
+def select_context(text, query=None, k=RETRIEVAL_TOP_K, max_chars=RETRIEVAL_MAX_CONTEXT_CHARS):
+    """
+    The part of a document to send with a prompt: all of it when it fits max_chars, else the
+    top-k chunks retrieved for the query.
+
+    Args:
+        text (str): the extracted document
+        query (str, optional): what the prompt asks about, e.g. the question being explained.
+            Without one the chunks cover the document as a whole.
+        k (int): most chunks retrieved
+        max_chars (int): most characters sent
+
+    Returns:
+        str: the context for the prompt
+    """
+    if len(text) <= max_chars:
+        return text
+    return get_index(text).context_for(query, k, max_chars)
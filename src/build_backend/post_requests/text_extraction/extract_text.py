@@ -1,27 +1,26 @@
 # Import necessary libraries
 import requests  # For making HTTP requests
 import json  # For working with JSON data
-from google.cloud import storage  # For interacting with Google Cloud Storage
-from io import BytesIO  # For handling file content as bytes
+from gcp import Bucket  # Shared, pooled Google Cloud Storage client
+from extraction import extract_docx, extract_pdf, extract_texts, iter_page_records, ndjson_lines  # Shared extraction package
 import os  # For miscellaneous operating system functions
-from PyPDF2 import PdfReader  # For working with PDF files
-from docx import Document  # For working with DOCX files
-import tempfile  # For creating temporary files
 
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_cors import cross_origin
 
 app = Flask(__name__)
 CORS(app, resources={r"*": {"origins": "*"}})
 
-# Set up Google Cloud Storage Client
+# Service account for Google Cloud Storage, the client behind it is shared process-wide
 KEY_PATH = "secrets/generate_mcq_account_key.json"
-storage_client = storage.Client.from_service_account_json(KEY_PATH)
+# Where /extract-text reads the documents from, shared with the prewarm worker
+DOCUMENTS_BUCKET = os.environ.get("DOCUMENTS_BUCKET", "bite-size-documents")
+DOCUMENTS_FOLDER = os.environ.get("DOCUMENTS_FOLDER", "documents_to_be_summarized")
 
 
 class TextExtractor:
@@ -41,9 +40,7 @@ class TextExtractor:
         Returns:
             list: List of file names in the specified folder.
         """
-        bucket = storage_client.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=folder_name)
-        return [blob.name for blob in blobs if not blob.name.endswith("/")]
+        return Bucket(KEY_PATH, bucket_name).list_files(folder_name)
 
     @staticmethod
     def load_user_answers_from_gcp(bucket_name, answers_file_name):
@@ -72,9 +69,7 @@ class TextExtractor:
         Returns:
             bytes: The content of the file as bytes.
         """
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
-        return blob.download_as_bytes()
+        return Bucket(KEY_PATH, bucket_name).get_file(file_name)
 
     @staticmethod
     def extract_text_from_pdf(pdf_file_content):
@@ -87,8 +82,7 @@ class TextExtractor:
         Returns:
             str: Extracted text from the PDF file.
         """
-        pdf_reader = PdfReader(BytesIO(pdf_file_content))
-        return "".join([page.extract_text() for page in pdf_reader.pages])
+        return extract_pdf(pdf_file_content)
 
     @staticmethod
     def extract_text_from_docx(docx_file_content):
@@ -101,39 +95,30 @@ class TextExtractor:
         Returns:
             str: Extracted text from the DOCX file.
         """
-        doc = Document(BytesIO(docx_file_content))
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        return extract_docx(docx_file_content)
     
     
     @app.route("/extract-text", methods=["GET"])
     @cross_origin()
     def extract_text():
         try:
-            # Get data from the request here, e.g., specific file names to process
-            #data = request.get_json()
-            # Assuming data contains 'files' which is a list of file names to process
-            text_generator = TextExtractor()
-            bucket_name = "bite-size-documents"
-            folder_name = "documents_to_be_summarized"
-            files = text_generator.list_files_in_gcp_bucket(bucket_name, folder_name)
-            
-            
-
-            parsed_texts = []
-
-            # Parsing different file formats and extracting text
-            for file_name in files:
-                _, extension = os.path.splitext(file_name)
-                file_in_memory = BytesIO(text_generator.get_file_from_gcp_bucket(bucket_name, file_name))
-                file_in_memory = file_in_memory.getvalue()
-
-                if extension == ".pdf":
-                    parsed_texts.append(text_generator.extract_text_from_pdf(file_in_memory))
-                elif extension == ".docx":
-                    parsed_texts.append(text_generator.extract_text_from_docx(file_in_memory))
-                else:
-                    app.logger.error(f"Unsupported file format: {extension}")
-                    continue  # Skip unsupported files
+            bucket_name = DOCUMENTS_BUCKET
+            folder_name = DOCUMENTS_FOLDER
+            bucket = Bucket(KEY_PATH, bucket_name)
+
+            # Listed blobs carry their MD5, so cached documents are neither downloaded nor parsed again
+            files = bucket.list_blobs(folder_name)
+
+            # ?stream=ndjson sends one line per page as soon as it is decoded, instead of one body at the end
+            if request.args.get("stream") == "ndjson":
+                records = iter_page_records(bucket, files)
+                return Response(
+                    stream_with_context(ndjson_lines(records)),
+                    mimetype="application/x-ndjson",
+                )
+
+            # Downloads and parsing overlap, results come back in the order of the files
+            parsed_texts = extract_texts(bucket, files)
 
             # Create a response with all parsed texts
             response = {"document_text": parsed_texts}
@@ -0,0 +1,220 @@
+"""
+Content-addressed cache of extracted document text.
+
+Entries are keyed by the GCS object's MD5 (read from the listing, so a hit needs neither the
+download nor the parser) or by a SHA-256 of the bytes for local uploads. The local-disk tier is
+an LRU bounded in bytes and shared by every worker process on the host; the optional bucket tier
+keeps entries under an `extracted_text/` prefix so other replicas and restarts benefit too.
+"""
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from google.api_core.exceptions import NotFound
+
+# Bump whenever the parsers change so stale text is never served
+PARSER_VERSION = 2
+
+CACHE_DIR = os.environ.get("EXTRACTION_CACHE_DIR", "/tmp/bitesize/extracted_text")
+MAX_BYTES = int(os.environ.get("EXTRACTION_CACHE_MAX_BYTES", 512 * 1024**2))
+BUCKET_PREFIX = "extracted_text/"
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionCache():
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, bucket=None, prefix=BUCKET_PREFIX):
+        """
+        Creates the cache, the disk tier lives in cache_dir and survives restarts.
+
+        Args:
+            cache_dir (str): directory of the local-disk tier
+            max_bytes (int): size bound of the local-disk tier, least recently used entries go first
+            bucket (Bucket): the custom GCP Bucket object of the bucket tier, None to disable it
+            prefix (str): folder of the bucket tier within the bucket
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bucket = bucket
+        self.prefix = prefix
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._scan())
+
+        # Hit/miss counters
+        self.disk_hits = 0
+        self.bucket_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for_blob(blob):
+        """
+        Cache key of a GCS object, from the metadata returned by the bucket listing.
+
+        Args:
+            blob (storage.Blob): the listed blob
+
+        Returns:
+            str: the key, None when the object has no MD5 (composite uploads)
+        """
+        if not blob.md5_hash:
+            return None
+        digest = base64.b64decode(blob.md5_hash).hex()
+        return f"v{PARSER_VERSION}-md5-{digest}"
+
+    @staticmethod
+    def key_for_content(content):
+        """
+        Cache key of raw file bytes, used for local uploads and blobs without an MD5.
+
+        Args:
+            content (bytes): the raw file content
+
+        Returns:
+            str: the key
+        """
+        return f"v{PARSER_VERSION}-sha256-{hashlib.sha256(content).hexdigest()}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def _scan(self):
+        """Lists (mtime, path, size) of every entry on disk, mtime is the last access."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".txt"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def get(self, key):
+        """
+        Looks the key up in the disk tier, then the bucket tier.
+
+        Args:
+            key (str): the cache key
+
+        Returns:
+            str: the cached text, None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                text = file.read()
+            # Mark as recently used for the LRU
+            os.utime(path)
+            with self._lock:
+                self.disk_hits += 1
+            return text
+        except FileNotFoundError:
+            pass
+
+        if self.bucket is not None:
+            try:
+                text = self.bucket.get_file(f"{self.prefix}{key}.txt").decode("utf-8")
+                # Promote to the disk tier so the next lookup is local
+                self._write_disk(key, text)
+                with self._lock:
+                    self.bucket_hits += 1
+                return text
+            except NotFound:
+                pass
+            except Exception as e:
+                # The bucket tier is best effort, a failed read extracts the document again
+                logger.error(f"Could not read [{key}] from the bucket cache: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text):
+        """
+        Stores the text in every tier.
+
+        Args:
+            key (str): the cache key
+            text (str): the extracted text
+        """
+        self._write_disk(key, text)
+
+        if self.bucket is not None:
+            try:
+                self.bucket.upload_string(text, f"{self.prefix}{key}.txt")
+            except Exception as e:
+                # The bucket tier is best effort, the disk tier already has the entry
+                logger.error(f"Could not write [{key}] to the bucket cache: {e}")
+
+    def _write_disk(self, key, text):
+        """Writes an entry atomically, then evicts least recently used entries over the bound."""
+        data = text.encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+
+        # Write to a temp file and rename so readers in other processes never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used entries until the disk tier fits. Caller holds the lock."""
+        # Other processes share the directory, so rescan rather than trusting our own running total
+        entries = sorted(self._scan())
+        self._size = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process evicted it first
+                pass
+            self._size -= size
+
+    def stats(self):
+        """
+        Returns:
+            dict: hit/miss counters, hit rate and the current size of the disk tier
+        """
+        with self._lock:
+            lookups = self.disk_hits + self.bucket_hits + self.misses
+            return {
+                "disk_hits": self.disk_hits,
+                "bucket_hits": self.bucket_hits,
+                "misses": self.misses,
+                "hit_rate": (self.disk_hits + self.bucket_hits) / lookups if lookups else 0.0,
+                "disk_bytes": self._size,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache(bucket=None):
+    """
+    Returns the process-wide cache. The bucket tier is enabled with EXTRACTION_CACHE_BUCKET_TIER=1,
+    in which case entries are stored in the bucket passed on the first call.
+
+    Args:
+        bucket (Bucket): the custom GCP Bucket object used for the bucket tier
+
+    Returns:
+        ExtractionCache: the shared cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            use_bucket = os.environ.get("EXTRACTION_CACHE_BUCKET_TIER") == "1"
+            _cache = ExtractionCache(bucket=bucket if use_bucket else None)
+    return _cache
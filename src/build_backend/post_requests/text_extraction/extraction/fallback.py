@@ -0,0 +1,41 @@
+"""
+Last-resort handler: textract, for formats none of the native handlers recognise.
+
+textract picks its parser from the file extension, so this handler needs the file name, and it is
+an optional dependency (services that don't install it simply don't get the fallback).
+"""
+import os
+import tempfile
+
+try:
+    import textract
+except ImportError:
+    textract = None
+
+from .registry import register
+
+
+def can_textract(buffer, file_name=None):
+    """textract is installed and we know which extension to hand it."""
+    return textract is not None and bool(file_name) and bool(os.path.splitext(file_name)[1])
+
+
+def extract_with_textract(file_content, file_name):
+    """
+    Extracts text from other file formats using textract.
+
+    Args:
+        file_content (memoryview): Content of the file.
+        file_name (str): the original name, its extension selects the textract parser
+
+    Returns:
+        str: Extracted text from the file.
+    """
+    _, extension = os.path.splitext(file_name)
+    with tempfile.NamedTemporaryFile(suffix=extension, delete=True) as temp_file:
+        temp_file.write(file_content)
+        temp_file.flush()
+        return textract.process(temp_file.name).decode("utf-8")
+
+
+register("textract", can_textract, extract_with_textract, fallback=True)
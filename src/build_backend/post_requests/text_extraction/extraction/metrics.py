@@ -0,0 +1,55 @@
+"""
+Per-format timing metrics for the extraction handlers.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+
+class FormatTimings():
+    def __init__(self):
+        """Creates empty counters, one entry per format name once that format has been seen."""
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, format_name, seconds, num_bytes):
+        """
+        Adds one extraction to the counters of a format.
+
+        Args:
+            format_name (str): the registered handler name, e.g. "pdf"
+            seconds (float): the wall time spent extracting
+            num_bytes (int): the size of the input document
+        """
+        with self._lock:
+            entry = self._stats.setdefault(
+                format_name, {"count": 0, "seconds": 0.0, "bytes": 0, "max_seconds": 0.0}
+            )
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["bytes"] += num_bytes
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    @contextmanager
+    def timed(self, format_name, num_bytes):
+        """Context manager recording the time spent in its body under format_name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(format_name, time.perf_counter() - start, num_bytes)
+
+    def stats(self):
+        """
+        Returns:
+            dict: format name -> count, total/mean/max seconds and bytes processed
+        """
+        with self._lock:
+            return {
+                name: dict(entry, mean_seconds=entry["seconds"] / entry["count"])
+                for name, entry in self._stats.items()
+            }
+
+
+# Process-wide counters, the pipeline records the timings reported back by its worker processes here
+timings = FormatTimings()
@@ -0,0 +1,222 @@
+"""
+Registry of format handlers. The format of a document is detected from its magic bytes, the file
+name is only a hint for the last-resort fallback, and every extraction is timed per format.
+"""
+import os
+import time
+import zipfile
+from collections import namedtuple
+
+from .buffer import BufferStream, as_buffer
+from .metrics import timings
+
+
+class UnsupportedFormat(Exception):
+    """
+    No registered handler recognises the document.
+    """
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+
+    def __str__(self):
+        extension = os.path.splitext(self.file_name)[1] if self.file_name else "unknown"
+        return f"Unsupported file format: {extension or 'unknown'}"
+
+
+# detect(buffer, file_name) -> bool, extract(buffer, file_name) -> str,
+# iter_pages(buffer, file_name) -> iterator of (page_no, text) or None when the format has no pages,
+# join_pages(texts) -> the text extract returns for those pages
+Handler = namedtuple("Handler", ["name", "detect", "extract", "iter_pages", "join_pages"])
+
+_handlers = []
+_fallbacks = []
+
+
+def join_concatenated(texts):
+    """Default page joiner, pages that keep their own line breaks are concatenated as they are."""
+    return "".join(texts)
+
+
+def register(name, detect, extract, iter_pages=None, join_pages=join_concatenated, fallback=False):
+    """
+    Adds a format handler. Handlers are tried in registration order, fallbacks only after all of them.
+
+    Args:
+        name (str): the format name used in metrics, e.g. "pdf"
+        detect (callable): (buffer, file_name) -> True if this handler can parse the document
+        extract (callable): (buffer, file_name) -> extracted text
+        iter_pages (callable): (buffer, file_name) -> iterator of (page_no, text), optional
+        join_pages (callable): texts of the pages -> the text extract returns, so a document
+            extracted page by page is cached the same as one extracted whole
+        fallback (bool): whether this is a last-resort handler
+    """
+    handler = Handler(name, detect, extract, iter_pages, join_pages)
+    (_fallbacks if fallback else _handlers).append(handler)
+
+
+def supported_formats():
+    """
+    Returns:
+        list[str]: the names of the registered handlers, in the order they are tried
+    """
+    return [handler.name for handler in _handlers + _fallbacks]
+
+
+def starts_with(buffer, magic, window=0):
+    """
+    Whether the magic bytes appear at the start of the buffer, or within its first `window` bytes.
+    """
+    head = bytes(buffer[: len(magic) + window])
+    return head.startswith(magic) if not window else magic in head
+
+
+def zip_names(buffer):
+    """
+    Member names of a ZIP based document (docx, pptx, odt ...), read from the central directory.
+
+    Returns:
+        set[str]: the member names, empty if the buffer isn't a ZIP archive
+    """
+    if not starts_with(buffer, b"PK\x03\x04"):
+        return set()
+    try:
+        with zipfile.ZipFile(BufferStream(buffer)) as archive:
+            return set(archive.namelist())
+    except zipfile.BadZipFile:
+        return set()
+
+
+def detect_format(content, file_name=None):
+    """
+    Finds the handler for a document.
+
+    Args:
+        content: the document, anything accepted by as_buffer
+        file_name (str): optional name, only used by the fallbacks
+
+    Returns:
+        Handler: the handler, None if no handler recognises the document
+    """
+    buffer = as_buffer(content)
+    for handler in _handlers + _fallbacks:
+        if handler.detect(buffer, file_name):
+            return handler
+    return None
+
+
+def handler_for(content, file_name=None, format=None):
+    """
+    Finds the handler of a document, like detect_format but raising when there is none.
+
+    Args:
+        content: the document, anything accepted by as_buffer
+        file_name (str): optional name, only used by the fallbacks
+        format (str): skip detection and use this handler
+
+    Returns:
+        Handler: the handler
+
+    Raises:
+        UnsupportedFormat: no handler recognises the document
+    """
+    buffer = as_buffer(content)
+    if format is not None:
+        for handler in _handlers + _fallbacks:
+            if handler.name == format:
+                return handler
+        raise UnsupportedFormat(file_name)
+
+    handler = detect_format(buffer, file_name)
+    if handler is None:
+        raise UnsupportedFormat(file_name)
+    return handler
+
+
+def extract_timed(content, file_name=None, format=None):
+    """
+    Extracts the text and reports how long it took, for callers that aggregate metrics themselves
+    (e.g. across worker processes).
+
+    Args:
+        content: the document, anything accepted by as_buffer
+        file_name (str): optional name, only used by the fallbacks
+        format (str): skip detection and use this handler
+
+    Returns:
+        tuple[str, float, str]: (format name, seconds, extracted text)
+
+    Raises:
+        UnsupportedFormat: no handler recognises the document
+    """
+    buffer = as_buffer(content)
+    handler = handler_for(buffer, file_name, format)
+
+    start = time.perf_counter()
+    text = handler.extract(buffer, file_name)
+    return handler.name, time.perf_counter() - start, text
+
+
+def extract_text(content, file_name=None, format=None):
+    """
+    Extracts the text of a document with the handler matching its magic bytes.
+
+    Args:
+        content: the document, anything accepted by as_buffer
+        file_name (str): optional name, only used by the fallbacks
+        format (str): skip detection and use this handler
+
+    Returns:
+        str: the extracted text
+
+    Raises:
+        UnsupportedFormat: no handler recognises the document
+    """
+    buffer = as_buffer(content)
+    name, seconds, text = extract_timed(buffer, file_name, format)
+    timings.record(name, seconds, len(buffer))
+    return text
+
+
+def _single_page(handler, buffer, file_name):
+    """Lazily extracts a format without pages as page 1."""
+    yield 1, handler.extract(buffer, file_name)
+
+
+def iter_pages(content, file_name=None, format=None):
+    """
+    Extracts the text of a document page by page. Formats without pages come back as a single page.
+
+    Args:
+        content: the document, anything accepted by as_buffer
+        file_name (str): optional name, only used by the fallbacks
+        format (str): skip detection and use this handler
+
+    Yields:
+        tuple[int, str]: (page number starting at 1, text of that page)
+
+    Raises:
+        UnsupportedFormat: no handler recognises the document
+    """
+    buffer = as_buffer(content)
+    handler = handler_for(buffer, file_name, format)
+
+    if handler.iter_pages is None:
+        pages = _single_page(handler, buffer, file_name)
+    else:
+        pages = handler.iter_pages(buffer, file_name)
+
+    # Only time spent decoding counts, not the time the consumer holds each page
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+            yield page
+    finally:
+        timings.record(handler.name, elapsed, len(buffer))
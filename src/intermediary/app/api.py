@@ -1,13 +1,14 @@
 from typing import Annotated
-from fastapi import FastAPI, File, UploadFile
+from fastapi import BackgroundTasks, FastAPI, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware 
-from google.cloud import storage
+from .gcp import Bucket
 # from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
 from fastapi import HTTPException
 import os
 import aiofiles
+import requests
 from pydantic import BaseModel
 import json
 
@@ -30,17 +31,28 @@ app.add_middleware(
 # Replace 'your-gcs-bucket-name' with your actual GCS bucket name
 GCS_BUCKET_NAME = 'bite-size-documents-2'
 
+# The question generation prewarm worker (preprocessing_question_gen/prewarm.py), unset to disable prewarming
+PREWARM_URL = os.environ.get('PREWARM_URL')
+
 def upload_to_gcs(file_path: str, blob_name: str):
     """Uploads a file to GCS."""
 
-    client = storage.Client.from_service_account_json('gen_service_account.json')
-    bucket = client.bucket(GCS_BUCKET_NAME)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(file_path)
+    Bucket('gen_service_account.json', GCS_BUCKET_NAME).upload_file(file_path, blob_name)
+
+
+def request_prewarm(blob_name: str):
+    """Asks the prewarm worker to build the question banks of an uploaded document."""
+    if not PREWARM_URL:
+        return
+    try:
+        requests.post(PREWARM_URL, json={"bucket": GCS_BUCKET_NAME, "blob_name": blob_name}, timeout=10)
+    except requests.RequestException as e:
+        # Prewarming only saves time, the banks are still built on the first test request
+        print(f"Could not request prewarming of [{blob_name}]: {e}")
 
 
 @app.post("/upload/")
-async def upload_file(file: UploadFile=File(...)):
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile=File(...)):
     try:
         # Save the uploaded file locally
         if not os.path.exists("temp"):
@@ -59,6 +71,9 @@ async def upload_file(file: UploadFile=File(...)):
         # Optionally, you can delete the local file after uploading to GCS
         os.remove(file_path)
 
+        # Build the question banks while the user gets to the test page, after the response is sent
+        background_tasks.add_task(request_prewarm, blob_name)
+
         return JSONResponse(content={"message": "File uploaded successfully"}, status_code=200)
     except Exception as e:
         raise HTTPException(
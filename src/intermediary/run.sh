@@ -7,6 +7,13 @@ echo "Stopping and removing the previous bitesize-backend-container (if it exist
 docker stop bitesize-backend-container
 docker rm bitesize-backend-container
 
-docker run -p 8080:8080 --name bitesize-backend-container bitesize-app-backend:latest
+# Uploads are sent to the prewarm worker deployed by build_backend/deploy, set PREWARM_URL to override
+if [ -z "$PREWARM_URL" ]; then
+    PREWARM_IP=$(kubectl get service prewarm-service --namespace bitesize -o jsonpath='{.status.loadBalancer.ingress[0].ip}')
+    PREWARM_URL="http://$PREWARM_IP:8081/prewarm"
+fi
+echo "Prewarming uploads at $PREWARM_URL"
+
+docker run -p 8080:8080 -e PREWARM_URL=$PREWARM_URL --name bitesize-backend-container bitesize-app-backend:latest
 
 echo "Container run successfully. Visit http://localhost:8080/docs to check"
\ No newline at end of file
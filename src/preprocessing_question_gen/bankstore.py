@@ -0,0 +1,256 @@
+"""
+Persistent store of generated question banks.
+
+A bank is the output of one inference pass over a document, so it is stored under the document's
+hash and the bank type and every replica and restart reuses it instead of prompting the model
+again. Each (document, bank type) pair is its own record: loading the MCQs of a document never
+reads its short answers. Next to the banks, the store keeps the seen state of each learner (see
+seenstate.py), a few bytes per question.
+
+The backend is picked with BANK_STORE:
+    sqlite  tables on local disk, their primary keys (doc_hash, bank_type[, user_id]) index lookups
+    gcs     one JSON object per bank under question_banks/<doc_hash>/<bank_type>.json in a bucket,
+            one binary object per learner under question_banks/<doc_hash>/seen/<user_key>/, see user_key
+    none    nothing is stored, every process generates its own banks
+
+Note: vendored into build_backend/generate_test, edit this copy and sync the other.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from google.api_core.exceptions import NotFound
+
+# Bump whenever the prompts or the bank format change so stale banks are never served
+BANK_VERSION = 2
+
+BANK_STORE = os.environ.get("BANK_STORE", "sqlite")
+BANK_STORE_PATH = os.environ.get("BANK_STORE_PATH", "/tmp/bitesize/question_banks.sqlite3")
+BANK_STORE_BUCKET = os.environ.get("BANK_STORE_BUCKET", "bite-size-documents")
+BUCKET_PREFIX = "question_banks/"
+
+def document_hash(text):
+    """
+    Key of a document's banks, from its extracted text.
+
+    Args:
+        text (str): the parsed document text
+
+    Returns:
+        str: the key
+    """
+    return f"v{BANK_VERSION}-{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+def bank_type(option, prompt=None):
+    """
+    Bank type of a TestBank option. Custom banks also depend on their prompt.
+
+    Args:
+        option (str): mcq, short answer or custom
+        prompt (str): the custom prompt
+
+    Returns:
+        str: the bank type, safe to use in an object name
+    """
+    option = option.lower().replace(" ", "_")
+    if option == "custom" and prompt:
+        return f"custom-{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}"
+    return option
+
+
+def user_key(user_id):
+    """
+    Object name part of a learner. User ids come from request bodies, hashing them keeps a "/" or
+    ".." in one from naming an object under another learner's or document's prefix.
+
+    Args:
+        user_id (str): the learner
+
+    Returns:
+        str: 64 hex characters
+    """
+    return hashlib.sha256(str(user_id).encode('utf-8')).hexdigest()
+
+
+class SQLiteBankStore():
+    def __init__(self, path=BANK_STORE_PATH):
+        """
+        Opens (and creates) the store. Every worker process on the host can share the file.
+
+        Args:
+            path (str): the SQLite database file
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            # WAL lets readers in other processes go on while a bank is written
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS banks (
+                    doc_hash TEXT NOT NULL,
+                    bank_type TEXT NOT NULL,
+                    questions TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (doc_hash, bank_type)
+                )"""
+            )
+            self._connection.execute(
+                """CREATE TABLE IF NOT EXISTS seen (
+                    doc_hash TEXT NOT NULL,
+                    bank_type TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    state BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (doc_hash, bank_type, user_id)
+                )"""
+            )
+            self._drop_unseen_column()
+
+    def _drop_unseen_column(self):
+        """
+        Databases created before the seen table have an unseen column in banks, which nothing
+        reads or writes since. It is dropped where SQLite can (3.35+) and ignored elsewhere.
+        """
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(banks)")]
+        if "unseen" in columns:
+            try:
+                self._connection.execute("ALTER TABLE banks DROP COLUMN unseen")
+            except sqlite3.OperationalError:
+                pass
+
+    def get(self, doc_hash, bank_type):
+        """
+        Looks one bank up.
+
+        Args:
+            doc_hash (str): see document_hash
+            bank_type (str): see bank_type
+
+        Returns:
+            list[str]: the bank, None when it isn't stored
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT questions FROM banks WHERE doc_hash = ? AND bank_type = ?",
+                (doc_hash, bank_type),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, doc_hash, bank_type, questions):
+        """
+        Stores a bank, replacing the previous version.
+
+        Args:
+            doc_hash (str): see document_hash
+            bank_type (str): see bank_type
+            questions (list[str]): the bank
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO banks (doc_hash, bank_type, questions, updated_at) VALUES (?, ?, ?, ?)",
+                (doc_hash, bank_type, json.dumps(questions), time.time()),
+            )
+
+    def get_seen(self, doc_hash, bank_type, user_id):
+        """
+        Looks a learner's seen state of one bank up.
+
+        Returns:
+            bytes: the serialized SeenState, None when the learner has no state yet
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM seen WHERE doc_hash = ? AND bank_type = ? AND user_id = ?",
+                (doc_hash, bank_type, user_id),
+            ).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def put_seen(self, doc_hash, bank_type, user_id, state):
+        """
+        Stores a learner's seen state of one bank.
+
+        Args:
+            state (bytes): the serialized SeenState
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?, ?)",
+                (doc_hash, bank_type, user_id, sqlite3.Binary(state), time.time()),
+            )
+
+
+class GCSBankStore():
+    def __init__(self, bucket, prefix=BUCKET_PREFIX):
+        """
+        Creates the store, shared by every replica with access to the bucket.
+
+        Args:
+            bucket (Bucket): the custom GCP Bucket object the banks are stored in
+            prefix (str): folder of the banks within the bucket
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _name(self, doc_hash, bank_type):
+        return f"{self.prefix}{doc_hash}/{bank_type}.json"
+
+    def get(self, doc_hash, bank_type):
+        """See SQLiteBankStore.get, only the requested bank's object is downloaded."""
+        try:
+            return json.loads(self.bucket.get_file(self._name(doc_hash, bank_type)))["questions"]
+        except NotFound:
+            return None
+
+    def put(self, doc_hash, bank_type, questions):
+        """See SQLiteBankStore.put."""
+        record = {"questions": questions, "updated_at": time.time()}
+        self.bucket.upload_string(
+            json.dumps(record), self._name(doc_hash, bank_type), content_type="application/json"
+        )
+
+    def _seen_name(self, doc_hash, bank_type, user_id):
+        return f"{self.prefix}{doc_hash}/seen/{user_key(user_id)}/{bank_type}.bin"
+
+    def get_seen(self, doc_hash, bank_type, user_id):
+        """See SQLiteBankStore.get_seen."""
+        try:
+            return self.bucket.get_file(self._seen_name(doc_hash, bank_type, user_id))
+        except NotFound:
+            return None
+
+    def put_seen(self, doc_hash, bank_type, user_id, state):
+        """See SQLiteBankStore.put_seen."""
+        self.bucket.upload_string(
+            state, self._seen_name(doc_hash, bank_type, user_id), content_type="application/octet-stream"
+        )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide bank store configured with BANK_STORE, None when it is "none".
+
+    Returns:
+        SQLiteBankStore | GCSBankStore: the shared store
+    """
+    global _store
+    with _store_lock:
+        if _store is None and BANK_STORE != "none":
+            if BANK_STORE == "gcs":
+                # Only the GCS backend needs the storage client and its credentials
+                from gcp import Bucket
+
+                _store = GCSBankStore(Bucket(None, BANK_STORE_BUCKET))
+            elif BANK_STORE == "sqlite":
+                _store = SQLiteBankStore()
+            else:
+                raise ValueError(f"Unknown BANK_STORE [{BANK_STORE}], expected sqlite, gcs or none")
+    return _store
@@ -0,0 +1,121 @@
+"""
+Micro-batching of prediction requests: concurrent callers submit one prompt each, a background
+thread coalesces whatever arrives within a short window into a single multi-instance call.
+
+Only the collection runs on that thread. Each collected batch is sent from a pool of
+MAX_BATCHES_IN_FLIGHT threads, so a slow predict call doesn't hold up the batches behind it. When
+every slot is busy the thread waits for one before collecting, and the requests arriving in the
+meantime go out together in the next batch.
+
+Note: vendored next to each copy of infer.py, edit this copy and sync the others.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = int(os.environ.get("LLM_MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get("LLM_MAX_BATCH_WAIT_MS", 20))
+# Batches sent to the endpoint at once, per batcher
+MAX_BATCHES_IN_FLIGHT = int(os.environ.get("LLM_MAX_BATCHES_IN_FLIGHT", 4))
+
+# One batcher per endpoint, shared by every generator instance in the process
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+class MicroBatcher():
+    def __init__(
+        self,
+        send_batch,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=MAX_BATCH_WAIT_MS,
+        max_in_flight=MAX_BATCHES_IN_FLIGHT,
+    ):
+        """
+        Starts the batching thread.
+
+        Args:
+            send_batch (callable): list of items -> list of results in the same order
+            max_batch_size (int): the most items sent in one call
+            max_wait_ms (float): how long the first item of a batch waits for company
+            max_in_flight (int): the most batches being sent at once
+        """
+        self.send_batch = send_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        max_in_flight = max(1, int(max_in_flight))
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = ThreadPoolExecutor(max_in_flight, thread_name_prefix="micro-batch")
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+        Queues one item for the next batch.
+
+        Returns:
+            Future: resolves to the result for this item
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _collect(self):
+        """Blocks for the first item, then takes more until the batch is full or the window closes."""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Wait for a free slot first, what queues up meanwhile makes the next batch fuller
+            self._slots.acquire()
+            batch = self._collect()
+            self._pool.submit(self._send, batch)
+
+    def _send(self, batch):
+        """Runs on the pool: sends one batch and resolves its futures, then frees the slot."""
+        items = [item for item, _ in batch]
+        try:
+            results = self.send_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"Batch of {len(items)} items got {len(results)} results")
+        except Exception as e:
+            logger.exception("Batch of %d items failed", len(items))
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+
+def get_batcher(key, send_batch):
+    """
+    Returns the batcher for `key`, created on first use with `send_batch`.
+
+    Args:
+        key (str): what requests are batched by, e.g. the endpoint resource name
+        send_batch (callable): list of items -> list of results, used if the batcher is created
+    """
+    batcher = _batchers.get(key)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = _batchers.get(key)
+            if batcher is None:
+                batcher = _batchers[key] = MicroBatcher(send_batch)
+    return batcher
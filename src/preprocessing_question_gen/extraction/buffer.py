@@ -0,0 +1,91 @@
+"""
+The single input type of the extraction package: a read-only memoryview over the document bytes.
+
+Every handler receives a memoryview, whatever the caller had (bytes from the bucket, a BytesIO
+from an upload, an mmap of a shared file), and parsers that need a file object get a seekable
+stream over that same memory instead of a copy.
+"""
+import io
+import mmap
+
+
+def as_buffer(content):
+    """
+    Wraps document content in a memoryview without copying it when possible.
+
+    Args:
+        content (bytes | bytearray | memoryview | mmap.mmap | BytesIO | file-like): the document
+
+    Returns:
+        memoryview: a read-only view over the content
+    """
+    if isinstance(content, memoryview):
+        return content.toreadonly()
+
+    if isinstance(content, (bytes, bytearray, mmap.mmap)):
+        return memoryview(content).toreadonly()
+
+    if isinstance(content, io.BytesIO):
+        # getbuffer shares the BytesIO's memory, no copy
+        return content.getbuffer().toreadonly()
+
+    # Any other file object (e.g. an upload) has to be read once
+    if hasattr(content, "seek"):
+        content.seek(0)
+    return memoryview(content.read()).toreadonly()
+
+
+class BufferStream(io.RawIOBase):
+    """
+    A seekable, read-only binary stream over a memoryview, for parsers that expect a file object.
+    Only the bytes a parser actually reads are copied out.
+    """
+
+    def __init__(self, buffer):
+        """
+        Args:
+            buffer (memoryview): the document content, see as_buffer
+        """
+        self._buffer = buffer.cast("B") if buffer.format != "B" else buffer
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = len(self._buffer) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._pos = position
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self._buffer)
+        else:
+            end = min(self._pos + size, len(self._buffer))
+        data = self._buffer[self._pos:end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[: len(data)] = data
+        return len(data)
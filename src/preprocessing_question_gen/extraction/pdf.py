@@ -0,0 +1,186 @@
+"""
+PDF handler: page-by-page extraction, and the parallel mode that splits large PDFs into page
+ranges parsed on a process pool.
+
+In parallel mode the bytes are written once to a temp file (in /dev/shm when available) that every
+worker memory-maps, so only the path and page range are pickled per task.
+"""
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import PyPDF2
+
+from .buffer import BufferStream, as_buffer
+from .registry import register, starts_with
+
+# PDFs with fewer pages than this are parsed serially, splitting them isn't worth the overhead
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 64))
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", 16))
+# Prefer RAM-backed storage for the shared file
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def is_pdf(buffer, file_name=None):
+    """PDF files start with %PDF-, the spec tolerates a little junk before it."""
+    return starts_with(buffer, b"%PDF-", window=1024)
+
+
+def iter_pdf_pages(pdf_file_content, file_name=None):
+    """
+    Extracts text from a PDF one page at a time, so nothing downstream has to wait for the whole document.
+
+    Args:
+        pdf_file_content: Content of the PDF file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Yields:
+        tuple[int, str]: (page number starting at 1, text of that page)
+    """
+    pdf_reader = PyPDF2.PdfReader(BufferStream(as_buffer(pdf_file_content)))
+    for page_no, page in enumerate(pdf_reader.pages, 1):
+        yield page_no, page.extract_text()
+
+
+def extract_pdf(pdf_file_content, file_name=None):
+    """
+    Extracts text from a PDF file content.
+
+    Args:
+        pdf_file_content: Content of the PDF file, anything accepted by as_buffer.
+        file_name (str): unused, part of the handler signature
+
+    Returns:
+        str: Extracted text from the PDF file.
+    """
+    return "".join(text for _, text in iter_pdf_pages(pdf_file_content))
+
+
+def count_pages(pdf_file_content):
+    """
+    Returns:
+        int: the number of pages, read from the page tree without extracting anything
+    """
+    return len(PyPDF2.PdfReader(BufferStream(as_buffer(pdf_file_content))).pages)
+
+
+register("pdf", is_pdf, extract_pdf, iter_pdf_pages)
+
+
+# Per worker process: path -> (mmap, reader) of the PDFs this worker is currently splitting
+_worker_readers = {}
+_MAX_WORKER_READERS = 2
+
+
+def _open_shared_pdf(path):
+    """
+    Opens the shared PDF in a worker process, memory-mapped and parsed only once per worker.
+
+    Args:
+        path (str): the temp file written by submit_pdf
+
+    Returns:
+        PyPDF2.PdfReader: a reader over the mapped file
+    """
+    entry = _worker_readers.get(path)
+    if entry is None:
+        # Only a couple of documents are split at a time, drop the oldest reader
+        while len(_worker_readers) >= _MAX_WORKER_READERS:
+            old_path = next(iter(_worker_readers))
+            _worker_readers.pop(old_path)[0].close()
+
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        entry = (mapped, PyPDF2.PdfReader(BufferStream(memoryview(mapped))))
+        _worker_readers[path] = entry
+    return entry[1]
+
+
+def _extract_page_range(path, start, stop):
+    """
+    Runs in a worker process: extracts pages [start, stop) of the shared PDF.
+
+    Returns:
+        tuple[float, list[str]]: the seconds spent, and the text of each page in order
+    """
+    started = time.perf_counter()
+    reader = _open_shared_pdf(path)
+    pages = [reader.pages[i].extract_text() for i in range(start, stop)]
+    return time.perf_counter() - started, pages
+
+
+def _extract_whole(content):
+    """
+    Runs in a worker process: extracts a small PDF in one task.
+
+    Returns:
+        tuple[str, float, str]: ("pdf", seconds, extracted text)
+    """
+    started = time.perf_counter()
+    text = extract_pdf(content)
+    return "pdf", time.perf_counter() - started, text
+
+
+def submit_pdf(
+    executor,
+    content,
+    min_pages=PDF_PARALLEL_MIN_PAGES,
+    pages_per_task=PDF_PAGES_PER_TASK,
+):
+    """
+    Parses a PDF on the process pool, split into page ranges when it is large enough.
+
+    Args:
+        executor (ProcessPoolExecutor): the pool to parse on
+        content (bytes): the raw PDF
+        min_pages (int): below this page count the PDF is parsed by a single task
+        pages_per_task (int): the size of each page range
+
+    Returns:
+        Future: resolves to ("pdf", seconds spent in workers, text), pages stitched back in order
+    """
+    try:
+        num_pages = count_pages(content)
+    except Exception:
+        # Let the worker raise the parse error through the future, like any other document
+        num_pages = 0
+
+    if num_pages < min_pages:
+        return executor.submit(_extract_whole, bytes(content))
+
+    # A unique name per document, worker readers are keyed by path
+    fd, path = tempfile.mkstemp(prefix=f"bitesize-{uuid.uuid4().hex}-", suffix=".pdf", dir=SHARED_DIR)
+    with os.fdopen(fd, "wb") as file:
+        file.write(content)
+
+    parts = [
+        executor.submit(_extract_page_range, path, start, min(start + pages_per_task, num_pages))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+    result = Future()
+    remaining = [len(parts)]
+    lock = threading.Lock()
+
+    def _on_part_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+
+        # Workers keep their own mapping, the file can go as soon as every range is parsed
+        os.remove(path)
+        try:
+            outputs = [part.result() for part in parts]
+            text = "".join(text for _, pages in outputs for text in pages)
+            result.set_result(("pdf", sum(seconds for seconds, _ in outputs), text))
+        except Exception as e:
+            result.set_exception(e)
+
+    for part in parts:
+        part.add_done_callback(_on_part_done)
+    return result
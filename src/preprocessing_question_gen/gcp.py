@@ -1,28 +1,113 @@
 """
 Instantaites a GCP bucket object for increased readability and efficent use
+
+Every service talks to Cloud Storage through this module. Clients are cached per
+credentials file for the lifetime of the process, so the key file is read and the
+OAuth token is minted once, and all requests share one pooled HTTP session sized
+for concurrent downloads.
 """
+import os
+import threading
+
+import google.auth
+import requests
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from google.oauth2 import service_account
+
+# Number of keep-alive connections per host, should be at least the number of concurrent downloads
+POOL_SIZE = int(os.environ.get("GCS_POOL_SIZE", 32))
+
+# One client per credentials source (key file path, or None for application default credentials)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _build_client(path):
+    """
+    Builds a storage client whose HTTP session keeps a connection pool of POOL_SIZE.
+
+    Args:
+        path (str): path to the service account json, or None for the default credentials
+
+    Returns:
+        storage.Client: the new client
+    """
+    if path is None:
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    else:
+        credentials = service_account.Credentials.from_service_account_file(
+            path, scopes=storage.Client.SCOPE
+        )
+        project = credentials.project_id
+
+    # The authorized session refreshes the token only when it expires, every request reuses it
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+def get_client(path=None):
+    """
+    Returns the process-wide storage client for the given credentials, creating it on first use.
+
+    Args:
+        path (str): path to the service account json, or None for the default credentials
+
+    Returns:
+        storage.Client: the shared client
+    """
+    client = _clients.get(path)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(path)
+            if client is None:
+                client = _build_client(path)
+                _clients[path] = client
+    return client
+
 
 class Bucket():
     def __init__(self, path, bucket_name):
         """
-        Creates the GCP bucket object based on the json path.
+        Creates the GCP bucket object based on the json path. Cheap to call, the client is shared.
+
+        Args:
+            path (str): path to the service account json, or None for the default credentials
+            bucket_name (str): the name of the GCP bucket
+        """
+        self.client = get_client(path)
+        self.bucket = self.client.bucket(bucket_name)
+
+    def list_blobs(self, folder_name):
+        """
+        List all file blobs in a GCP bucket within a specific folder.
+
+        Args:
+            folder_name (str): the name of the folder within the GCP bucket
+
+        Returns:
+            list[storage.Blob]: only files (no folders) within this folder, with their metadata
         """
-        storage_client = storage.Client.from_service_account_json(path)
-        self.bucket = storage_client.bucket(bucket_name)
-        
+        blobs = self.bucket.list_blobs(prefix=folder_name)
+        return [blob for blob in blobs if not blob.name.endswith("/")]
+
     def list_files(self, folder_name):
         """
         List all files in a GCP bucket within a specific folder.
-        
+
         Args:
             folder_name (str): the name of the folder within the GCP bucket we want the file names from
-        
+
         Returns:
             list: names of only files (no folders) within this folder
         """
-        blobs = self.bucket.list_blobs(prefix=folder_name)
-        return [blob.name for blob in blobs if not blob.name.endswith("/")]
+        return [blob.name for blob in self.list_blobs(folder_name)]
 
     def get_file(self, file_name):
         """
@@ -32,10 +117,53 @@ class Bucket():
             file_name (str): the name of the file
 
         Returns:
-            ???: File content in bytes
+            bytes: File content in bytes
         """
         blob = self.bucket.blob(file_name)
 
         # Download as bytes
         content = blob.download_as_bytes()
-        return content
\ No newline at end of file
+        return content
+
+    def upload_file(self, file_path, blob_name):
+        """
+        Upload a local file to the GCP bucket.
+
+        Args:
+            file_path (str): path of the local file
+            blob_name (str): destination name in the bucket
+        """
+        self.bucket.blob(blob_name).upload_from_filename(file_path)
+
+    def upload_string(self, data, blob_name, content_type="text/plain"):
+        """
+        Upload in-memory data to the GCP bucket.
+
+        Args:
+            data (str | bytes): the content to write
+            blob_name (str): destination name in the bucket
+            content_type (str): the MIME type stored with the object
+        """
+        self.bucket.blob(blob_name).upload_from_string(data, content_type=content_type)
+
+    def delete_folder(self, folder_name):
+        """
+        Delete every object in a folder, keeping the folder placeholder itself.
+
+        Args:
+            folder_name (str): the name of the folder within the GCP bucket
+
+        Returns:
+            int: the number of deleted objects
+        """
+        if not folder_name.endswith("/"):
+            folder_name += "/"
+
+        blobs = [
+            blob
+            for blob in self.bucket.list_blobs(prefix=folder_name)
+            if blob.name != folder_name
+        ]
+        if blobs:
+            self.bucket.delete_blobs(blobs)
+        return len(blobs)
@@ -3,23 +3,17 @@
 import os
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 
-import PyPDF2
-from docx import Document
-import textract
-import tempfile
-
 # Imports for GCP
-from google.cloud import storage
 from google.cloud import aiplatform
 from google.protobuf import json_format
 from google.protobuf.struct_pb2 import Value
 import asyncio
 
-from io import BytesIO
 
 # Custom
-from testbank import TestBank
+from testbank import ANONYMOUS_USER, TestBank
 from gcp import Bucket
+from extraction import UnsupportedFormat, extract_docx, extract_pdf, extract_text, extract_texts
 
 
 class MCQGenerator:
@@ -31,7 +25,7 @@ class MCQGenerator:
 
     def parse(self, bucket, filename):
         """
-        Given a single file, calls the appropriate parser given the file extension.
+        Given a single file, calls the appropriate parser given the file content.
 
         Args:
             bucket (Bucket): the instantiated custom GCP Bucket object
@@ -42,38 +36,26 @@ class MCQGenerator:
         """
         print(f"Parsing file [{filename}] ...")
 
-        # Don't care about the name, only the file extension like .pdf
-        _, extension = os.path.splitext(filename)
-
-        file_in_memory = BytesIO(bucket.get_file(filename))
-
-        # Uses the appropriate parser for different file formats and extracts string representation of the text
-        if extension == ".pdf":
-            return self.extract_text_from_pdf(file_in_memory)
+        try:
+            # The format is detected from the content, the name only helps the textract fallback
+            return extract_text(bucket.get_file(filename), filename)
 
-        elif extension == ".docx":
-            return self.extract_text_from_docx(file_in_memory)
-
-        else:
+        except UnsupportedFormat as e:
             # Warn the user the file isn't supported, but don't stop the execution
-            print(f"Unsupported file format [{extension}] \nSkipping...")            
+            print(f"{e} \nSkipping...")
 
-        print("\n" * 4)
-    
     @staticmethod
     def extract_text_from_pdf(pdf_file_content):
         """
         Extracts text from a PDF file content.
 
         Args:
-            pdf_file_content (BytesIO): Content of the PDF file.
+            pdf_file_content (bytes | BytesIO): Content of the PDF file.
 
         Returns:
             str: Extracted text from the PDF file.
         """
-        pdf_reader = PyPDF2.PdfReader(pdf_file_content)
-        text = "".join([page.extract_text() for page in pdf_reader.pages])
-        return text
+        return extract_pdf(pdf_file_content)
 
     @staticmethod
     def extract_text_from_docx(docx_file_content):
@@ -81,28 +63,27 @@ class MCQGenerator:
         Extracts text from a DOCX file content.
 
         Args:
-            docx_file_content (BytesIO): Content of the DOCX file.
+            docx_file_content (bytes | BytesIO): Content of the DOCX file.
 
         Returns:
             str: Extracted text from the DOCX file.
         """
-        doc = Document(docx_file_content)
-        return "\n".join([paragraph.text for paragraph in doc.paragraphs])
+        return extract_docx(docx_file_content)
 
     @staticmethod
-    def extract_text_from_other_formats(file_content):
+    def extract_text_from_other_formats(file_content, file_name=None):
         """
-        Extracts text from other file formats using textract.
+        Extracts text from other file formats (txt, md, html, rtf, pptx, odt ...),
+        detected from the content and parsed in memory. textract is only the last resort.
 
         Args:
-            file_content (BytesIO): Content of the file.
+            file_content (bytes | BytesIO): Content of the file.
+            file_name (str): Original file name, lets textract pick its parser.
 
         Returns:
             str: Extracted text from the file.
         """
-        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-            temp_file.write(file_content.read())
-            return textract.process(temp_file.name).decode("utf-8")
+        return extract_text(file_content, file_name)
 
     @staticmethod
     def print_formatted_questions(data):
@@ -114,8 +95,8 @@ class MCQGenerator:
         for idx, question_block in enumerate(data, 1):
             lines = question_block.split("\n")
 
-            # Extract the actual question from the line.
-            actual_question = lines[0].split(". ")[1]
+            # Extract the actual question from the line, dropping its number when there is one.
+            actual_question = lines[0].split(". ", 1)[-1]
 
             # Print the formatted question.
             print(f"Question {idx}: {actual_question}\n")
@@ -123,7 +104,7 @@ class MCQGenerator:
                 print(option)
             print("\n" + lines[-1] + "\n")
 
-    def mcq_test(self, text, num_questions = 10, repeats = False):
+    def mcq_test(self, text, num_questions = 10, repeats = False, user_id = ANONYMOUS_USER):
         """
         Use the right model to build the TestBank for the text (if not done previously) and output tests of user length
 
@@ -131,12 +112,13 @@ class MCQGenerator:
             text (str): the parsed document text
             num_questions (int): the number of questions the user wants for this test, default 10
             repeats (bool): whether or not the user is okay with seeing repeats, default 10
+            user_id (str): the learner, each one only gets questions they haven't seen
 
         Returns:
             list[str]: List of multiple choice test questions.
         """
-        # We need the textual information to make this at all, if this is the first call, create it
-        if self.testBank is None:
+        # We need the textual information to make this at all, if this is the first call or a new document, create it
+        if self.testBank.text != text:
             self.testBank.initalizeText(text)
 
         # Need to figure out if we have a question bank of MCQs already
@@ -144,9 +126,9 @@ class MCQGenerator:
             self.testBank.buildBank('mcq')
 
         # A question bank for the text exists, now we can make a multiple choice test
-        return self.testBank.generate_mcq_test(text, num_questions, repeats)
+        return self.testBank.generate_mcq_test(num_questions, repeats, user_id)
     
-    def short_answer_test(self, text, num_questions = 10, repeats = False):
+    def short_answer_test(self, text, num_questions = 10, repeats = False, user_id = ANONYMOUS_USER):
         """
         Use the right model to build the TestBank for the text (if not done previously) and output test of user length
 
@@ -154,12 +136,13 @@ class MCQGenerator:
             text (str): the parsed document text
             num_questions (int): the number of questions the user wants for this test, default 10
             repeats (bool): whether or not the user is okay with seeing repeats, default 10
+            user_id (str): the learner, each one only gets questions they haven't seen
 
         Returns:
             list[str]: List of short answer test questions.
         """
-        # We need the textual information to make this at all, if this is the first call, create it
-        if self.testBank is None:
+        # We need the textual information to make this at all, if this is the first call or a new document, create it
+        if self.testBank.text != text:
             self.testBank.initalizeText(text)
 
         # Need to figure out if we have a question bank of MCQs already
@@ -167,7 +150,7 @@ class MCQGenerator:
             self.testBank.buildBank('short answer')
 
         # A question bank for the text exists, now we can make a short answer test
-        return self.testBank.generate_short_answer_test(text, num_questions, repeats)     
+        return self.testBank.generate_short_answer_test(num_questions, repeats, user_id)
         
 
     def mixed_question_test(self, text, num_questions = 10, repeats = False):
@@ -182,7 +165,7 @@ class MCQGenerator:
         Returns:
             list[str]: List of multiple choice and short answer test questions.
         """
-        if self.testBank is None: 
+        if self.testBank.text != text:
             self.testBank.initalizeText(text)
 
         # Since mixed questions is just a mix of mcqs and short answers, we can use them in place of another inference call
@@ -193,19 +176,19 @@ class MCQGenerator:
             self.testBank.buildBank('short answer')
 
          # A question bank for the text exists, now we can make a mixed format test
-        return self.testBank.generate_mixed_test(text, num_questions, repeats)
+        return self.testBank.generate_mixed_test(num_questions, repeats)
 
     def custom_prompt_test(self, text, custom_prompt):
-        # We need the textual information to make this at all, if this is the first call, create it
-        if self.testBank is None:
+        # We need the textual information to make this at all, if this is the first call or a new document, create it
+        if self.testBank.text != text:
             self.testBank.initalizeText(text)
 
         # Make the bank if nothing is there
         if self.testBank.custom is None:
-            self.testBank.buildBank('custom')
+            self.testBank.buildBank('custom', custom_prompt)
 
         # A question bank for the text exists, now we can make a mixed format test
-        return self.testBank.generate_custom_test(text, custom_prompt)        
+        return self.testBank.generate_custom_test(repeats = False)        
         
 
 
@@ -226,12 +209,12 @@ if __name__ == "__main__":
         bucket = Bucket(key_path, bucket_name)
         print('Connected to Bucket')
 
-        # Get all file names from the GCP bucket
-        files = bucket.list_files(folder_name)
+        # Get all files from the GCP bucket, their MD5 lets cached documents skip the download
+        files = bucket.list_blobs(folder_name)
         print(f"Found {len(files)} files in the GCP bucket")
 
-        # Parsing different file formats and extracting text
-        parsed_texts = [generator.parse(bucket_name, file) for file in files]
+        # Parsing different file formats and extracting text, downloads and parsing overlap
+        parsed_texts = extract_texts(bucket, files)
 
         # Generating and printing MCQs for each parsed text
         for text in parsed_texts:
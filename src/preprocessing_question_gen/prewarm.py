@@ -0,0 +1,148 @@
+"""
+Background worker that builds the question banks of the uploaded documents ahead of the first test.
+
+Without it, the first mcq_test on a new document blocks on buildBank. The intermediary's /upload/
+endpoint POSTs {"bucket": ..., "blob_name": ...} to /prewarm once a file is in its bucket; the
+worker answers 202 right away and builds the MCQ and short-answer banks on its own thread. The
+banks go to the bank store (see bankstore.py), where the services that serve tests load them from,
+so BANK_STORE must point every service at the same store.
+
+Banks are keyed on the text /generate-questions receives: the frontend sends every document of
+the folder /extract-text reads, joined with newlines. The worker builds the banks of that folder,
+DOCUMENTS_BUCKET/DOCUMENTS_FOLDER, the same settings /extract-text reads, whatever bucket the
+upload names. An upload only schedules the build: it runs PREWARM_DEBOUNCE seconds after the
+last upload, so the files of one upload are prewarmed together rather than once per file, and a
+folder that changes while it is being prewarmed is prewarmed again afterwards.
+
+    PREWARM_PORT=8081 python3 prewarm.py
+"""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from extraction import extract_texts
+from gcp import Bucket
+from testbank import TestBank
+
+PREWARM_PORT = int(os.environ.get("PREWARM_PORT", 8081))
+# Seconds without a new upload before the folder is prewarmed
+PREWARM_DEBOUNCE = float(os.environ.get("PREWARM_DEBOUNCE", 30))
+# Service account json for the bucket, the default credentials when unset
+PREWARM_KEY_PATH = os.environ.get("PREWARM_KEY_PATH")
+# The folder /extract-text reads, see generate_test.py
+DOCUMENTS_BUCKET = os.environ.get("DOCUMENTS_BUCKET", "bite-size-documents")
+DOCUMENTS_FOLDER = os.environ.get("DOCUMENTS_FOLDER", "documents_to_be_summarized")
+
+# The scheduled build, whether one is running and whether the folder changed meanwhile
+_timer = None
+_running = False
+_changed = False
+_lock = threading.Lock()
+
+
+def prewarm(bucket_name=DOCUMENTS_BUCKET, folder_name=DOCUMENTS_FOLDER):
+    """
+    Extracts the documents of a folder and builds the MCQ and short-answer banks of their text, as
+    /generate-questions receives it, into the bank store. Banks the store already has are loaded
+    rather than generated, so prewarming twice is cheap.
+
+    Args:
+        bucket_name (str): the bucket /extract-text reads
+        folder_name (str): the folder /extract-text reads
+    """
+    try:
+        bucket = Bucket(PREWARM_KEY_PATH, bucket_name)
+        # The documents prewarmed before come from the extraction cache
+        texts = extract_texts(bucket, bucket.list_blobs(folder_name))
+        if not texts:
+            return
+
+        bank = TestBank()
+        bank.initalizeText("\n".join(texts))
+        for option in ('mcq', 'short answer'):
+            bank.buildBank(option)
+        print(f"Prewarmed [{folder_name}]: {len(bank.mcqs)} MCQs, {len(bank.short_answers)} short answers")
+    except Exception as e:
+        print(f"Could not prewarm [{folder_name}]: {e}")
+
+
+def _run():
+    """Timer callback: prewarms the folder, again for as long as it changed during the last build."""
+    global _timer, _running, _changed
+    with _lock:
+        _timer = None
+        if _running:
+            # The build in progress picks this upload up once it ends
+            _changed = True
+            return
+        _running = True
+
+    while True:
+        prewarm()
+        with _lock:
+            if not _changed:
+                _running = False
+                return
+            _changed = False
+
+
+def submit(blob_name, delay=None):
+    """
+    Schedules the prewarm of the documents folder after an upload, pushing back a build that is
+    scheduled but hasn't started.
+
+    Args:
+        blob_name (str): the uploaded object, only logged
+        delay (float): seconds before the build, PREWARM_DEBOUNCE by default
+
+    Returns:
+        bool: False if a build was already scheduled
+    """
+    global _timer
+    delay = PREWARM_DEBOUNCE if delay is None else delay
+    with _lock:
+        scheduled = _timer is not None
+        if scheduled:
+            _timer.cancel()
+        _timer = threading.Timer(delay, _run)
+        _timer.daemon = True
+        _timer.start()
+    print(f"Upload of [{blob_name}]: prewarming [{DOCUMENTS_FOLDER}] in {delay}s")
+    return not scheduled
+
+
+class PrewarmHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            with _lock:
+                self._reply(200, {"status": "ok", "scheduled": _timer is not None, "running": _running})
+        else:
+            self._reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/prewarm":
+            self._reply(404, {"error": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            blob_name = body["blob_name"]
+        except (ValueError, KeyError):
+            self._reply(400, {"error": "Expected a JSON body with blob_name"})
+            return
+        self._reply(202, {"queued": submit(blob_name)})
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer(("0.0.0.0", PREWARM_PORT), PrewarmHandler)
+    print(f"Prewarm worker listening on port {PREWARM_PORT}")
+    server.serve_forever()
@@ -0,0 +1,5 @@
+"""Makes the service's flat modules importable, as they are when it runs from this folder."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
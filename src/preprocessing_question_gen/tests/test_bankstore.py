@@ -0,0 +1,54 @@
+import pytest
+
+pytest.importorskip("google.api_core")
+
+from bankstore import GCSBankStore, SQLiteBankStore, bank_type, document_hash, user_key
+
+
+def test_keys():
+    assert document_hash("text") == document_hash("text") != document_hash("text ")
+    assert bank_type("short answer") == "short_answer"
+    assert bank_type("custom", "prompt a") != bank_type("custom", "prompt b")
+    assert bank_type("custom", "prompt a").startswith("custom-")
+
+
+def test_sqlite_store_round_trips_banks_and_seen_states(tmp_path):
+    store = SQLiteBankStore(str(tmp_path / "banks.sqlite3"))
+    assert store.get("doc", "mcq") is None
+    store.put("doc", "mcq", ["1. q"])
+    store.put("doc", "mcq", ["1. q", "2. r"])
+    assert store.get("doc", "mcq") == ["1. q", "2. r"]
+    assert store.get("doc", "short_answer") is None
+
+    assert store.get_seen("doc", "mcq", "learner") is None
+    store.put_seen("doc", "mcq", "learner", b"\x01\x02")
+    assert store.get_seen("doc", "mcq", "learner") == b"\x01\x02"
+    assert store.get_seen("doc", "mcq", "other") is None
+
+
+def test_sqlite_store_drops_the_unseen_column_of_old_databases(tmp_path):
+    import sqlite3
+
+    path = str(tmp_path / "banks.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE banks (doc_hash TEXT NOT NULL, bank_type TEXT NOT NULL, questions TEXT NOT NULL, "
+        "unseen TEXT, updated_at REAL NOT NULL, PRIMARY KEY (doc_hash, bank_type))"
+    )
+    connection.close()
+
+    store = SQLiteBankStore(path)
+    store.put("doc", "mcq", ["1. q"])
+    assert store.get("doc", "mcq") == ["1. q"]
+    if sqlite3.sqlite_version_info >= (3, 35):
+        columns = [row[1] for row in store._connection.execute("PRAGMA table_info(banks)")]
+        assert "unseen" not in columns
+
+
+@pytest.mark.parametrize("user_id", ["../other-doc/mcq", "a/b", "..", "learner"])
+def test_gcs_seen_names_stay_under_their_document(user_id):
+    name = GCSBankStore(bucket=None)._seen_name("doc", "mcq", user_id)
+    prefix, learner, file_name = name.rsplit("/", 2)
+    assert prefix == "question_banks/doc/seen"
+    assert learner == user_key(user_id) and len(learner) == 64
+    assert file_name == "mcq.bin"
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("google.api_core")
+
+from extraction import iter_page_records
+
+
+class FakeBucket():
+    name = "documents"
+
+    def get_file(self, name):
+        if name == "missing.txt":
+            raise IOError("503 Service Unavailable")
+        return f"text of {name}".encode("utf-8")
+
+
+class NoCache():
+    def get(self, key):
+        return None
+
+    def put(self, key, text):
+        pass
+
+
+def test_failed_download_is_an_error_record_and_the_stream_goes_on():
+    records = list(iter_page_records(FakeBucket(), ["a.txt", "missing.txt", "b.txt"], cache=NoCache()))
+    assert records == [
+        {"file": "a.txt", "page": 1, "text": "text of a.txt"},
+        {"file": "a.txt", "done": True, "pages": 1},
+        {"file": "missing.txt", "error": "503 Service Unavailable"},
+        {"file": "b.txt", "page": 1, "text": "text of b.txt"},
+        {"file": "b.txt", "done": True, "pages": 1},
+    ]
+
+
+def rtf(body):
+    from extraction.text import extract_rtf
+
+    return extract_rtf(memoryview(body.encode("latin-1")))
+
+
+def test_rtf_unicode_escapes_skip_their_replacement_characters():
+    assert rtf(r"{\rtf1\ansi\uc1 Caf\u233?\par \uc2 \u8364\'80\'80 euro}") == "Caf\u00e9\n\u20ac euro"
+    assert rtf(r"{\rtf1 \u-3913?}") == "\uf0b7"
+
+
+def test_rtf_bare_uc_and_u_are_ignored():
+    assert rtf(r"{\rtf1\uc\u text \uc\u233?going}") == "text \u00e9going"
+
+
+def test_rtf_bin_skips_its_binary_data():
+    assert rtf(r"{\rtf1 before {\*\blipuid x}{\pict\bin4 }{\}}after\bin2 \{ end}") == "before after end"
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+pytest.importorskip("google.cloud.aiplatform")
+
+from infer import LlamaTextGenerator
+
+ITEMS = [
+    {"question": 'Which "brace" closes {this}?', "difficulty": "Easy"},
+    {"question": "What about a backslash \\ and }?", "difficulty": "Hard"},
+]
+
+
+def pieces(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_iter_json_array_yields_each_object_whatever_the_pieces(size):
+    text = json.dumps(ITEMS, indent=1)
+    assert list(LlamaTextGenerator.iter_json_array(pieces(text, size))) == ITEMS
+
+
+def test_iter_json_array_yields_objects_as_they_close():
+    stream = iter(['[{"question": "A?", "difficulty": "Easy"}', ', {"question": "B', '?", "difficulty": "Medium"}]'])
+    parsed = LlamaTextGenerator.iter_json_array(stream)
+    assert next(parsed) == {"question": "A?", "difficulty": "Easy"}
+    # The first object came before the rest of the stream was read
+    assert next(stream).startswith(', {"question": "B')
+
+
+def test_iter_json_array_skips_objects_that_dont_parse():
+    text = '[{"question": "A?", difficulty: Easy}, {"question": "B?", "difficulty": "Hard"}, {"question": "cut off'
+    assert list(LlamaTextGenerator.iter_json_array([text])) == [{"question": "B?", "difficulty": "Hard"}]
+
+
+@pytest.mark.parametrize("size", [1, 2, 1000])
+def test_split_stream_regroups_items_whatever_the_pieces(size):
+    text = "1. First?\nDifficulty: Easy\n\n2. Second?\n\n\n\n3. Third?\n"
+    assert list(LlamaTextGenerator.split_stream(pieces(text, size))) == [
+        "1. First?\nDifficulty: Easy",
+        "2. Second?",
+        "3. Third?\n",
+    ]
+
+
+def test_split_stream_yields_an_item_once_its_separator_arrives():
+    stream = iter(["1. First?", "\n", "\n2. Sec", "ond?"])
+    items = LlamaTextGenerator.split_stream(stream)
+    assert next(items) == "1. First?"
+    assert next(stream) == "ond?"
+
+
+def test_split_stream_with_another_separator():
+    assert list(LlamaTextGenerator.split_stream(["a\nb", "\n", "c"], separator="\n")) == ["a", "b", "c"]
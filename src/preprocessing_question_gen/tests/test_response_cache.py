@@ -0,0 +1,75 @@
+from response_cache import ResponseCache, cache_key, is_sampled
+
+
+def test_key_ignores_only_unicode_form_and_surrounding_whitespace():
+    instance = {"prompt": "Generate 2 MCQs", "context": "Café au lait"}
+    assert cache_key(instance) == cache_key({"prompt": "  Generate 2 MCQs\n", "context": "Café au lait"})
+    assert cache_key(instance) != cache_key({"prompt": "Generate 2 MCQs", "context": "Café\nau lait"})
+    assert cache_key(instance) != cache_key({"prompt": "Generate  2 MCQs", "context": "Café au lait"})
+
+
+def test_key_covers_generation_parameters_and_namespace():
+    instance = {"prompt": "Explain", "context": "text"}
+    assert cache_key(instance) != cache_key(dict(instance, max_new_tokens=64))
+    assert cache_key(instance) != cache_key(dict(instance, temperature=0.8))
+    assert cache_key(instance, "endpoint-a") != cache_key(instance, "endpoint-b")
+    assert cache_key(instance) == cache_key({"context": "text", "prompt": "Explain"})
+
+
+def test_only_explicit_sampling_is_sampled():
+    assert not is_sampled({"prompt": "p"})
+    assert not is_sampled({"prompt": "p", "temperature": 0})
+    assert not is_sampled({"prompt": "p", "do_sample": False, "temperature": None})
+    assert is_sampled({"prompt": "p", "temperature": 0.8})
+    assert is_sampled({"prompt": "p", "do_sample": True})
+
+
+def test_greedy_instances_keep_one_response():
+    cache = ResponseCache(variants=3)
+    instance = {"prompt": "p"}
+    assert cache.get(instance) is None
+    cache.put(instance, "first")
+    cache.put(instance, "second")
+    assert cache.get(instance) == "second"
+
+
+def test_sampled_instances_miss_until_every_variant_is_cached_and_evict_the_oldest():
+    cache = ResponseCache(variants=2)
+    instance = {"prompt": "p", "temperature": 0.8}
+    cache.put(instance, "a")
+    assert cache.get(instance) is None
+    cache.put(instance, "a")
+    assert cache.get(instance) is None
+    cache.put(instance, "b")
+    assert cache.get(instance) in ("a", "b")
+    cache.put(instance, "c")
+    assert {cache.get(instance) for _ in range(50)} == {"b", "c"}
+
+
+def test_empty_responses_are_never_cached():
+    cache = ResponseCache()
+    cache.put({"prompt": "p"}, "")
+    assert cache.get({"prompt": "p"}) is None
+
+
+def test_memory_tier_evicts_the_least_recently_used_key():
+    cache = ResponseCache(size=2)
+    for prompt in ("a", "b"):
+        cache.put({"prompt": prompt}, prompt.upper())
+    assert cache.get({"prompt": "a"}) == "A"
+    cache.put({"prompt": "c"}, "C")
+    assert cache.get({"prompt": "b"}) is None
+    assert cache.get({"prompt": "a"}) == "A"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_tier_is_shared_across_instances_and_expires(tmp_path):
+    path = str(tmp_path / "responses.sqlite3")
+    ResponseCache(path=path).put({"prompt": "p"}, "cached")
+    other = ResponseCache(path=path)
+    assert other.get({"prompt": "p"}) == "cached"
+    assert other.stats()["disk_hits"] == 1
+
+    expired = ResponseCache(path=path, ttl=-1)
+    expired.put({"prompt": "q"}, "stale")
+    assert ResponseCache(path=path).get({"prompt": "q"}) is None
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from seenstate import HEADER, SeenState
+
+
+def test_draws_every_question_once_before_running_out():
+    state = SeenState(10)
+    rng = random.Random(0)
+    drawn = state.draw(4, rng) + state.draw(4, rng) + state.draw(4, rng)
+    assert sorted(drawn) == list(range(10))
+    assert state.remaining == 0
+    assert state.draw(3, rng) == []
+
+
+def test_reset_makes_every_question_unseen():
+    state = SeenState(5)
+    state.draw(5)
+    state.reset()
+    assert state.remaining == 5
+    assert sorted(state.draw(5)) == list(range(5))
+
+
+def test_sample_leaves_the_state_alone():
+    state = SeenState(6)
+    state.draw(2)
+    order, remaining = state.order.copy(), state.remaining
+    sampled = state.sample(10)
+    assert sorted(sampled) == list(range(6))
+    assert state.remaining == remaining and (state.order == order).all()
+
+
+def test_grow_adds_the_new_questions_as_unseen():
+    state = SeenState(4)
+    rng = random.Random(1)
+    seen = state.draw(3, rng)
+    state.grow(7)
+    assert state.size == 7 and state.remaining == 4
+    unseen = state.draw(4, rng)
+    assert sorted(unseen + seen) == list(range(7))
+
+
+def test_round_trips_through_bytes():
+    state = SeenState(8)
+    state.draw(3, random.Random(2))
+    data = state.to_bytes()
+    assert len(data) == HEADER.size + 4 * 8
+    restored = SeenState.from_bytes(data)
+    assert restored.size == 8 and restored.remaining == 5
+    assert (restored.order == state.order).all()
+    # The restored order is writable, drawing from it works
+    restored.draw(5)
+    assert restored.remaining == 0
+
+
+def test_rejects_an_unknown_format_version():
+    data = bytearray(SeenState(2).to_bytes())
+    data[0] = 99
+    with pytest.raises(ValueError):
+        SeenState.from_bytes(bytes(data))
@@ -0,0 +1,140 @@
+import itertools
+import re
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.cloud.aiplatform")
+
+from bankstore import SQLiteBankStore
+from infer import LlamaTextGenerator
+import testbank
+
+DOCUMENT = (
+    "Photosynthesis turns light, water and carbon dioxide into glucose and oxygen. The light "
+    "reactions happen in the thylakoid membranes, the Calvin cycle in the stroma of the chloroplast. "
+) * 6
+
+
+def mcq(number):
+    """One MCQ as the model writes it, its difficulty in a block of its own."""
+    return (
+        f"{number}. Which statement about item{number} fact{number} claim{number} term{number} holds?\n"
+        "a) one\nb) two\nc) three\nd) four\n\nDifficulty: Easy"
+    )
+
+
+class GreedyEndpoint():
+    """Answers like the model server: the same text to the same prompt unless it is sampled."""
+
+    def __init__(self, resource_name):
+        self.resource_name = resource_name
+        self.instances = []
+        self._samples = itertools.count(1)
+
+    def predict(self, instances, timeout=None):
+        self.instances.extend(instances)
+        return SimpleNamespace(predictions=[{"response": self._answer(instance)} for instance in instances])
+
+    def _answer(self, instance):
+        count = int(re.search(r"Generate (\d+)", instance["prompt"]).group(1))
+        first = next(self._samples) * 1000 if instance.get("temperature") else 0
+        return "Here are the questions:\n\n" + "\n\n".join(mcq(first + number) for number in range(1, count + 1))
+
+
+def greedy_generator(name):
+    generator = LlamaTextGenerator.__new__(LlamaTextGenerator)
+    generator.endpoint = GreedyEndpoint(name)
+    generator.stream_url = None
+    return generator
+
+
+def new_bank(tmp_path, name):
+    bank = testbank.TestBank(store=SQLiteBankStore(str(tmp_path / "banks.sqlite3")), generator=greedy_generator(name))
+    bank.initalizeText(DOCUMENT)
+    return bank
+
+
+def test_mcq_items_join_each_question_to_its_difficulty():
+    blocks = [
+        "Sure, here are 3 MCQs:",
+        "1. What is glucose made from?\na) light\nb) salt\nc) iron\nd) sand",
+        "Difficulty: Easy",
+        "2. Where is the Calvin cycle?\na) stroma\nb) nucleus\nc) membrane\nd) wall\nDifficulty: Hard",
+        "Difficulty: Hard",
+        "3. What do thylakoids hold?\\na) light reactions\\nb) DNA\\nc) ribosomes\\nd) water",
+        "Medium",
+    ]
+    assert testbank.TestBank._mcqItems(blocks) == [
+        "1. What is glucose made from?\na) light\nb) salt\nc) iron\nd) sand\nDifficulty: Easy",
+        "2. Where is the Calvin cycle?\na) stroma\nb) nucleus\nc) membrane\nd) wall\nDifficulty: Hard",
+        "3. What do thylakoids hold?\na) light reactions\nb) DNA\nc) ribosomes\nd) water\nMedium",
+    ]
+
+
+def test_short_answer_items_are_one_question_each():
+    blocks = ["Here are 3 questions:\n1. Why is light needed? (Easy)\n2. What is the stroma? (Medium)", "3. Name a product. (Hard)"]
+    assert testbank.TestBank._shortAnswerItems(blocks) == [
+        "1. Why is light needed? (Easy)",
+        "2. What is the stroma? (Medium)",
+        "3. Name a product. (Hard)",
+    ]
+
+
+def test_chunk_quotas_are_proportional_and_add_up():
+    chunks = ["a" * 500, "b" * 300, "c" * 200]
+    quotas = testbank.TestBank._chunkQuotas(SimpleNamespace(numQuestions=10), chunks)
+    assert quotas == [5, 3, 2]
+
+
+def test_chunk_quotas_give_the_rounding_to_the_largest_remainders():
+    # Exact shares 2.4, 1.56 and 0.04, the question left over goes to the second chunk
+    quotas = testbank.TestBank._chunkQuotas(SimpleNamespace(numQuestions=4), ["a" * 600, "b" * 390, "c" * 10])
+    assert quotas == [2, 2, 0]
+    # Equal remainders, the first chunks get the questions left over
+    assert testbank.TestBank._chunkQuotas(SimpleNamespace(numQuestions=7), ["a" * 450] * 3) == [3, 2, 2]
+
+
+def test_dedupe_drops_normalized_copies_and_near_duplicates():
+    questions = [
+        "1. What does the Calvin cycle produce in the stroma?",
+        "Question 4) what does the Calvin cycle produce, in the stroma",
+        "2. What does the Calvin cycle produce in the chloroplast stroma?",
+        "3. Where do the light reactions happen?",
+        "  ",
+    ]
+    assert testbank.TestBank._dedupe(questions) == [questions[0], questions[3]]
+
+
+def test_dedupe_keeps_the_bank_out_of_the_result():
+    existing = ["1. Where do the light reactions happen?"]
+    questions = ["7. Where do the light reactions happen", "8. What is released as a by-product?"]
+    assert testbank.TestBank._dedupe(questions, existing) == [questions[1]]
+
+def test_built_mcq_bank_holds_only_questions_with_their_difficulty(tmp_path):
+    bank = new_bank(tmp_path, "bank-shape")
+    bank.buildBank("mcq")
+
+    assert len(bank.mcqs) == bank.numQuestions
+    assert all(item.endswith("\nDifficulty: Easy") and "\na) one" in item for item in bank.mcqs)
+    test = bank.drawTest("mcq", 3, False)
+    assert len(test) == 3 and all("Difficulty: Easy" in item for item in test)
+
+
+def test_refill_grows_a_bank_built_by_a_greedy_server(tmp_path):
+    bank = new_bank(tmp_path, "refill-grows")
+    generator = bank.generator
+    bank.buildBank("mcq")
+    built = list(bank.mcqs)
+    assert built
+
+    built_instances = len(generator.endpoint.instances)
+    added = bank.refillBank("mcq")
+
+    assert added > 0
+    assert bank.mcqs[: len(built)] == built
+    assert len(bank.mcqs) == len(built) + added
+    refills = generator.endpoint.instances[built_instances:]
+    assert refills and all(instance.get("temperature", 0) > 0 for instance in refills)
+    # The refilled bank is what the store now serves
+    assert bank.store.get(bank.docHash, "mcq") == bank.mcqs